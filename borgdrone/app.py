@@ -1,13 +1,24 @@
 from flask import Flask, Response, render_template, request
 
 from ._version import __version__
+from .archives import ArchivesManager as archives_manager
 from .archives import archives_blueprint
 from .auth import UserManager as user_manager
 from .auth import Users, auth_blueprint
 from .bundles import bundles_blueprint
+from .dashboard import AccountingManager as accounting_manager
 from .dashboard import dashboard_blueprint
-from .extensions import db, login_manager, migrate, socketio
-from .helpers import ResponseHelper, bash
+from .extensions import (
+    borg_accounting,
+    borg_backend,
+    borg_cache,
+    borg_executor,
+    db,
+    login_manager,
+    migrate,
+    socketio,
+)
+from .helpers import ResponseHelper, bash, database
 from .repositories import repositories_blueprint
 from .settings import environ, settings_blueprint
 
@@ -45,6 +56,9 @@ def create_app() -> Flask:
     login_manager.init_app(app)
     login_manager.login_view = "auth.login"
     socketio.init_app(app)
+    borg_executor.init_app(app)
+    borg_cache.init_app(app)
+    borg_backend.init_app(app)
 
     @app.context_processor
     def utility_processor():
@@ -79,6 +93,9 @@ def create_app() -> Flask:
     with app.app_context():
 
         db.create_all()
+        database.upgrade_schema()
+        archives_manager.fill_epochs()
+        borg_accounting.init_app(app, sink=accounting_manager.save_records)
         init_db_data(app)
         app.register_blueprint(auth_blueprint, url_prefix="/auth")
         app.register_blueprint(bundles_blueprint, url_prefix="/bundles")
@@ -1,17 +1,30 @@
-from typing import Any, Dict
+import base64
+import json
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from sqlalchemy import select
+from flask import current_app as app
+from sqlalchemy import RowMapping, Select, delete, func, insert, select, tuple_, update
 
 from borgdrone.borg import BorgRunner as borg_runner
 from borgdrone.bundles import BackupBundle
 from borgdrone.bundles import BundleManager as bundle_manager
 from borgdrone.extensions import db
+from borgdrone.helpers import datahelpers
 from borgdrone.logging import BorgdroneEvent, logger
 from borgdrone.repositories import Repository
 from borgdrone.repositories import RepositoryManager as repository_manager
 from borgdrone.types import OptInt, OptStr
 
-from .models import Archive, OptArchive, OptListArchive
+from . import DiffManager as diff_manager
+from . import ListingManager as listing_manager
+from . import SearchManager as search_manager
+from .models import Archive, ListArchive, OptArchive, OptListArchive
+
+IMPORT_BATCH_SIZE = 500
+PAGE_SIZE = 50
+# above this many new archives one `borg info` for all is cheaper than one per archive
+SYNC_INFO_LIMIT = 20
 
 
 def get_one(db_id: OptInt = None, archive_id: OptStr = None, archive_name: OptStr = None) -> OptArchive:
@@ -36,6 +49,201 @@ def get_all(repo_id: int) -> OptListArchive:
     return instances
 
 
+# only what the archive list shows, selected as plain rows
+PAGE_COLUMNS = (
+    Archive.id,
+    Archive.name,
+    Archive.start,
+    Archive.start_epoch,
+    Archive.end,
+    Archive.hostname,
+    Archive.username,
+    Archive.tam,
+    Archive.duration,
+    Archive.stats_original_size,
+    Archive.stats_deduplicated_size,
+    Archive.backupbundle_id,
+)
+
+
+def encode_cursor(row: RowMapping) -> str:
+    """Opaque position after `row`, for `get_page`."""
+    return base64.urlsafe_b64encode(json.dumps([row["start_epoch"], row["id"]]).encode()).decode()
+
+
+def __decode_cursor(cursor: str) -> Optional[Tuple[int, int]]:
+    try:
+        start_epoch, db_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(start_epoch), int(db_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def __day_after(date: str) -> str:
+    return (datetime.fromisoformat(date) + timedelta(days=1)).date().isoformat()
+
+
+def __filtered(
+    stmt: Select,
+    repo_id: int,
+    bundle_id: OptInt = None,
+    hostname: OptStr = None,
+    date_from: OptStr = None,
+    date_to: OptStr = None,
+) -> Select:
+    """`stmt` limited to the archives of a repository that match the filters.
+
+    Arguments:
+        date_from -- First day to include, YYYY-MM-DD.
+        date_to -- Last day to include, YYYY-MM-DD.
+    """
+    stmt = stmt.join(BackupBundle, Archive.backupbundle_id == BackupBundle.id).where(BackupBundle.repo_id == repo_id)
+
+    if bundle_id:
+        stmt = stmt.where(Archive.backupbundle_id == bundle_id)
+    if hostname:
+        stmt = stmt.where(Archive.hostname == hostname)
+    if date_from:
+        stmt = stmt.where(Archive.start_epoch >= datahelpers.ISO8601_to_epoch(date_from))
+    if date_to:
+        stmt = stmt.where(Archive.start_epoch < datahelpers.ISO8601_to_epoch(__day_after(date_to)))
+
+    return stmt
+
+
+def get_page(
+    repo_id: int,
+    cursor: OptStr = None,
+    limit: int = PAGE_SIZE,
+    newest_first: bool = True,
+    bundle_id: OptInt = None,
+    hostname: OptStr = None,
+    date_from: OptStr = None,
+    date_to: OptStr = None,
+) -> Tuple[List[RowMapping], OptStr]:
+    """One page of a repository's archives, ordered by `start_epoch` and id.
+
+    Keyset pagination: the page starts after `cursor`, so every page costs
+    the same no matter how deep it is, and archives added in the meantime
+    do not shift the pages. Filters as in `__filtered`.
+
+    Returns:
+        The rows, and the cursor of the next page or None on the last page.
+    """
+    stmt = __filtered(select(*PAGE_COLUMNS), repo_id, bundle_id, hostname, date_from, date_to)
+
+    key = tuple_(Archive.start_epoch, Archive.id)
+    if cursor and (position := __decode_cursor(cursor)):
+        stmt = stmt.where(key < position if newest_first else key > position)
+
+    if newest_first:
+        stmt = stmt.order_by(Archive.start_epoch.desc(), Archive.id.desc())
+    else:
+        stmt = stmt.order_by(Archive.start_epoch.asc(), Archive.id.asc())
+
+    # one extra row tells whether there is a next page
+    rows = list(db.session.execute(stmt.limit(limit + 1)).mappings())
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1])
+
+
+def get_totals(
+    repo_id: int,
+    bundle_id: OptInt = None,
+    hostname: OptStr = None,
+    date_from: OptStr = None,
+    date_to: OptStr = None,
+) -> Dict[str, Any]:
+    """Number of archives, their summed stats and first/last start time (epoch), computed by the database.
+
+    Filters as in `__filtered`.
+    """
+    stmt = select(
+        func.count(Archive.id).label("archives"),
+        func.coalesce(func.sum(Archive.stats_original_size), 0).label("original_size"),
+        func.coalesce(func.sum(Archive.stats_compressed_size), 0).label("compressed_size"),
+        func.coalesce(func.sum(Archive.stats_deduplicated_size), 0).label("deduplicated_size"),
+        func.coalesce(func.sum(Archive.stats_nfiles), 0).label("nfiles"),
+        func.min(Archive.start_epoch).label("first"),
+        func.max(Archive.start_epoch).label("last"),
+    ).select_from(Archive)
+    stmt = __filtered(stmt, repo_id, bundle_id, hostname, date_from, date_to)
+
+    return dict(db.session.execute(stmt).mappings().one())
+
+
+def get_bundle_growth(repo_id: int, date_from: OptStr = None, date_to: OptStr = None) -> List[RowMapping]:
+    """Per bundle and day: archives made, their summed sizes, and the running total of deduplicated size.
+
+    Days are local days, computed by the database from `start_epoch`.
+    """
+    day = func.date(Archive.start_epoch, "unixepoch", "localtime").label("day")
+    daily = (
+        __filtered(
+            select(
+                Archive.backupbundle_id,
+                day,
+                func.count(Archive.id).label("archives"),
+                func.coalesce(func.sum(Archive.stats_original_size), 0).label("original_size"),
+                func.coalesce(func.sum(Archive.stats_deduplicated_size), 0).label("deduplicated_size"),
+            ),
+            repo_id,
+            date_from=date_from,
+            date_to=date_to,
+        )
+        .where(Archive.start_epoch.is_not(None))
+        .group_by(Archive.backupbundle_id, day)
+        .subquery()
+    )
+
+    growth = func.sum(daily.c.deduplicated_size).over(partition_by=daily.c.backupbundle_id, order_by=daily.c.day)
+    stmt = select(daily, growth.label("growth")).order_by(daily.c.backupbundle_id, daily.c.day)
+
+    return list(db.session.execute(stmt).mappings())
+
+
+def fill_epochs(batch_size: int = IMPORT_BATCH_SIZE) -> int:
+    """Set `start_epoch` and `end_epoch` of archives stored before the columns existed.
+
+    Returns:
+        int -- Number of archives updated.
+    """
+    filled = 0
+    last_id = 0
+    while True:
+        stmt = (
+            select(Archive.id, Archive.start, Archive.end)
+            .where(Archive.start_epoch.is_(None), Archive.id > last_id)
+            .order_by(Archive.id)
+            .limit(batch_size)
+        )
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            break
+
+        updates = [
+            {
+                "id": db_id,
+                "start_epoch": datahelpers.ISO8601_to_epoch(start),
+                "end_epoch": datahelpers.ISO8601_to_epoch(end),
+            }
+            for db_id, start, end in rows
+        ]
+        db.session.execute(update(Archive), updates)
+        db.session.commit()
+
+        filled += len(rows)
+        last_id = rows[-1][0]
+
+    if filled:
+        logger.debug(f"Filled the epoch columns of {filled} archives.", "yellow")
+
+    return filled
+
+
 def delete_archive(archive_name: str) -> BorgdroneEvent[None]:
     _log = BorgdroneEvent[None]()
     _log.event = "ArchivesManager.delete_archive"
@@ -46,15 +254,83 @@ def delete_archive(archive_name: str) -> BorgdroneEvent[None]:
     repository = archive.backupbundle.repo
 
     # run borg command
-    result_log = borg_runner.delete_archive(repository.path, archive.name)
+    env = borg_runner.repository_env(repository.passphrase)
+    result_log = borg_runner.delete_archive(repository.path, archive.name, env)
     if result_log.status == "FAILURE":
         return _log.return_failure(result_log.error_message)
     logger.success("Archive deleted from disk.")
 
+    listing_manager.remove_listings(repository.repo_id, [archive.archive_id])
+    diff_manager.remove_diffs(repository.repo_id, [archive.archive_id])
+    search_manager.remove_archives([archive.id])
     archive.delete()
+    schedule_compact(repository)
     return _log.return_success("Archive deleted.")
 
 
+def delete_archives(archive_ids: List[int]) -> BorgdroneEvent[Dict[str, OptStr]]:
+    """Delete many archives with one borg call and one transaction per repository.
+
+    Repositories are independent, one that fails does not stop the others.
+    The data maps every repository path to its error, None where the
+    archives were deleted, and a failure message names both.
+    """
+    _log = BorgdroneEvent[Dict[str, OptStr]]()
+    _log.event = "ArchivesManager.delete_archives"
+
+    archives = list(db.session.scalars(select(Archive).where(Archive.id.in_(archive_ids))))
+    if not archives:
+        return _log.not_found_message("Archive")
+
+    by_repository: Dict[int, Tuple[Repository, List[Archive]]] = {}
+    for archive in archives:
+        repository = archive.backupbundle.repo
+        by_repository.setdefault(repository.id, (repository, []))[1].append(archive)
+
+    results: Dict[str, OptStr] = {}
+    for repository, repository_archives in by_repository.values():
+        # run borg command
+        result_log = borg_runner.delete_archives(
+            repository.path,
+            [archive.name for archive in repository_archives],
+            borg_runner.repository_env(repository.passphrase),
+        )
+        if result_log.status == "FAILURE":
+            results[repository.path] = result_log.error_message or "Unknown error."
+            continue
+
+        deleted_ids = [archive.archive_id for archive in repository_archives]
+        listing_manager.remove_listings(repository.repo_id, deleted_ids)
+        diff_manager.remove_diffs(repository.repo_id, deleted_ids)
+        search_manager.remove_archives([archive.id for archive in repository_archives])
+        db.session.execute(delete(Archive).where(Archive.id.in_([archive.id for archive in repository_archives])))
+        db.session.commit()
+
+        schedule_compact(repository)
+        results[repository.path] = None
+
+    _log.set_data(results)
+    failed = [f"{path}: {error}" for path, error in results.items() if error is not None]
+    if failed:
+        message = f"Not deleted from {'; '.join(failed)}"
+        if deleted := [path for path, error in results.items() if error is None]:
+            message += f" Deleted from {', '.join(deleted)}."
+        return _log.return_failure(message)
+
+    return _log.return_success(f"{len(archives)} archives deleted.")
+
+
+def schedule_compact(repository: Repository) -> None:
+    """Reclaim the space of deleted archives later, in one `borg compact`."""
+    borg_runner.schedule_compact(
+        repository.path,
+        delay=float(app.config.get("BORG_COMPACT_DELAY", 60)),
+        threshold=int(app.config.get("BORG_COMPACT_THRESHOLD", 10)),
+        window=app.config.get("BORG_COMPACT_WINDOW", ""),
+        env=borg_runner.repository_env(repository.passphrase),
+    )
+
+
 def refresh_archive(archive_name: str) -> BorgdroneEvent[None]:
     _log = BorgdroneEvent[None]()
     _log.event = "ArchivesManager.refresh_archive"
@@ -69,7 +345,8 @@ def refresh_archive(archive_name: str) -> BorgdroneEvent[None]:
         return _log.not_found_message("Repository")
 
     # run borg command
-    result_log = borg_runner.archive_info(repository.path, archive.name)
+    env = borg_runner.repository_env(repository.passphrase)
+    result_log = borg_runner.archive_info(repository.path, archive.name, env)
     if not (data := result_log.get_data()):
         return _log.return_failure(result_log.error_message)
 
@@ -136,44 +413,267 @@ def __process_command(command: str) -> Dict[str, Any]:
     return bundle_data
 
 
-def import_archives(repository: Repository) -> BorgdroneEvent[None]:
+def __archive_rows(bundle: BackupBundle, archives: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Turn BorgRunner archive dicts into rows for a bulk insert/update of Archive."""
+    columns = {column.key for column in Archive.__table__.columns}
+
+    rows = []
+    for archive in archives:
+        row = {key: value for key, value in archive.items() if key in columns}
+        row["backupbundle_id"] = bundle.id
+        rows.append(row)
+
+    return rows
+
+
+def __upsert_archives(repository: Repository, rows: List[Dict[str, Any]]) -> None:
+    """Insert new archives and update known ones (matched on archive_id) in one transaction."""
+    archive_ids = [row["archive_id"] for row in rows]
+    stmt = select(Archive.archive_id, Archive.id).where(
+        Archive.repository_id == repository.repo_id, Archive.archive_id.in_(archive_ids)
+    )
+    existing = dict(db.session.execute(stmt).tuples().all())
+
+    inserts = [row for row in rows if row["archive_id"] not in existing]
+    updates = [{**row, "id": existing[row["archive_id"]]} for row in rows if row["archive_id"] in existing]
+
+    if inserts:
+        db.session.execute(insert(Archive), inserts)
+    if updates:
+        db.session.execute(update(Archive), updates)
+
+    db.session.commit()
+
+
+def __resolve_bundle(
+    repository: Repository, bundles: Dict[str, BackupBundle], command_line: str
+) -> BorgdroneEvent[BackupBundle]:
+    """Find the bundle that produced an archive, creating it when it is unknown.
+
+    `bundles` maps command lines to the repository's bundles and is updated in place.
+    """
+    _log = BorgdroneEvent[BackupBundle]()
+    _log.event = "ArchivesManager.resolve_bundle"
+
+    bundle_data = __process_command(command_line)
+
+    bundle_command = bundle_manager.parse_bundle_create_command(
+        bundle_data["repository_path"],
+        bundle_data["name_format"],
+        bundle_data["exclude_paths"],
+        bundle_data["include_paths"],
+    )
+    bundle_data["command_line"] = bundle_command
+
+    if bundle := bundles.get(bundle_command):
+        _log.set_data(bundle)
+        return _log
+
+    result_log = bundle_manager.create_bundle_from_command(repository, bundle_data)
+    if not (bundle := result_log.get_data()):
+        return _log.return_failure(result_log.error_message)
+
+    bundles[bundle_command] = bundle
+    _log.set_data(bundle)
+    return _log
+
+
+def import_archives(
+    repository: Repository,
+    refresh: bool = False,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> BorgdroneEvent[None]:
+    """Import the archives of a repository into the database.
+
+    Archive metadata and stats come from a single `borg info` call and are
+    written with one bulk insert/update per batch. Archives that are already
+    in the database are skipped unless `refresh` is set, so an interrupted
+    import picks up where it stopped.
+
+    Arguments:
+        repository -- The repository to import from.
+        refresh -- Also update archives that were imported before.
+        batch_size -- Archives written per transaction.
+        progress -- Called with (processed, total) after every batch.
+    """
     _log = BorgdroneEvent[None]()
     _log.event = "ArchivesManager.sync_archives_with_db"
 
-    # Run borg command to list all archives
-    result_log = borg_runner.list_archives(repository.path)
-    if not (archives := result_log.get_data()):
+    known = set()
+    if not refresh:
+        known = set(db.session.scalars(select(Archive.archive_id).where(Archive.repository_id == repository.repo_id)))
+
+    # Stream the archive list, only the ids that still need importing are kept
+    found = 0
+    wanted = set()
+    listing_log = BorgdroneEvent[None]()
+    env = borg_runner.repository_env(repository.passphrase)
+    for archive in borg_runner.iter_archives(repository.path, repository.repo_id, listing_log, env):
+        found += 1
+        if archive["archive_id"] not in known:
+            wanted.add(archive["archive_id"])
+
+    if listing_log.status == "FAILURE":
+        # Possible:
+        # - Repository.DoesNotExist
+        return _log.return_failure(listing_log.error_message)
+
+    logger.success(f"Found {found} archives, {len(wanted)} to import.")
+
+    if not wanted:
+        return _log.return_success("Archives imported.")
+
+    # Possible:
+    # - Repository.DoesNotExist
+    result_log = borg_runner.list_archives_info(repository.path, env)
+    if (archives_info := result_log.get_data()) is None:
         return _log.return_failure(result_log.error_message)
 
-    logger.success(f"Found {len(archives)} archives.")
+    archives_info = [archive for archive in archives_info if archive["archive_id"] in wanted]
 
-    for archive in archives:
-        logger.success(f"Processing {archive['name']}", "yellow")
-        bundle_data = __process_command(archive["command_line"])
-
-        bundle_command = bundle_manager.parse_bundle_create_command(
-            bundle_data["repository_path"],
-            bundle_data["name_format"],
-            bundle_data["exclude_paths"],
-            bundle_data["include_paths"],
+    result_log = __write_archives(repository, archives_info, batch_size, progress)
+    if result_log.status == "FAILURE":
+        return _log.return_failure(result_log.error_message)
+
+    __index_new(repository, list(wanted))
+    return _log.return_success("Archives imported.")
+
+
+def __index_new(repository: Repository, archive_ids: List[str]) -> None:
+    """List and index archives that were just added, when FILE_INDEX_AUTO is on."""
+    if not archive_ids or not search_manager.auto_index():
+        return
+
+    db_ids = []
+    for start in range(0, len(archive_ids), IMPORT_BATCH_SIZE):
+        stmt = select(Archive.id).where(
+            Archive.repository_id == repository.repo_id,
+            Archive.archive_id.in_(archive_ids[start : start + IMPORT_BATCH_SIZE]),
         )
-        bundle_data["command_line"] = bundle_command
+        db_ids.extend(db.session.scalars(stmt))
+
+    listing_manager.build_listings(db_ids)
+
+
+def __write_archives(
+    repository: Repository,
+    archives_info: List[Dict[str, Any]],
+    batch_size: int = IMPORT_BATCH_SIZE,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> BorgdroneEvent[None]:
+    """Upsert archive info into the database in batches, creating missing bundles."""
+    _log = BorgdroneEvent[None]()
+    _log.event = "ArchivesManager.write_archives"
+
+    bundles = {bundle.command_line: bundle for bundle in bundle_manager.get_all(repository.id) or []}
+
+    total = len(archives_info)
+    for start in range(0, total, batch_size):
+        batch: Dict[int, Tuple[BackupBundle, List[Dict[str, Any]]]] = {}
 
-        bundle = bundle_manager.get_one(command_line=bundle_command)
-        if bundle:
-            logger.success("A bundle for this archive was found.")
-        else:
-            result_log = bundle_manager.create_bundle_from_command(repository, bundle_data)
+        for archive in archives_info[start : start + batch_size]:
+            result_log = __resolve_bundle(repository, bundles, archive["command_line"])
             if not (bundle := result_log.get_data()):
                 return _log.return_failure(result_log.error_message)
 
-        result = borg_runner.archive_info(repository.path, archive["name"])
-        if not (archive_data := result.get_data()):
-            return _log.return_failure(f"Error processing archive {archive['name']}.")
+            batch.setdefault(bundle.id, (bundle, []))[1].append(archive)
 
-        archive = Archive().update_from_dict(archive_data)
-        bundle.archives.append(archive)
-        bundle.commit()
-        logger.success("Archive processed successfully.")
+        rows = []
+        for bundle, bundle_archives in batch.values():
+            rows.extend(__archive_rows(bundle, bundle_archives))
+        __upsert_archives(repository, rows)
 
-    return _log.return_success("Archives imported.")
+        processed = min(start + batch_size, total)
+        logger.debug(f"Imported {processed}/{total} archives.", "yellow")
+        if progress:
+            progress(processed, total)
+
+    return _log.return_debug_success()
+
+
+def __fetch_archives_info(repository: Repository, names: Dict[str, str]) -> BorgdroneEvent[List[Dict[str, Any]]]:
+    """Info for the archives in `names` (archive_id -> name), with as few borg calls as possible."""
+    _log = BorgdroneEvent[List[Dict[str, Any]]]()
+    _log.event = "ArchivesManager.fetch_archives_info"
+
+    env = borg_runner.repository_env(repository.passphrase)
+
+    if len(names) > SYNC_INFO_LIMIT:
+        # Possible:
+        # - Repository.DoesNotExist
+        result_log = borg_runner.list_archives_info(repository.path, env)
+        if (archives_info := result_log.get_data()) is None:
+            return _log.return_failure(result_log.error_message)
+
+        _log.set_data([archive for archive in archives_info if archive["archive_id"] in names])
+        return _log.return_debug_success()
+
+    archives_info = []
+    for name in names.values():
+        result_log = borg_runner.archive_info(repository.path, name, env)
+        if not (data := result_log.get_data()):
+            return _log.return_failure(result_log.error_message)
+        archives_info.append(data)
+
+    _log.set_data(archives_info)
+    return _log.return_debug_success()
+
+
+def sync_archives(repo_db_id: int) -> BorgdroneEvent[ListArchive]:
+    """Reconcile the database with the archives that exist in a repository.
+
+    Only the archive id list is read from borg and compared with the
+    database. Details are fetched for new archives only, rows of archives
+    that were deleted outside Borgdrone are removed.
+
+    Returns:
+        BorgdroneEvent[ListArchive] -- The repository's archives after the sync.
+    """
+    _log = BorgdroneEvent[ListArchive]()
+    _log.event = "ArchivesManager.sync_archives"
+
+    repository = repository_manager.get_one(db_id=repo_db_id)
+    if not repository:
+        return _log.not_found_message("Repository")
+
+    stmt = select(Archive.archive_id, Archive.id).join(BackupBundle).where(BackupBundle.repo_id == repository.id)
+    in_db: Dict[str, int] = dict(db.session.execute(stmt).tuples().all())
+
+    on_disk: Dict[str, str] = {}
+    listing_log = BorgdroneEvent[None]()
+    env = borg_runner.repository_env(repository.passphrase)
+    for archive in borg_runner.iter_archives(repository.path, repository.repo_id, listing_log, env):
+        on_disk[archive["archive_id"]] = archive["name"]
+
+    if listing_log.status == "FAILURE":
+        # Possible:
+        # - Repository.DoesNotExist
+        return _log.return_failure(listing_log.error_message)
+
+    new = {archive_id: name for archive_id, name in on_disk.items() if archive_id not in in_db}
+    vanished = [db_id for archive_id, db_id in in_db.items() if archive_id not in on_disk]
+    vanished_ids = [archive_id for archive_id in in_db if archive_id not in on_disk]
+    listing_manager.remove_listings(repository.repo_id, vanished_ids)
+    diff_manager.remove_diffs(repository.repo_id, vanished_ids)
+    search_manager.remove_archives(vanished)
+
+    if new:
+        result_log = __fetch_archives_info(repository, new)
+        if (archives_info := result_log.get_data()) is None:
+            return _log.return_failure(result_log.error_message)
+
+        result_log = __write_archives(repository, archives_info)
+        if result_log.status == "FAILURE":
+            return _log.return_failure(result_log.error_message)
+
+        __index_new(repository, list(new))
+
+    if vanished:
+        db.session.execute(delete(Archive).where(Archive.id.in_(vanished)))
+        db.session.commit()
+
+    logger.debug(f"{len(on_disk)} archives on disk, {len(new)} added, {len(vanished)} removed.", "yellow")
+
+    _log.set_data(get_all(repository.id) or [])
+    return _log.return_success(f"Archives synchronized: {len(new)} added, {len(vanished)} removed.")
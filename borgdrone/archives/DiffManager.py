@@ -0,0 +1,297 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from flask import current_app as app
+from sqlalchemy import select
+
+from borgdrone.borg import BorgRunner as borg_runner
+from borgdrone.extensions import borg_executor, db
+from borgdrone.helpers import database
+from borgdrone.logging import BorgdroneEvent, logger
+
+from . import ListingManager as listing_manager
+from . import diff
+from .models import Archive
+
+PAGE_SIZE = 100
+# changes written at once, and how often a cancelled comparison notices
+CHUNK_CHANGES = 5000
+# finished comparisons kept for their status
+KEEP_DIFFS = 20
+# archives offered to compare with
+COMPARABLE_LIMIT = 200
+
+
+class ArchiveDiff:
+    """Background comparison of two archives of the same repository.
+
+    - `source`: "listings" when both archive listings are cached, "borg" otherwise
+    - `status`: RUNNING, READY, FAILED, CANCELLED
+    """
+
+    def __init__(self, old_db_id: int, new_db_id: int, source: str):
+        self.old_db_id = old_db_id
+        self.new_db_id = new_db_id
+        self.source = source
+        self.status = "RUNNING"
+        self.changes = 0
+        self.error = ""
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.job = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "old_db_id": self.old_db_id,
+            "new_db_id": self.new_db_id,
+            "source": self.source,
+            "status": self.status,
+            "changes": self.changes,
+            "error": self.error,
+            "elapsed": round((self.finished or time.time()) - self.started, 1),
+        }
+
+
+__diffs: Dict[Tuple[int, int], ArchiveDiff] = {}
+__diffs_lock = threading.Lock()
+
+
+def ordered(first: Archive, second: Archive) -> Tuple[Archive, Archive]:
+    """The two archives, older first."""
+    if (first.start_epoch or 0, first.id) > (second.start_epoch or 0, second.id):
+        return second, first
+    return first, second
+
+
+def diff_path(old: Archive, new: Archive) -> str:
+    """Where the comparison of two archives is stored, next to their listings."""
+    repo_id = old.backupbundle.repo.repo_id
+    return os.path.join(app.config["LISTINGS_DIR"], repo_id, "diffs", f"{old.archive_id}-{new.archive_id}.sqlite3")
+
+
+def remove_diffs(repo_id: str, archive_ids: List[str]) -> None:
+    """Delete the comparisons that involve archives that no longer exist. `repo_id` is the borg repository id."""
+    directory = os.path.join(app.config["LISTINGS_DIR"], repo_id, "diffs")
+    if not archive_ids or not os.path.isdir(directory):
+        return
+
+    removed = set(archive_ids)
+    for filename in os.listdir(directory):
+        old_id, _, new_id = filename.split(".")[0].partition("-")
+        if old_id in removed or new_id in removed:
+            os.remove(os.path.join(directory, filename))
+
+
+def comparable(archive: Archive) -> List[Archive]:
+    """Other archives of the same repository, newest first."""
+    stmt = (
+        select(Archive)
+        .where(Archive.repository_id == archive.repository_id, Archive.id != archive.id)
+        .order_by(Archive.start_epoch.desc())
+        .limit(COMPARABLE_LIMIT)
+    )
+    return list(db.session.scalars(stmt))
+
+
+def previous(archive: Archive) -> Optional[Archive]:
+    """The archive of the same bundle made before `archive`, the usual one to compare with."""
+    stmt = (
+        select(Archive)
+        .where(
+            Archive.backupbundle_id == archive.backupbundle_id,
+            Archive.start_epoch < (archive.start_epoch or 0),
+        )
+        .order_by(Archive.start_epoch.desc())
+        .limit(1)
+    )
+    return db.session.scalars(stmt).first()
+
+
+def __changes(old: Archive, new: Archive, source: str, stream_log: BorgdroneEvent[None]) -> Iterator[diff.ChangeTuple]:
+    if source == "listings":
+        yield from diff.diff_listings(listing_manager.listing_path(old), listing_manager.listing_path(new))
+        return
+
+    repository = old.backupbundle.repo
+    env = borg_runner.repository_env(repository.passphrase)
+    yield from diff.parse_diff_lines(
+        borg_runner.iter_archive_diff_lines(repository.path, old.name, new.name, stream_log, env)
+    )
+
+
+def __run(archive_diff: ArchiveDiff) -> None:
+    old = database.get_by_id(archive_diff.old_db_id, Archive)
+    new = database.get_by_id(archive_diff.new_db_id, Archive)
+    if not old or not new:
+        archive_diff.status = "FAILED"
+        archive_diff.error = "Archive not found."
+        return
+
+    path = diff_path(old, new)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # written next to the final file and renamed, a diff that exists is complete
+    writer = diff.DiffWriter(f"{path}.partial")
+    stream_log = BorgdroneEvent[None]()
+    cancelled = False
+    try:
+        changes = __changes(old, new, archive_diff.source, stream_log)
+        while chunk := [change for _, change in zip(range(CHUNK_CHANGES), changes)]:
+            writer.write(chunk)
+            archive_diff.changes = writer.changes
+            if cancelled := archive_diff.job is not None and archive_diff.job.cancelled:
+                changes.close()
+                break
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        writer.abort()
+        archive_diff.status = "FAILED"
+        archive_diff.error = str(e)
+        return
+
+    if stream_log.status == "FAILURE" or cancelled:
+        writer.abort()
+        archive_diff.status = "CANCELLED" if cancelled else "FAILED"
+        archive_diff.error = stream_log.error_message or "Comparison cancelled."
+        return
+
+    writer.finish({"old": old.name, "new": new.name, "source": archive_diff.source})
+    os.replace(f"{path}.partial", path)
+
+    archive_diff.status = "READY"
+    elapsed = time.time() - archive_diff.started
+    logger.debug(f"Diff of {old.name} and {new.name}: {writer.changes} changes in {elapsed:.1f}s", "green")
+
+
+def __finished(archive_diff: ArchiveDiff) -> None:
+    archive_diff.finished = time.time()
+    if archive_diff.status == "RUNNING":
+        # the job failed before it could record why
+        archive_diff.status = "CANCELLED" if archive_diff.job is not None and archive_diff.job.cancelled else "FAILED"
+
+
+def __cached(old: Archive, new: Archive) -> bool:
+    return os.path.exists(listing_manager.listing_path(old)) and os.path.exists(listing_manager.listing_path(new))
+
+
+def start_diff(first_db_id: int, second_db_id: int) -> BorgdroneEvent[ArchiveDiff]:
+    """Compare two archives in the background, unless they are already being compared.
+
+    With both listings cached the listings are merged without borg, which
+    takes seconds even for millions of files. Otherwise `borg diff` is
+    streamed, queued behind other work on the repository.
+    """
+    _log = BorgdroneEvent[ArchiveDiff]()
+    _log.event = "DiffManager.start_diff"
+
+    first = database.get_by_id(first_db_id, Archive)
+    second = database.get_by_id(second_db_id, Archive)
+    if not first or not second:
+        return _log.not_found_message("Archive")
+    if first.id == second.id:
+        return _log.return_failure("Select two different archives.")
+    if first.repository_id != second.repository_id:
+        return _log.return_failure("Only archives of the same repository can be compared.")
+
+    old, new = ordered(first, second)
+    source = "listings" if __cached(old, new) else "borg"
+
+    with __diffs_lock:
+        if (archive_diff := __diffs.get((old.id, new.id))) is not None and archive_diff.status == "RUNNING":
+            _log.set_data(archive_diff)
+            return _log.return_success("The archives are already being compared.")
+
+        archive_diff = ArchiveDiff(old.id, new.id, source)
+        __diffs[(old.id, new.id)] = archive_diff
+        for key in [key for key, done in __diffs.items() if done.status != "RUNNING"][:-KEEP_DIFFS]:
+            del __diffs[key]
+
+    # merging listings does not touch the repository, it only counts against the global limit
+    key = old.backupbundle.repo.path if source == "borg" else None
+    archive_diff.job = borg_executor.submit(key, __run, archive_diff)
+    archive_diff.job.add_done_callback(lambda _job: __finished(archive_diff))
+
+    _log.set_data(archive_diff)
+    return _log.return_success("Comparing the archives.")
+
+
+def cancel_diff(first_db_id: int, second_db_id: int) -> BorgdroneEvent[ArchiveDiff]:
+    _log = BorgdroneEvent[ArchiveDiff]()
+    _log.event = "DiffManager.cancel_diff"
+
+    first = database.get_by_id(first_db_id, Archive)
+    second = database.get_by_id(second_db_id, Archive)
+    if not first or not second:
+        return _log.not_found_message("Archive")
+
+    old, new = ordered(first, second)
+    with __diffs_lock:
+        archive_diff = __diffs.get((old.id, new.id))
+
+    if archive_diff is None or archive_diff.status != "RUNNING" or archive_diff.job is None:
+        return _log.not_found_message("Comparison")
+
+    archive_diff.job.cancel()
+    _log.set_data(archive_diff)
+    return _log.return_success("Comparison cancelled.")
+
+
+def get_status(old: Archive, new: Archive) -> Dict[str, Any]:
+    """State of the comparison of two archives (older first): missing, running, ready or failed.
+
+    `cached` tells whether a new comparison would merge the listings instead of running borg.
+    """
+    with __diffs_lock:
+        archive_diff = __diffs.get((old.id, new.id))
+
+    if archive_diff is not None and archive_diff.status == "RUNNING":
+        return {"state": "running", **archive_diff.to_dict()}
+
+    path = diff_path(old, new)
+    if os.path.exists(path):
+        with diff.DiffReader(path) as reader:
+            meta = reader.meta()
+        totals = {key: int(meta.get(key, 0)) for key in ("added", "removed", "modified", "delta", "built")}
+        return {"state": "ready", "source": meta.get("source", ""), **totals}
+
+    if archive_diff is not None and archive_diff.status in ("FAILED", "CANCELLED"):
+        return {"state": "failed", **archive_diff.to_dict()}
+
+    return {"state": "missing", "cached": __cached(old, new)}
+
+
+def get_changes(
+    old: Archive,
+    new: Archive,
+    path: str = "",
+    change: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = PAGE_SIZE,
+) -> BorgdroneEvent[Tuple[List[Dict[str, Any]], Optional[str]]]:
+    """One page of the changes below `path`, optionally only one kind (added, removed, modified).
+
+    Returns:
+        The changes ordered by path, and the `after` of the next page or None.
+    """
+    _log = BorgdroneEvent[Tuple[List[Dict[str, Any]], Optional[str]]]()
+    _log.event = "DiffManager.get_changes"
+
+    path_on_disk = diff_path(old, new)
+    if not os.path.exists(path_on_disk):
+        return _log.return_failure("The archives have not been compared yet.")
+
+    with diff.DiffReader(path_on_disk) as reader:
+        _log.set_data(reader.changes(path, change, after, limit))
+
+    return _log.return_debug_success()
+
+
+def get_directories(old: Archive, new: Archive, path: str = "") -> List[Dict[str, Any]]:
+    """Per-directory rollups of the changed subdirectories of `path`, most changes first."""
+    path_on_disk = diff_path(old, new)
+    if not os.path.exists(path_on_disk):
+        return []
+
+    with diff.DiffReader(path_on_disk) as reader:
+        return reader.directories(path)
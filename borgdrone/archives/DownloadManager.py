@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from borgdrone.borg import BorgRunner as borg_runner
+from borgdrone.helpers import bash
+from borgdrone.logging import BorgdroneEvent, logger
+
+from .models import Archive
+
+# finished downloads kept for their counters
+KEEP_DOWNLOADS = 20
+
+
+class Download:
+    """One archive download streamed to a client.
+
+    - `kind`: tar (`borg export-tar`) or file (`borg extract --stdout`)
+    - `status`: STREAMING, DONE, CANCELLED, FAILED
+    """
+
+    def __init__(self, archive: Archive, kind: str, paths: List[str]):
+        self.id: str = uuid.uuid4().hex
+        self.archive_db_id = archive.id
+        self.archive_name = archive.name
+        self.kind = kind
+        self.paths = paths
+        self.status = "STREAMING"
+        self.error = ""
+
+        self.bytes = 0  # handed to the web server so far
+        self.started = time.time()
+        self.finished: Optional[float] = None
+
+    @property
+    def filename(self) -> str:
+        if self.kind == "file":
+            return os.path.basename(self.paths[0])
+        if len(self.paths) == 1:
+            return f"{self.archive_name}-{os.path.basename(self.paths[0])}.tar"
+        return f"{self.archive_name}.tar"
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "archive_db_id": self.archive_db_id,
+            "archive": self.archive_name,
+            "kind": self.kind,
+            "paths": self.paths,
+            "filename": self.filename,
+            "status": self.status,
+            "error": self.error,
+            "bytes": self.bytes,
+            "elapsed": round(self.elapsed, 1),
+            "bytes_per_second": int(self.bytes / self.elapsed) if self.elapsed > 0 else 0,
+        }
+
+
+__downloads: "OrderedDict[str, Download]" = OrderedDict()
+__downloads_lock = threading.Lock()
+
+
+def __register(download: Download) -> None:
+    with __downloads_lock:
+        __downloads[download.id] = download
+        while len(__downloads) > KEEP_DOWNLOADS:
+            oldest = next(iter(__downloads.values()))
+            if oldest.status == "STREAMING":
+                break
+            __downloads.popitem(last=False)
+
+
+class DownloadBody:
+    """The response body of a download.
+
+    WSGI servers call `close()` once the response is done, early when the
+    client went away, or without iterating at all (HEAD). Closing stops
+    borg, so an abandoned download never keeps the repository busy.
+    """
+
+    def __init__(self, download: Download, stream: bash.ChunkStream, chunks: Iterator[bytes], first: bytes):
+        self.download = download
+        self._stream = stream
+        self._chunks = chunks
+        self._first = first
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self._first:
+            self.download.bytes += len(self._first)
+            yield self._first
+        for chunk in self._chunks:
+            self.download.bytes += len(chunk)
+            yield chunk
+
+        # the response already started, on failure all the client sees is a truncated download
+        error = borg_runner.stream_error(self._stream)
+        self.__finish("FAILED" if error else "DONE", error or "")
+
+    def close(self) -> None:
+        self._stream.close()
+        if self.download.status == "STREAMING":
+            self.__finish("CANCELLED", "The client disconnected.")
+
+    def __finish(self, status: str, error: str) -> None:
+        download = self.download
+        download.status = status
+        download.error = error
+        download.finished = time.time()
+
+        rate = download.bytes / download.elapsed if download.elapsed > 0 else 0
+        logger.debug(f"Download {download.filename}: {status}, {download.bytes} bytes, {rate:.0f} B/s", "green")
+
+
+def open_download(archive: Archive, kind: str, paths: List[str]) -> BorgdroneEvent[Tuple[Download, DownloadBody]]:
+    """Start streaming `paths` of an archive, as a tar (`kind` tar) or the contents of one file (`kind` file).
+
+    borg writes straight into the response, nothing is staged on disk and
+    only a few chunks are held in memory. The stream waits for its turn on
+    the repository, and is read until the first chunk so a failing borg
+    (a path not in the archive) is reported before the response starts.
+
+    Returns:
+        The download, and the body to hand to the response.
+    """
+    _log = BorgdroneEvent[Tuple[Download, DownloadBody]]()
+    _log.event = "DownloadManager.open_download"
+
+    paths = [path.strip("/") for path in paths if path.strip("/")]
+    if kind == "file" and len(paths) != 1:
+        return _log.return_failure("Select one file to download.")
+    if kind not in ("tar", "file"):
+        return _log.return_failure("Unknown download type.")
+
+    repository = archive.backupbundle.repo
+    env = borg_runner.repository_env(repository.passphrase)
+    if kind == "tar":
+        stream = borg_runner.export_tar_stream(repository.path, archive.name, paths, env)
+    else:
+        stream = borg_runner.extract_stdout_stream(repository.path, archive.name, paths[0], env)
+
+    chunks = iter(stream)
+    first = next(chunks, b"")
+    if not first and (error := borg_runner.stream_error(stream)):
+        return _log.return_failure(error)
+
+    download = Download(archive, kind, paths)
+    __register(download)
+
+    _log.set_data((download, DownloadBody(download, stream, chunks, first)))
+    return _log.return_debug_success(f"Downloading {download.filename}.")
+
+
+def get_downloads() -> List[Download]:
+    """Recent downloads, newest first."""
+    with __downloads_lock:
+        return list(reversed(__downloads.values()))
@@ -0,0 +1,313 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from flask import current_app as app
+
+from borgdrone.borg import BorgRunner as borg_runner
+from borgdrone.extensions import borg_executor
+from borgdrone.helpers import database
+from borgdrone.logging import BorgdroneEvent, logger
+
+from . import SearchManager as search_manager
+from . import listing
+from .models import Archive
+
+PAGE_SIZE = 100
+# lines sent to a parser process at once
+CHUNK_LINES = 5000
+# finished builds kept for their status
+KEEP_BUILDS = 50
+MAX_PARSE_WORKERS = 4
+
+
+class ListingBuild:
+    """Background build of the listing of one archive.
+
+    - `status`: BUILDING, READY, FAILED, CANCELLED
+    """
+
+    def __init__(self, archive_db_id: int):
+        self.archive_db_id = archive_db_id
+        self.status = "BUILDING"
+        self.items = 0
+        self.error = ""
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.job = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "archive_db_id": self.archive_db_id,
+            "status": self.status,
+            "items": self.items,
+            "error": self.error,
+            "elapsed": round((self.finished or time.time()) - self.started, 1),
+        }
+
+
+__builds: Dict[int, ListingBuild] = {}
+__builds_lock = threading.Lock()
+__pool: Optional[Executor] = None
+__pool_lock = threading.Lock()
+
+
+def listing_path(archive: Archive) -> str:
+    """Where the listing of `archive` is stored, one SQLite file per archive."""
+    return os.path.join(app.config["LISTINGS_DIR"], archive.backupbundle.repo.repo_id, f"{archive.archive_id}.sqlite3")
+
+
+def remove_listings(repo_id: str, archive_ids: Iterable[str]) -> None:
+    """Delete the listings of archives that no longer exist. `repo_id` is the borg repository id."""
+    for archive_id in archive_ids:
+        path = os.path.join(app.config["LISTINGS_DIR"], repo_id, f"{archive_id}.sqlite3")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def __parser_workers() -> int:
+    """LISTING_PARSE_WORKERS, or one per spare CPU when it is empty. 0 parses inline."""
+    if (workers := app.config.get("LISTING_PARSE_WORKERS", "")) != "":
+        return max(0, int(workers))
+
+    # with a single CPU the processes only add overhead
+    return min(MAX_PARSE_WORKERS, (os.cpu_count() or 1) - 1)
+
+
+def __parser_pool() -> Optional[Executor]:
+    """Processes that parse the JSON lines while the builder writes, None to parse inline."""
+    global __pool  # pylint: disable=global-statement
+
+    if (workers := __parser_workers()) <= 0:
+        return None
+
+    with __pool_lock:
+        if __pool is None:
+            # spawned, forking a process with running threads is not safe
+            __pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+            atexit.register(__pool.shutdown, wait=False, cancel_futures=True)
+        return __pool
+
+
+def __reset_pool() -> None:
+    global __pool  # pylint: disable=global-statement
+
+    with __pool_lock:
+        __pool = None
+
+
+def __chunks(lines: Iterator[str]) -> Iterator[List[str]]:
+    chunk: List[str] = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= CHUNK_LINES:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def __parse(lines: Iterator[str]) -> Iterator[List[listing.ItemTuple]]:
+    """Parsed items, chunk by chunk and in order.
+
+    A few chunks are parsed ahead in the pool while the caller writes the
+    previous ones. Should the pool break, the rest is parsed inline.
+    """
+    pool = __parser_pool()
+    if pool is None:
+        for chunk in __chunks(lines):
+            yield listing.parse_lines(chunk)
+        return
+
+    ahead = 2 * __parser_workers()
+    pending: Deque[Tuple[List[str], Optional[Future]]] = deque()
+
+    def result(chunk: List[str], future: Optional[Future]) -> List[listing.ItemTuple]:
+        nonlocal pool
+        if future is not None:
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                logger.debug("Listing parser processes died, parsing inline.", "red")
+                __reset_pool()
+                pool = None
+        return listing.parse_lines(chunk)
+
+    for chunk in __chunks(lines):
+        pending.append((chunk, pool.submit(listing.parse_lines, chunk) if pool is not None else None))
+        if len(pending) >= ahead:
+            yield result(*pending.popleft())
+
+    while pending:
+        yield result(*pending.popleft())
+
+
+def __build(build: ListingBuild, archive_db_id: int) -> None:
+    archive = database.get_by_id(archive_db_id, Archive)
+    if not archive:
+        build.status = "FAILED"
+        build.error = "Archive not found."
+        return
+
+    repository = archive.backupbundle.repo
+    path = listing_path(archive)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # written next to the final file and renamed, a listing that exists is complete
+    writer = listing.ListingWriter(f"{path}.partial")
+    stream_log = BorgdroneEvent[None]()
+    try:
+        env = borg_runner.repository_env(repository.passphrase)
+        lines = borg_runner.iter_archive_item_lines(repository.path, archive.name, stream_log, env)
+        for items in __parse(lines):
+            writer.write(items)
+            build.items = writer.items
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        writer.abort()
+        build.status = "FAILED"
+        build.error = str(e)
+        return
+
+    if stream_log.status == "FAILURE" or (build.job is not None and build.job.cancelled):
+        writer.abort()
+        build.status = "CANCELLED" if build.job is not None and build.job.cancelled else "FAILED"
+        build.error = stream_log.error_message or "Listing cancelled."
+        return
+
+    writer.finish({"archive": archive.name, "archive_id": archive.archive_id})
+    os.replace(f"{path}.partial", path)
+
+    try:
+        search_manager.index_archive(archive, path)
+    except sqlite3.Error as e:
+        # the listing is fine, only searching will not find the archive
+        logger.debug(f"File index of {archive.name} failed: {e}", "red")
+
+    build.status = "READY"
+    logger.debug(f"Listing of {archive.name}: {writer.items} items in {time.time() - build.started:.1f}s", "green")
+
+
+def __finished(build: ListingBuild) -> None:
+    build.finished = time.time()
+    if build.status == "BUILDING":
+        # the job failed before it could record why
+        build.status = "FAILED"
+        if build.job is not None and build.job.cancelled:
+            build.status = "CANCELLED"
+
+
+def build_listing(archive_db_id: int) -> BorgdroneEvent[ListingBuild]:
+    """Build the listing of an archive in the background, unless a build is already running.
+
+    The build runs on the borg executor, queued behind other work on the repository.
+    """
+    _log = BorgdroneEvent[ListingBuild]()
+    _log.event = "ListingManager.build_listing"
+
+    archive = database.get_by_id(archive_db_id, Archive)
+    if not archive:
+        return _log.not_found_message("Archive")
+
+    with __builds_lock:
+        if (build := __builds.get(archive.id)) is not None and build.status == "BUILDING":
+            _log.set_data(build)
+            return _log.return_success("Listing is already being built.")
+
+        build = ListingBuild(archive.id)
+        __builds[archive.id] = build
+        for db_id in [db_id for db_id, old in __builds.items() if old.status != "BUILDING"][:-KEEP_BUILDS]:
+            del __builds[db_id]
+
+    build.job = borg_executor.submit(archive.backupbundle.repo.path, __build, build, archive.id)
+    build.job.add_done_callback(lambda _job: __finished(build))
+
+    _log.set_data(build)
+    return _log.return_success("Building the archive listing.")
+
+
+def build_listings(archive_db_ids: List[int]) -> None:
+    """Queue listing builds for new archives, which also adds them to the file index.
+
+    From inside a borg job, the builds are queued from another thread so
+    they run after the job instead of inline in it.
+    """
+    if not archive_db_ids:
+        return
+
+    if borg_executor.current_job() is None:
+        for archive_db_id in archive_db_ids:
+            build_listing(archive_db_id)
+        return
+
+    flask_app = app._get_current_object()  # pylint: disable=protected-access
+
+    def submit() -> None:
+        with flask_app.app_context():
+            for archive_db_id in archive_db_ids:
+                build_listing(archive_db_id)
+
+    threading.Thread(target=submit, name="listing-builds", daemon=True).start()
+
+
+def cancel_build(archive_db_id: int) -> BorgdroneEvent[ListingBuild]:
+    _log = BorgdroneEvent[ListingBuild]()
+    _log.event = "ListingManager.cancel_build"
+
+    with __builds_lock:
+        build = __builds.get(archive_db_id)
+
+    if build is None or build.status != "BUILDING" or build.job is None:
+        return _log.not_found_message("Listing build")
+
+    build.job.cancel()
+    _log.set_data(build)
+    return _log.return_success("Listing build cancelled.")
+
+
+def get_status(archive: Archive) -> Dict[str, Any]:
+    """State of an archive's listing: missing, building, ready or failed."""
+    with __builds_lock:
+        build = __builds.get(archive.id)
+
+    if build is not None and build.status == "BUILDING":
+        return {"state": "building", **build.to_dict()}
+
+    path = listing_path(archive)
+    if os.path.exists(path):
+        with listing.ListingReader(path) as reader:
+            meta = reader.meta()
+        return {"state": "ready", "items": int(meta.get("items", 0)), "built": int(meta.get("built", 0))}
+
+    if build is not None and build.status in ("FAILED", "CANCELLED"):
+        return {"state": "failed", **build.to_dict()}
+
+    return {"state": "missing"}
+
+
+def get_children(
+    archive: Archive, path: str = "", after: Optional[str] = None, limit: int = PAGE_SIZE
+) -> BorgdroneEvent[Tuple[List[Dict[str, Any]], Optional[str]]]:
+    """One page of a directory of the archive, read from its listing.
+
+    Returns:
+        The entries ordered by name, and the `after` of the next page or None.
+    """
+    _log = BorgdroneEvent[Tuple[List[Dict[str, Any]], Optional[str]]]()
+    _log.event = "ListingManager.get_children"
+
+    path_on_disk = listing_path(archive)
+    if not os.path.exists(path_on_disk):
+        return _log.return_failure("The archive listing has not been built yet.")
+
+    with listing.ListingReader(path_on_disk) as reader:
+        _log.set_data(reader.children(path, after, limit))
+
+    return _log.return_debug_success()
@@ -0,0 +1,187 @@
+import re
+import time
+from fnmatch import fnmatchcase
+from itertools import islice
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, select
+
+from borgdrone.borg import BorgRunner as borg_runner
+from borgdrone.bundles import BackupBundle, retention
+from borgdrone.extensions import db
+from borgdrone.helpers import database
+from borgdrone.logging import BorgdroneEvent, logger
+from borgdrone.types import OptStr
+
+from . import ArchivesManager as archives_manager
+from .models import Archive
+
+# archives shown per list in a preview, the counts always cover all of them
+PREVIEW_ROWS = 200
+
+
+class RetentionPlan:
+    """What a retention policy keeps of a bundle's archives, newest first.
+
+    `archives` start with (id, name, start_epoch), `reasons` tell why each
+    is kept, None for the archives to prune.
+    """
+
+    def __init__(
+        self,
+        bundle_id: int,
+        policy: retention.RetentionPolicy,
+        archives: List[retention.ArchiveRow],
+        reasons: List[Optional[str]],
+    ):
+        self.bundle_id = bundle_id
+        self.policy = policy
+        self.archives = archives
+        self.reasons = reasons
+        self.removed_count = reasons.count(None)
+        self.kept_count = len(reasons) - self.removed_count
+
+    def kept(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self.__select(True, limit)
+
+    def removed(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self.__select(False, limit)
+
+    def __select(self, kept: bool, limit: Optional[int]) -> List[Dict[str, Any]]:
+        # only the archives asked for become dicts, a preview shows a few hundred of tens of thousands
+        selected = (
+            {"id": db_id, "name": name, "start_epoch": start_epoch, "reason": reason}
+            for (db_id, name, start_epoch, *_periods), reason in zip(self.archives, self.reasons)
+            if (reason is not None) == kept
+        )
+        return list(islice(selected, limit))
+
+    def to_dict(self, limit: int = PREVIEW_ROWS) -> Dict[str, Any]:
+        return {
+            "bundle_id": self.bundle_id,
+            "policy": self.policy.to_dict(),
+            "empty": self.policy.is_empty(),
+            "archives": len(self.archives),
+            "kept": self.kept_count,
+            "removed": self.removed_count,
+            "keep": self.kept(limit),
+            "remove": self.removed(limit),
+        }
+
+
+def __period_rows(bundle_id: int) -> List[retention.ArchiveRow]:
+    """The bundle's archives newest first, with their hour, day, ISO week, month and year in local time."""
+    local = (Archive.start_epoch, "unixepoch", "localtime")
+    stmt = (
+        select(
+            Archive.id,
+            Archive.name,
+            Archive.start_epoch,
+            func.strftime("%Y-%m-%d %H", *local),
+            func.date(*local),
+            # an ISO week is named by its Thursday
+            func.date(*local, "-3 days", "weekday 4"),
+            func.strftime("%Y-%m", *local),
+            func.strftime("%Y", *local),
+        )
+        .where(Archive.backupbundle_id == bundle_id, Archive.start_epoch.is_not(None))
+        .order_by(Archive.start_epoch.desc(), Archive.id.desc())
+    )
+    # plain rows, the ORM adds nothing here and building its results takes longer than the query
+    return list(db.session.connection().execute(stmt).tuples().all())
+
+
+def plan_retention(bundle: BackupBundle, policy: Optional[retention.RetentionPolicy] = None) -> RetentionPlan:
+    """Which archives of `bundle` a policy keeps, by default the bundle's own.
+
+    Worked out from the archive times in the database, borg is not asked.
+    SQLite puts every archive in its periods in one query, which leaves a
+    single pass per rule, so even tens of thousands of archives take a
+    fraction of a second.
+    """
+    policy = policy or retention.RetentionPolicy.from_bundle(bundle)
+    rows = __period_rows(bundle.id)
+    return RetentionPlan(bundle.id, policy, rows, retention.plan(rows, policy, time.time()))
+
+
+def __name_format(bundle: BackupBundle) -> str:
+    """The archive name format in the bundle's command line, the one its archives were made with."""
+    for part in (bundle.command_line or "").split(" "):
+        if "::" in part:
+            return part.partition("::")[2]
+    return bundle.name_format or bundle.repo.name_format
+
+
+def bundle_glob(bundle: BackupBundle) -> OptStr:
+    """A --glob-archives pattern that matches exactly the bundle's archives, None when there is none.
+
+    The placeholders of the name format become wildcards. Bundles of a
+    repository often share the default format, then the pattern matches
+    archives of other bundles too and cannot be used.
+    """
+    glob = re.sub(r"\*+", "*", re.sub(r"\{[^}]*\}", "*", __name_format(bundle)))
+    if not glob.strip("*") or " " in glob:
+        return None
+
+    stmt = (
+        select(Archive.name, Archive.backupbundle_id).join(BackupBundle).where(BackupBundle.repo_id == bundle.repo_id)
+    )
+    for name, bundle_id in db.session.execute(stmt).tuples():
+        if fnmatchcase(name, glob) != (bundle_id == bundle.id):
+            return None
+
+    return glob
+
+
+def prune(bundle_id: int) -> BorgdroneEvent[RetentionPlan]:
+    """Apply the bundle's retention policy with a single borg call.
+
+    The archives are synchronized first, so the plan and the pattern check
+    see what is really in the repository. When a --glob-archives pattern
+    isolates the bundle, `borg prune` runs with the policy's options and
+    decides the same way the preview did. Otherwise the planned archives
+    are deleted in one `borg delete`. Afterwards the database is reconciled
+    with the repository and compaction is scheduled.
+
+    Returns:
+        BorgdroneEvent[RetentionPlan] -- The plan that was applied.
+    """
+    _log = BorgdroneEvent[RetentionPlan]()
+    _log.event = "RetentionManager.prune"
+
+    bundle = database.get_by_id(bundle_id, BackupBundle)
+    if not bundle:
+        return _log.not_found_message("Bundle")
+
+    policy = retention.RetentionPolicy.from_bundle(bundle)
+    if policy.is_empty():
+        return _log.return_failure("The bundle has no retention policy.")
+
+    repository = bundle.repo
+    sync_log = archives_manager.sync_archives(repository.id)
+    if sync_log.status == "FAILURE":
+        return _log.return_failure(sync_log.error_message)
+
+    plan = plan_retention(bundle, policy)
+    _log.set_data(plan)
+    if not (removed := plan.removed()):
+        return _log.return_success("Nothing to prune.")
+
+    env = borg_runner.repository_env(repository.passphrase)
+    if glob := bundle_glob(bundle):
+        result_log = borg_runner.prune_archives(repository.path, policy.keep_flags(), glob, env)
+    else:
+        result_log = borg_runner.delete_archives(repository.path, [archive["name"] for archive in removed], env)
+    if result_log.status == "FAILURE":
+        return _log.return_failure(result_log.error_message)
+
+    logger.debug(
+        f"Pruned {len(removed)} archives of bundle {bundle.id} with borg {'prune' if glob else 'delete'}.", "yellow"
+    )
+
+    archives_manager.schedule_compact(repository)
+    sync_log = archives_manager.sync_archives(repository.id)
+    if sync_log.status == "FAILURE":
+        return _log.return_failure(sync_log.error_message)
+
+    return _log.return_success(f"{len(removed)} archives pruned, {plan.kept_count} kept.")
@@ -0,0 +1,75 @@
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import current_app as app
+
+from borgdrone.logging import BorgdroneEvent, logger
+from borgdrone.types import OptStr
+
+from . import listing
+from .fileindex import FileIndex
+from .models import Archive
+
+RESULTS_PAGE_SIZE = 50
+
+
+def file_index() -> FileIndex:
+    """The cross-archive file index, opened for one operation (use it as a context manager)."""
+    return FileIndex(app.config["FILE_INDEX_PATH"])
+
+
+def auto_index() -> bool:
+    """Whether new archives are listed and indexed as soon as they are known."""
+    return app.config.get("FILE_INDEX_AUTO", "True") == "True"
+
+
+def index_archive(archive: Archive, listing_path: str) -> BorgdroneEvent[int]:
+    """Add the files of an archive's listing to the file index.
+
+    Called once the listing was built, so the archive's contents are read
+    from borg only once for browsing and searching.
+    """
+    _log = BorgdroneEvent[int]()
+    _log.event = "SearchManager.index_archive"
+
+    started = time.time()
+    with listing.ListingReader(listing_path) as reader, file_index() as index:
+        added = index.add_archive(
+            archive.id, archive.backupbundle.repo.repo_id, archive.name, archive.start_epoch, reader.files()
+        )
+
+    logger.debug(f"Indexed {added} files of {archive.name} in {time.time() - started:.1f}s", "green")
+    _log.set_data(added)
+    return _log.return_debug_success(f"{added} files indexed.")
+
+
+def remove_archives(archive_ids: List[int]) -> None:
+    """Drop deleted archives (Archive.id) from the file index."""
+    if not archive_ids:
+        return
+
+    with file_index() as index:
+        index.remove_archives(archive_ids)
+
+
+def indexed_archives() -> Dict[int, str]:
+    with file_index() as index:
+        return index.archives()
+
+
+def search(
+    query: str, repository: OptStr = None, after: int = 0, limit: int = RESULTS_PAGE_SIZE
+) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """Paths of all indexed archives that contain `query`, see `FileIndex.search`.
+
+    Arguments:
+        repository -- Borg repository id to limit the search to.
+    """
+    with file_index() as index:
+        return index.search(query, repository, after, limit)
+
+
+def versions(path: str, repository: OptStr = None, mtime_before: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Every indexed archive that contains `path`, newest first, see `FileIndex.versions`."""
+    with file_index() as index:
+        return index.versions(path, repository, mtime_before)
@@ -0,0 +1,274 @@
+import heapq
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# (path, change, type, old_size, new_size, delta, old_mtime, new_mtime)
+ChangeTuple = Tuple[str, str, str, Optional[int], Optional[int], int, Optional[int], Optional[int]]
+
+CHANGES = ("added", "removed", "modified")
+
+SCHEMA = """
+CREATE TABLE change (
+    path TEXT PRIMARY KEY,
+    change TEXT NOT NULL,  -- added, removed, modified
+    type TEXT,
+    old_size INTEGER,
+    new_size INTEGER,
+    delta INTEGER NOT NULL,  -- size difference in bytes
+    old_mtime INTEGER,
+    new_mtime INTEGER
+) WITHOUT ROWID;
+CREATE TABLE rollup (
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    added INTEGER NOT NULL,
+    removed INTEGER NOT NULL,
+    modified INTEGER NOT NULL,
+    delta INTEGER NOT NULL,
+    PRIMARY KEY (parent, name)
+) WITHOUT ROWID;
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+CHANGE_COLUMNS = ("path", "change", "type", "old_size", "new_size", "delta", "old_mtime", "new_mtime")
+ROLLUP_COLUMNS = ("name", "added", "removed", "modified", "delta")
+
+
+# the items of listing `a` that are missing from listing `b` or differ in it, ordered by
+# directory and name. Each directory of `a` is looked up in `b` once, then its items by
+# the primary key of both listings, so only the changed rows ever leave SQLite.
+SIDE_QUERY = """
+SELECT d1.path || char(0) || i1.name, {change}, i1.type, i1.size, i1.mtime, i2.type, i2.size, i2.mtime
+FROM {a}.directory d1
+LEFT JOIN {b}.directory d2 ON d2.path = d1.path
+CROSS JOIN {a}.item i1 ON i1.parent = d1.id
+LEFT JOIN {b}.item i2 ON i2.parent = d2.id AND i2.name = i1.name
+WHERE i2.name IS NULL {changed}
+ORDER BY d1.path, i1.name
+"""
+
+# directories count only when added or removed, their mtime changes with every file in them
+CHANGED = (
+    "OR (i1.type IS NOT i2.type OR i1.size IS NOT i2.size OR i1.mtime IS NOT i2.mtime)"
+    " AND NOT (i1.type = 'd' AND i2.type = 'd')"
+)
+
+
+def __path(key: str) -> str:
+    directory, _, name = key.partition("\0")
+    return f"{directory}/{name}" if directory else name
+
+
+def diff_listings(old_path: str, new_path: str) -> Iterator[ChangeTuple]:
+    """The changes from the `old` listing to the `new` one, ordered by directory and name.
+
+    Both listings are walked in the same order, one for what was removed or
+    modified and one for what was added, and the two are merged as they come.
+    Unchanged items, by far the most, are skipped inside SQLite.
+    """
+    db = sqlite3.connect(f"file:{old_path}?mode=ro", uri=True)
+    try:
+        db.execute("ATTACH ? AS new", (f"file:{new_path}?mode=ro",))
+        old_side = db.execute(
+            SIDE_QUERY.format(
+                a="main",
+                b="new",
+                change="CASE WHEN i2.name IS NULL THEN 'removed' ELSE 'modified' END",
+                changed=CHANGED,
+            )
+        )
+        # a second cursor, both sides are read at the same time
+        new_side = db.cursor().execute(SIDE_QUERY.format(a="new", b="main", change="'added'", changed=""))
+
+        # no key is on both sides
+        for key, change, item_type, size, mtime, new_type, new_size, new_mtime in heapq.merge(
+            old_side, new_side, key=lambda row: row[0]
+        ):
+            if change == "removed":
+                yield (__path(key), change, item_type, size, None, -(size or 0), mtime, None)
+            elif change == "added":
+                yield (__path(key), change, item_type, None, size, size or 0, None, mtime)
+            else:
+                delta = (new_size or 0) - (size or 0)
+                yield (__path(key), change, new_type, size, new_size, delta, mtime, new_mtime)
+    finally:
+        db.close()
+
+
+def __diff_type(kind: str) -> str:
+    if kind.endswith("directory"):
+        return "d"
+    if kind.endswith("link"):
+        return "l"
+    return "-"
+
+
+def parse_diff_lines(lines: Iterable[str]) -> Iterator[ChangeTuple]:
+    """Turn `borg diff --json-lines` lines into changes.
+
+    borg reports modified files by the bytes of the chunks added and
+    removed, not by their sizes, so the sizes of modified files are unknown.
+    """
+    for line in lines:
+        if not line:
+            continue
+
+        item = json.loads(line)
+        path = item["path"].strip("/")
+        changes = item.get("changes", [])
+        kinds = [change.get("type", "") for change in changes]
+
+        added = next((change for change in changes if change.get("type", "").startswith("added")), None)
+        removed = next((change for change in changes if change.get("type", "").startswith("removed")), None)
+        if added is not None:
+            size = added.get("size")
+            yield (path, "added", __diff_type(added["type"]), None, size, size or 0, None, None)
+        elif removed is not None:
+            size = removed.get("size")
+            yield (path, "removed", __diff_type(removed["type"]), size, None, -(size or 0), None, None)
+        else:
+            delta = sum(
+                change.get("added", 0) - change.get("removed", 0)
+                for change in changes
+                if change.get("type") == "modified"
+            )
+            item_type = "l" if "changed link" in kinds else "-"
+            yield (path, "modified", item_type, None, None, delta, None, None)
+
+
+class DiffWriter:
+    """Writes the changes between two archives into a new SQLite file.
+
+    Besides the changes themselves, every directory gets the counts and the
+    size delta of everything below it (its rollup), stored under its parent
+    so the subdirectories of a directory are one range of the primary key.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.changes = 0
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        self._db = sqlite3.connect(path)
+        # a half-written file is thrown away, it does not need to survive a crash
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.executescript(SCHEMA)
+
+        # directory -> [added, removed, modified, delta] of its own entries
+        self._rollups: Dict[str, List[int]] = {}
+
+    def write(self, changes: Iterable[ChangeTuple]) -> None:
+        columns = {change: index for index, change in enumerate(CHANGES)}
+        rows = []
+        for row in changes:
+            rows.append(row)
+            parent = row[0].rpartition("/")[0]
+            if (rollup := self._rollups.get(parent)) is None:
+                rollup = self._rollups[parent] = [0, 0, 0, 0]
+            rollup[columns[row[1]]] += 1
+            rollup[3] += row[5]
+
+        self._db.executemany("INSERT OR REPLACE INTO change VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.changes += len(rows)
+
+    def __rollups(self) -> Dict[str, List[int]]:
+        """Adds the rollups of subdirectories to their parents, deepest first."""
+        rollups = self._rollups
+        by_depth: Dict[int, set] = {}
+        for directory in rollups:
+            by_depth.setdefault(directory.count("/") + 1 if directory else 0, set()).add(directory)
+
+        for depth in range(max(by_depth, default=0), 0, -1):
+            for directory in by_depth.get(depth, ()):
+                parent = directory.rpartition("/")[0]
+                if (totals := rollups.get(parent)) is None:
+                    totals = rollups[parent] = [0, 0, 0, 0]
+                    by_depth.setdefault(depth - 1, set()).add(parent)
+                for index, value in enumerate(rollups[directory]):
+                    totals[index] += value
+
+        return rollups
+
+    def finish(self, meta: Dict[str, Any]) -> None:
+        rollups = self.__rollups()
+        added, removed, modified, delta = rollups.pop("", [0, 0, 0, 0])
+        self._db.executemany(
+            "INSERT INTO rollup VALUES (?, ?, ?, ?, ?, ?)",
+            [(*directory.rpartition("/")[::2], *totals) for directory, totals in rollups.items()],
+        )
+
+        meta = {
+            **meta,
+            "added": added,
+            "removed": removed,
+            "modified": modified,
+            "delta": delta,
+            "built": int(time.time()),
+        }
+        self._db.executemany("INSERT INTO meta VALUES (?, ?)", [(key, str(value)) for key, value in meta.items()])
+        self._db.commit()
+        self._db.close()
+
+    def abort(self) -> None:
+        self._db.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DiffReader:
+    """Read access to a diff written by `DiffWriter`."""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+    def __enter__(self) -> "DiffReader":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._db.close()
+
+    def meta(self) -> Dict[str, str]:
+        return dict(self._db.execute("SELECT key, value FROM meta").fetchall())
+
+    def directories(self, path: str = "") -> List[Dict[str, Any]]:
+        """Rollups of the changed subdirectories of `path`, most changes first."""
+        path = path.strip("/")
+        columns = ", ".join(ROLLUP_COLUMNS)
+        rows = self._db.execute(
+            f"SELECT {columns} FROM rollup WHERE parent = ? ORDER BY added + removed + modified DESC, name", (path,)
+        ).fetchall()
+
+        directories = [dict(zip(ROLLUP_COLUMNS, row)) for row in rows]
+        for directory in directories:
+            directory["path"] = f"{path}/{directory['name']}" if path else directory["name"]
+        return directories
+
+    def changes(
+        self, path: str = "", change: Optional[str] = None, after: Optional[str] = None, limit: int = 100
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """One page of the changes below directory `path`, ordered by path.
+
+        Returns:
+            The changes, and the path to pass as `after` for the next page, None on the last page.
+        """
+        stmt = f"SELECT {', '.join(CHANGE_COLUMNS)} FROM change WHERE path > ?"
+        params: List[Any] = [after or ""]
+
+        if path := path.strip("/"):
+            # everything below path/, '0' sorts right after '/'
+            stmt += " AND path > ? AND path < ?"
+            params += [f"{path}/", f"{path}0"]
+        if change in CHANGES:
+            stmt += " AND change = ?"
+            params.append(change)
+
+        rows = self._db.execute(f"{stmt} ORDER BY path LIMIT ?", [*params, limit + 1]).fetchall()
+        changes = [dict(zip(CHANGE_COLUMNS, row)) for row in rows[:limit]]
+
+        return changes, changes[-1]["path"] if len(rows) > limit else None
@@ -0,0 +1,209 @@
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# (path, type, size, mtime)
+FileTuple = Tuple[str, str, Optional[int], Optional[int]]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive (
+    id INTEGER PRIMARY KEY,  -- Archive.id
+    repository TEXT NOT NULL,  -- borg repository id
+    name TEXT NOT NULL,
+    start INTEGER
+);
+CREATE TABLE IF NOT EXISTS path (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS version (
+    path_id INTEGER NOT NULL,
+    archive_id INTEGER NOT NULL,
+    type TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    PRIMARY KEY (path_id, archive_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_version_archive_id ON version (archive_id);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS path_fts USING fts5(path, content='path', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS path_fts_insert AFTER INSERT ON path BEGIN
+    INSERT INTO path_fts (rowid, path) VALUES (new.id, new.path);
+END;
+CREATE TRIGGER IF NOT EXISTS path_fts_delete AFTER DELETE ON path BEGIN
+    INSERT INTO path_fts (path_fts, rowid, path) VALUES ('delete', old.id, old.path);
+END;
+"""
+
+# trigrams need at least three characters, shorter searches scan the paths
+MIN_FTS_QUERY = 3
+BATCH_SIZE = 10000
+
+
+class FileIndex:
+    """The paths of every indexed archive, for searches and version history across archives.
+
+    Every distinct path is stored once and gets one version row per
+    archive that contains it, so the index grows with the number of
+    distinct paths and their versions rather than with the size of the
+    listings. Searches go through an FTS5 trigram index of the paths,
+    or a LIKE scan on SQLite builds without FTS5.
+
+    Paths are stored the way borg lists them, without a leading slash.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, timeout=30)
+        # readers are not blocked while an archive is being added
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.executescript(SCHEMA)
+
+        try:
+            self._db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+
+    def __enter__(self) -> "FileIndex":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._db.close()
+
+    def archives(self) -> Dict[int, str]:
+        """Archive.id to name, of the archives in the index."""
+        return dict(self._db.execute("SELECT id, name FROM archive").fetchall())
+
+    def add_archive(
+        self, archive_id: int, repository: str, name: str, start: Optional[int], files: Iterable[FileTuple]
+    ) -> int:
+        """Add the files of an archive, replacing what was indexed for it before.
+
+        Returns:
+            int -- Number of files added.
+        """
+        added = 0
+        with self._db:
+            self._db.execute("DELETE FROM version WHERE archive_id = ?", (archive_id,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO archive (id, repository, name, start) VALUES (?, ?, ?, ?)",
+                (archive_id, repository, name, start),
+            )
+            self._db.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS incoming (path TEXT, type TEXT, size INTEGER, mtime INTEGER)"
+            )
+
+            batch: List[FileTuple] = []
+            for file in files:
+                batch.append(file)
+                if len(batch) >= BATCH_SIZE:
+                    added += self.__add_batch(archive_id, batch)
+                    batch = []
+            if batch:
+                added += self.__add_batch(archive_id, batch)
+
+        return added
+
+    def __add_batch(self, archive_id: int, batch: List[FileTuple]) -> int:
+        # resolving path ids in SQL is much faster than one lookup per file
+        self._db.executemany("INSERT INTO incoming VALUES (?, ?, ?, ?)", batch)
+        self._db.execute("INSERT OR IGNORE INTO path (path) SELECT path FROM incoming")
+        self._db.execute(
+            "INSERT OR REPLACE INTO version (path_id, archive_id, type, size, mtime)"
+            " SELECT path.id, ?, incoming.type, incoming.size, incoming.mtime"
+            " FROM incoming JOIN path ON path.path = incoming.path",
+            (archive_id,),
+        )
+        self._db.execute("DELETE FROM incoming")
+        return len(batch)
+
+    def remove_archives(self, archive_ids: List[int]) -> None:
+        """Forget archives, and the paths no remaining archive contains."""
+        if not archive_ids:
+            return
+
+        placeholders = ", ".join("?" * len(archive_ids))
+        with self._db:
+            self._db.execute(f"DELETE FROM version WHERE archive_id IN ({placeholders})", archive_ids)
+            self._db.execute(f"DELETE FROM archive WHERE id IN ({placeholders})", archive_ids)
+            self._db.execute(
+                "DELETE FROM path WHERE NOT EXISTS (SELECT 1 FROM version WHERE version.path_id = path.id)"
+            )
+
+    def search(
+        self, query: str, repository: Optional[str] = None, after: int = 0, limit: int = 50
+    ) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """Paths containing `query`, with how many archives have them and the newest of those.
+
+        Returns:
+            The matches, and the `after` of the next page or None on the last page.
+        """
+        query = query.strip().lstrip("/")
+        if not query:
+            return [], None
+
+        if self.fts and len(query) >= MIN_FTS_QUERY:
+            stmt = (
+                "SELECT path.id, path.path FROM path_fts JOIN path ON path.id = path_fts.rowid"
+                " WHERE path_fts MATCH ? AND path.id > ?"
+            )
+            params: List[Any] = ['"' + query.replace('"', '""') + '"', after]
+        else:
+            escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            stmt = "SELECT path.id, path.path FROM path WHERE path.path LIKE ? ESCAPE '\\' AND path.id > ?"
+            params = [f"%{escaped}%", after]
+
+        if repository:
+            stmt += (
+                " AND EXISTS (SELECT 1 FROM version JOIN archive ON archive.id = version.archive_id"
+                " WHERE version.path_id = path.id AND archive.repository = ?)"
+            )
+            params.append(repository)
+
+        rows = self._db.execute(f"{stmt} ORDER BY path.id LIMIT ?", [*params, limit + 1]).fetchall()
+        matches = [{"id": path_id, "path": path} for path_id, path in rows[:limit]]
+        if not matches:
+            return [], None
+
+        placeholders = ", ".join("?" * len(matches))
+        summary = self._db.execute(
+            "SELECT version.path_id, count(*), max(archive.start) FROM version"
+            " JOIN archive ON archive.id = version.archive_id"
+            f" WHERE version.path_id IN ({placeholders}) GROUP BY version.path_id",
+            [match["id"] for match in matches],
+        ).fetchall()
+        by_path = {path_id: (versions, latest) for path_id, versions, latest in summary}
+        for match in matches:
+            match["versions"], match["latest"] = by_path.get(match["id"], (0, None))
+
+        return matches, matches[-1]["id"] if len(rows) > limit else None
+
+    def versions(
+        self, path: str, repository: Optional[str] = None, mtime_before: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Every archive that contains `path`, newest first.
+
+        `changed` is False when the file has the same size and mtime as in
+        the next older archive, so only real changes stand out.
+
+        Arguments:
+            mtime_before -- Only versions last modified before this time (epoch seconds).
+        """
+        stmt = (
+            "SELECT archive.id, archive.name, archive.repository, archive.start, version.type, version.size,"
+            " version.mtime FROM path JOIN version ON version.path_id = path.id"
+            " JOIN archive ON archive.id = version.archive_id WHERE path.path = ?"
+        )
+        params: List[Any] = [path.strip().lstrip("/")]
+        if repository:
+            stmt += " AND archive.repository = ?"
+            params.append(repository)
+        if mtime_before is not None:
+            stmt += " AND version.mtime < ?"
+            params.append(mtime_before)
+
+        columns = ("archive_id", "archive", "repository", "start", "type", "size", "mtime")
+        rows = [dict(zip(columns, row)) for row in self._db.execute(f"{stmt} ORDER BY archive.start DESC", params)]
+
+        for newer, older in zip(rows, rows[1:] + [None]):
+            newer["changed"] = older is None or (newer["size"], newer["mtime"]) != (older["size"], older["mtime"])
+
+        return rows
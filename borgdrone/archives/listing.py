@@ -0,0 +1,180 @@
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# (path, type, mode, user, group, size, mtime, linktarget)
+ItemTuple = Tuple[str, str, str, str, str, int, Optional[int], Optional[str]]
+
+SCHEMA = """
+CREATE TABLE directory (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+CREATE TABLE item (
+    parent INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    mode TEXT,
+    user TEXT,
+    "group" TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    linktarget TEXT,
+    PRIMARY KEY (parent, name)
+) WITHOUT ROWID;
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+ITEM_COLUMNS = ("name", "type", "mode", "user", "group", "size", "mtime", "linktarget")
+
+
+def __epoch(timestamp: Optional[str]) -> Optional[int]:
+    if not timestamp:
+        return None
+    try:
+        return int(datetime.fromisoformat(timestamp).timestamp())
+    except ValueError:
+        return None
+
+
+def parse_lines(lines: List[str]) -> List[ItemTuple]:
+    """Turn `borg list --json-lines` lines into item tuples.
+
+    Runs in the parser processes, so it only uses the standard library.
+    """
+    items = []
+    for line in lines:
+        if not line:
+            continue
+
+        item = json.loads(line)
+        items.append(
+            (
+                item["path"].strip("/"),
+                item.get("type", "-"),
+                item.get("mode", ""),
+                item.get("user", ""),
+                item.get("group", ""),
+                int(item.get("size") or 0),
+                __epoch(item.get("mtime")),
+                item.get("linktarget") or None,
+            )
+        )
+
+    return items
+
+
+class ListingWriter:
+    """Writes the listing of one archive into a new SQLite file.
+
+    Items are stored under the id of their parent directory, keyed by name,
+    so the children of a directory are one range of the primary key.
+    Directories borg did not list (the parents of the backed up paths) are
+    added as they are found.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.items = 0
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        self._db = sqlite3.connect(path)
+        # a half-written file is thrown away, it does not need to survive a crash
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.executescript(SCHEMA)
+
+        self._directories: Dict[str, int] = {"": 0}
+        self._db.execute("INSERT INTO directory (id, path) VALUES (0, '')")
+
+    def __directory(self, path: str, rows: List[tuple]) -> int:
+        if (directory_id := self._directories.get(path)) is not None:
+            return directory_id
+
+        parent, _, name = path.rpartition("/")
+        parent_id = self.__directory(parent, rows)
+
+        directory_id = len(self._directories)
+        self._directories[path] = directory_id
+        self._db.execute("INSERT INTO directory (id, path) VALUES (?, ?)", (directory_id, path))
+        # replaced by borg's own entry, should it come later
+        rows.append((parent_id, name, "d", None, None, None, 0, None, None))
+        return directory_id
+
+    def write(self, items: Iterable[ItemTuple]) -> None:
+        rows: List[tuple] = []
+        for path, item_type, mode, user, group, size, mtime, linktarget in items:
+            if not path:
+                continue
+
+            parent, _, name = path.rpartition("/")
+            parent_id = self.__directory(parent, rows)
+            if item_type == "d":
+                self.__directory(path, rows)
+
+            rows.append((parent_id, name, item_type, mode, user, group, size, mtime, linktarget))
+            self.items += 1
+
+        self._db.executemany("INSERT OR REPLACE INTO item VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def finish(self, meta: Dict[str, Any]) -> None:
+        meta = {**meta, "items": self.items, "directories": len(self._directories), "built": int(time.time())}
+        self._db.executemany("INSERT INTO meta VALUES (?, ?)", [(key, str(value)) for key, value in meta.items()])
+        self._db.commit()
+        self._db.close()
+
+    def abort(self) -> None:
+        self._db.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ListingReader:
+    """Read access to a listing written by `ListingWriter`."""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+    def __enter__(self) -> "ListingReader":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._db.close()
+
+    def meta(self) -> Dict[str, str]:
+        return dict(self._db.execute("SELECT key, value FROM meta").fetchall())
+
+    def files(self) -> Iterator[Tuple[str, str, Optional[int], Optional[int]]]:
+        """(path, type, size, mtime) of every item, directories included."""
+        yield from self._db.execute(
+            "SELECT CASE WHEN directory.path = '' THEN item.name ELSE directory.path || '/' || item.name END,"
+            " item.type, item.size, item.mtime FROM item JOIN directory ON directory.id = item.parent"
+        )
+
+    def children(
+        self, path: str = "", after: Optional[str] = None, limit: int = 100
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """One page of the entries of directory `path`, ordered by name.
+
+        Returns:
+            The entries, and the name to pass as `after` for the next page, None on the last page.
+        """
+        row = self._db.execute("SELECT id FROM directory WHERE path = ?", (path.strip("/"),)).fetchone()
+        if row is None:
+            return [], None
+
+        columns = ", ".join(f'"{column}"' for column in ITEM_COLUMNS)
+        rows = self._db.execute(
+            f"SELECT {columns} FROM item WHERE parent = ? AND name > ? ORDER BY name LIMIT ?",
+            (row[0], after or "", limit + 1),
+        ).fetchall()
+
+        entries = [dict(zip(ITEM_COLUMNS, values)) for values in rows[:limit]]
+        prefix = f"{path.strip('/')}/" if path.strip("/") else ""
+        for entry in entries:
+            entry["path"] = prefix + entry["name"]
+
+        next_after = entries[-1]["name"] if len(rows) > limit else None
+        return entries, next_after
@@ -1,6 +1,6 @@
 from typing import List, Optional
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from borgdrone.extensions import db
@@ -12,27 +12,37 @@ ListArchive = List["Archive"]
 
 class Archive(db.Model):
     __tablename__ = "archive"
+    __table_args__ = (
+        # borg archive ids are unique within a repository
+        Index("uq_archive_repository_id_archive_id", "repository_id", "archive_id", unique=True),
+        # a bundle's archives in start order, for the archive list and run history
+        Index("ix_archive_backupbundle_id_start_epoch", "backupbundle_id", "start_epoch"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
 
-    archive_id: Mapped[str]
+    archive_id: Mapped[str] = mapped_column(index=True)
     backupbundle_id: Mapped[int] = mapped_column(ForeignKey("backupbundle.id"))
     backupbundle = relationship("BackupBundle", back_populates="archives")
 
-    name: Mapped[str]
+    name: Mapped[str] = mapped_column(index=True)
+    # ISO 8601 as borg reports them, for display only
     end: Mapped[str]
     hostname: Mapped[str]
     start: Mapped[str]
+    # seconds since the epoch of start and end, for ordering, range queries and aggregation in SQL
+    start_epoch: Mapped[Optional[int]] = mapped_column(index=True)
+    end_epoch: Mapped[Optional[int]]
     tam: Mapped[Optional[str]]
     time: Mapped[Optional[str]]
     username: Mapped[str]
 
     command_line = Mapped[Optional[str]]
-    duration: Mapped[Optional[str]]
+    duration: Mapped[Optional[float]]  # seconds
     repository_id: Mapped[Optional[str]]
-    stats_compressed_size: Mapped[Optional[str]]
-    stats_deduplicated_size: Mapped[Optional[str]]
+    stats_compressed_size: Mapped[Optional[int]]
+    stats_deduplicated_size: Mapped[Optional[int]]
     stats_nfiles: Mapped[Optional[int]]
-    stats_original_size: Mapped[Optional[str]]
+    stats_original_size: Mapped[Optional[int]]
 
     def commit(self):
         db.session.add(self)
@@ -1,21 +1,75 @@
-from flask import Blueprint, request
+from datetime import date
+from typing import Any, Dict
+from urllib.parse import quote
+
+from flask import Blueprint, Response, jsonify, request, url_for
 from flask_login import login_required
 
-from borgdrone.helpers import ResponseHelper
+from borgdrone.bundles import BackupBundle
+from borgdrone.bundles import BundleManager as bundle_manager
+from borgdrone.bundles import retention
+from borgdrone.helpers import ResponseHelper, database, datahelpers
 from borgdrone.repositories import RepositoryManager as repository_manager
 
 from . import ArchivesManager as archive_manager
+from . import DiffManager as diff_manager
+from . import DownloadManager as download_manager
+from . import ListingManager as listing_manager
+from . import RetentionManager as retention_manager
+from . import SearchManager as search_manager
+from .models import Archive
 
 archives_blueprint = Blueprint("archives", __name__, template_folder="templates")
 
 
+def __date(value: Any) -> Any:
+    try:
+        return date.fromisoformat(value).isoformat() if value else None
+    except ValueError:
+        return None
+
+
+def __page_filters() -> Dict[str, Any]:
+    """Sort and filters of the archive list, from the form or the query string."""
+    values = request.values
+    bundle_id = values.get("bundle_id", "")
+
+    return {
+        "bundle_id": int(bundle_id) if bundle_id.isdigit() else None,
+        "hostname": values.get("hostname") or None,
+        "date_from": __date(values.get("date_from")),
+        "date_to": __date(values.get("date_to")),
+        "newest_first": values.get("sort", "newest") != "oldest",
+    }
+
+
+def __page_context(repo_db_id: int) -> Dict[str, Any]:
+    """The archive rows after the request's cursor, and the url of the page after them."""
+    filters = __page_filters()
+    rows, cursor = archive_manager.get_page(repo_db_id, request.values.get("cursor"), **filters)
+
+    next_url = None
+    if cursor:
+        query = {key: value for key, value in filters.items() if value is not None and key != "newest_first"}
+        query["sort"] = "newest" if filters["newest_first"] else "oldest"
+        next_url = url_for("archives.page", repo_db_id=repo_db_id, cursor=cursor, **query)
+
+    context = {"archives": rows, "next_url": next_url, "convert_bytes": datahelpers.convert_bytes}
+    if not request.values.get("cursor"):
+        # the first page shows what the filters matched in total
+        totals_filters = {key: value for key, value in filters.items() if key != "newest_first"}
+        context["totals"] = archive_manager.get_totals(repo_db_id, **totals_filters)
+
+    return context
+
+
 @archives_blueprint.route("/")
 @login_required
 def index():
     rh = ResponseHelper(get_template="archives/index.html")
 
     repositories = repository_manager.get_all()
-    rh.context_data = {"repositories": repositories}
+    rh.context_data = {"repositories": repositories, "bundles": bundle_manager.get_all() or []}
 
     return rh.respond()
 
@@ -30,27 +84,523 @@ def get_archives():
         rh.toast_error = "No repository selected."
         return rh.respond(empty=True)
 
-    archives = archive_manager.get_all(int(repo_db_id))
-    rh.context_data = {"archives": archives}
+    rh.context_data = __page_context(int(repo_db_id))
+    return rh.respond()
+
+
+@archives_blueprint.route("/page")
+@login_required
+def page():
+    """The next rows of the archive list, requested when the end of the list scrolls into view."""
+    rh = ResponseHelper(get_template="archives/archive_rows.html")
+
+    repo_db_id = request.args.get("repo_db_id", "")
+    if not repo_db_id.isdigit():
+        return rh.respond(empty=True)
+
+    rh.context_data = __page_context(int(repo_db_id))
     return rh.respond()
 
 
+@archives_blueprint.route("/stats")
+@login_required
+def stats():
+    """Totals and per-bundle daily growth of a repository's archives, as JSON."""
+    repo_db_id = request.args.get("repo_db_id", "")
+    if not repo_db_id.isdigit():
+        return jsonify({"error": "No repository selected."}), 400
+
+    filters = __page_filters()
+    date_from, date_to = filters["date_from"], filters["date_to"]
+    totals_filters = {key: value for key, value in filters.items() if key != "newest_first"}
+
+    return jsonify(
+        {
+            "totals": archive_manager.get_totals(int(repo_db_id), **totals_filters),
+            "growth": [dict(row) for row in archive_manager.get_bundle_growth(int(repo_db_id), date_from, date_to)],
+        }
+    )
+
+
 @archives_blueprint.route("/refresh", methods=["POST"])
 @login_required
 def refresh_archives():
     rh = ResponseHelper(post_success_template="archives/archives.html")
 
-    repo_db_id = request.form["repo_db_id"]
+    repo_db_id = request.form.get("repo_db_id")
     if not repo_db_id:
         rh.toast_error = "No repository selected."
         return rh.respond(empty=True)
 
-    result_log = archive_manager.refresh_archives(int(repo_db_id), first=10)
+    result_log = archive_manager.sync_archives(int(repo_db_id))
     rh.borgdrone_return = result_log.borgdrone_return()
 
     if result_log.status == "FAILURE":
         rh.toast_error = result_log.error_message
+        # the archives of other repositories may be gone, the page is shown again then
+        if None not in (result_log.get_data() or {}).values():
+            return rh.respond(empty=True)
+    else:
+        rh.toast_success = result_log.message
+    rh.context_data = __page_context(int(repo_db_id))
+    return rh.respond()
+
+
+@archives_blueprint.route("/delete", methods=["POST"])
+@login_required
+def delete_archives():
+    rh = ResponseHelper(post_success_template="archives/archives.html")
+
+    archive_ids = [int(archive_id) for archive_id in request.form.getlist("archive_ids")]
+    if not archive_ids:
+        rh.toast_error = "No archives selected."
+        return rh.respond(empty=True)
+
+    result_log = archive_manager.delete_archives(archive_ids)
+    rh.borgdrone_return = result_log.borgdrone_return()
+
+    if result_log.status == "FAILURE":
+        rh.toast_error = result_log.error_message
+        # the archives of other repositories may be gone, the page is shown again then
+        if None not in (result_log.get_data() or {}).values():
+            return rh.respond(empty=True)
+    else:
+        rh.toast_success = result_log.message
+
+    repo_db_id = request.form.get("repo_db_id")
+    if not repo_db_id:
         return rh.respond(empty=True)
 
-    rh.context_data = {"archives": result_log.get_data()}
-    return rh.respond(empty=True)
+    rh.context_data = __page_context(int(repo_db_id))
+    return rh.respond()
+
+
+def __listing_context(archive: Archive) -> Dict[str, Any]:
+    """The listing's state, and the top level of the archive once the listing is built."""
+    context: Dict[str, Any] = {
+        "archive": archive,
+        "status": listing_manager.get_status(archive),
+        "convert_bytes": datahelpers.convert_bytes,
+        "epoch_to_human": datahelpers.epoch_to_human,
+    }
+
+    if context["status"]["state"] == "ready":
+        result_log = listing_manager.get_children(archive)
+        if data := result_log.get_data():
+            context["path"] = ""
+            context["entries"], context["next_after"] = data
+
+    return context
+
+
+@archives_blueprint.route("/<int:archive_db_id>/browse")
+@login_required
+def browse(archive_db_id: int):
+    rh = ResponseHelper(get_template="archives/browse.html")
+
+    if not (archive := database.get_by_id(archive_db_id, Archive)):
+        rh.toast_error = "Archive not found."
+        return rh.respond(empty=True)
+
+    rh.context_data = __listing_context(archive)
+    return rh.respond()
+
+
+@archives_blueprint.route("/<int:archive_db_id>/listing", methods=["GET", "POST"])
+@login_required
+def listing(archive_db_id: int):
+    """GET polls the state of the listing, POST starts building it."""
+    rh = ResponseHelper(
+        get_template="archives/listing_status.html", post_success_template="archives/listing_status.html"
+    )
+
+    if not (archive := database.get_by_id(archive_db_id, Archive)):
+        rh.toast_error = "Archive not found."
+        return rh.respond(empty=True)
+
+    if request.method == "POST":
+        result_log = listing_manager.build_listing(archive.id)
+        rh.borgdrone_return = result_log.borgdrone_return()
+        if result_log.status == "FAILURE":
+            rh.toast_error = result_log.error_message
+            return rh.respond(empty=True)
+        rh.toast_info = result_log.message
+
+    rh.context_data = __listing_context(archive)
+    return rh.respond()
+
+
+@archives_blueprint.route("/<int:archive_db_id>/listing/cancel", methods=["POST"])
+@login_required
+def cancel_listing(archive_db_id: int):
+    rh = ResponseHelper(post_success_template="archives/listing_status.html")
+
+    if not (archive := database.get_by_id(archive_db_id, Archive)):
+        rh.toast_error = "Archive not found."
+        return rh.respond(empty=True)
+
+    result_log = listing_manager.cancel_build(archive.id)
+    if result_log.status == "FAILURE":
+        rh.toast_error = result_log.error_message
+    else:
+        rh.toast_success = result_log.message
+
+    rh.context_data = __listing_context(archive)
+    return rh.respond()
+
+
+@archives_blueprint.route("/<int:archive_db_id>/children")
+@login_required
+def children(archive_db_id: int):
+    """One page of a directory of the archive, loaded when the directory is expanded."""
+    rh = ResponseHelper(get_template="archives/listing_children.html")
+
+    if not (archive := database.get_by_id(archive_db_id, Archive)):
+        return rh.respond(empty=True)
+
+    path = request.args.get("path", "")
+    result_log = listing_manager.get_children(archive, path, request.args.get("after") or None)
+    if not (data := result_log.get_data()):
+        rh.toast_error = result_log.error_message
+        return rh.respond(empty=True)
+
+    entries, next_after = data
+    rh.context_data = {
+        "archive": archive,
+        "path": path,
+        "entries": entries,
+        "next_after": next_after,
+        "convert_bytes": datahelpers.convert_bytes,
+        "epoch_to_human": datahelpers.epoch_to_human,
+    }
+    return rh.respond()
+
+
+@archives_blueprint.route("/<int:archive_db_id>/download")
+@login_required
+def download(archive_db_id: int):
+    """Stream `path`s of the archive as a tar, or with `kind=file` the contents of one file.
+
+    Nothing is staged on the web host, borg's output goes straight into the
+    chunked response and stops when the client disconnects.
+    """
+    rh = ResponseHelper()
+
+    if not (archive := database.get_by_id(archive_db_id, Archive)):
+        rh.toast_error = "Archive not found."
+        return rh.respond(redirect_url="archives.index")
+
+    result_log = download_manager.open_download(archive, request.args.get("kind", "tar"), request.args.getlist("path"))
+    rh.borgdrone_return = result_log.borgdrone_return()
+    if not (data := result_log.get_data()):
+        rh.toast_error = result_log.error_message
+        rh.context_data = {"archive_db_id": archive.id}
+        return rh.respond(redirect_url="archives.browse")
+
+    started_download, body = data
+    mimetype = "application/x-tar" if started_download.kind == "tar" else "application/octet-stream"
+    response = Response(body, mimetype=mimetype, direct_passthrough=True)
+    response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(started_download.filename)}"
+    # proxies would otherwise buffer the whole download before passing it on
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers["BORGDRONE_RETURN"] = rh.borgdrone_return
+    return response
+
+
+@archives_blueprint.route("/downloads")
+@login_required
+def downloads():
+    """Recent downloads with their throughput, as JSON."""
+    return jsonify([item.to_dict() for item in download_manager.get_downloads()])
+
+
+@archives_blueprint.route("/downloads/panel")
+@login_required
+def downloads_panel():
+    rh = ResponseHelper(get_template="archives/downloads.html")
+    rh.context_data = {
+        "downloads": [item.to_dict() for item in download_manager.get_downloads()],
+        "convert_bytes": datahelpers.convert_bytes,
+    }
+    return rh.respond()
+
+
+def __diff_archives(archive_db_id: int) -> Any:
+    """The archive and the one it is compared with (`other`), older first, or None."""
+    other_db_id = request.values.get("other", "")
+    archive = database.get_by_id(archive_db_id, Archive)
+    other = database.get_by_id(int(other_db_id), Archive) if other_db_id.isdigit() else None
+    if not archive or not other or archive.id == other.id:
+        return None
+
+    return diff_manager.ordered(archive, other)
+
+
+def __diff_context(old: Archive, new: Archive, path: str = "", change: Any = None) -> Dict[str, Any]:
+    """The comparison's state, and the rollups and first changes below `path` once it is done."""
+    context: Dict[str, Any] = {
+        "old": old,
+        "new": new,
+        "status": diff_manager.get_status(old, new),
+        "path": path,
+        "change": change,
+        "convert_bytes": datahelpers.convert_bytes,
+        "convert_bytes_delta": datahelpers.convert_bytes_delta,
+        "epoch_to_human": datahelpers.epoch_to_human,
+    }
+
+    if context["status"]["state"] == "ready":
+        context["directories"] = diff_manager.get_directories(old, new, path)
+        if data := diff_manager.get_changes(old, new, path, change).get_data():
+            context["changes"], next_after = data
+            context["next_url"] = __next_changes_url(old, new, path, change, next_after)
+
+    return context
+
+
+def __next_changes_url(old: Archive, new: Archive, path: str, change: Any, after: Any) -> Any:
+    if not after:
+        return None
+    return url_for(
+        "archives.diff_changes", archive_db_id=new.id, other=old.id, path=path, change=change or "", after=after
+    )
+
+
+@archives_blueprint.route("/<int:archive_db_id>/diff")
+@login_required
+def diff(archive_db_id: int):
+    """Compare an archive with `other`, by default the archive of the same bundle made before it."""
+    rh = ResponseHelper(get_template="archives/diff.html")
+
+    if not (archive := database.get_by_id(archive_db_id, Archive)):
+        rh.toast_error = "Archive not found."
+        return rh.respond(empty=True)
+
+    other_db_id = request.args.get("other", "")
+    other = database.get_by_id(int(other_db_id), Archive) if other_db_id.isdigit() else diff_manager.previous(archive)
+
+    rh.context_data = {"archive": archive, "other": other, "comparable": diff_manager.comparable(archive)}
+    if other and other.id != archive.id:
+        rh.context_data.update(__diff_context(*diff_manager.ordered(archive, other)))
+    return rh.respond()
+
+
+@archives_blueprint.route("/<int:archive_db_id>/diff/status", methods=["GET", "POST"])
+@login_required
+def diff_status(archive_db_id: int):
+    """GET polls the state of the comparison with `other`, POST starts it."""
+    rh = ResponseHelper(get_template="archives/diff_status.html", post_success_template="archives/diff_status.html")
+
+    if not (archives := __diff_archives(archive_db_id)):
+        rh.toast_error = "Select two archives to compare."
+        return rh.respond(empty=True)
+
+    if request.method == "POST":
+        result_log = diff_manager.start_diff(*[archive.id for archive in archives])
+        rh.borgdrone_return = result_log.borgdrone_return()
+        if result_log.status == "FAILURE":
+            rh.toast_error = result_log.error_message
+            return rh.respond(empty=True)
+        rh.toast_info = result_log.message
+
+    rh.context_data = __diff_context(*archives)
+    return rh.respond()
+
+
+@archives_blueprint.route("/<int:archive_db_id>/diff/cancel", methods=["POST"])
+@login_required
+def cancel_diff(archive_db_id: int):
+    rh = ResponseHelper(post_success_template="archives/diff_status.html")
+
+    if not (archives := __diff_archives(archive_db_id)):
+        rh.toast_error = "Select two archives to compare."
+        return rh.respond(empty=True)
+
+    result_log = diff_manager.cancel_diff(*[archive.id for archive in archives])
+    if result_log.status == "FAILURE":
+        rh.toast_error = result_log.error_message
+    else:
+        rh.toast_success = result_log.message
+
+    rh.context_data = __diff_context(*archives)
+    return rh.respond()
+
+
+@archives_blueprint.route("/<int:archive_db_id>/diff/changes")
+@login_required
+def diff_changes(archive_db_id: int):
+    """The rollups and changes below a directory, or with `after` the next page of changes."""
+    after = request.args.get("after") or None
+    rh = ResponseHelper(get_template="archives/diff_changes.html" if after else "archives/diff_result.html")
+
+    if not (archives := __diff_archives(archive_db_id)):
+        return rh.respond(empty=True)
+
+    old, new = archives
+    path = request.args.get("path", "").strip("/")
+    change = request.args.get("change") or None
+    if not after:
+        rh.context_data = __diff_context(old, new, path, change)
+        return rh.respond()
+
+    result_log = diff_manager.get_changes(old, new, path, change, after)
+    if not (data := result_log.get_data()):
+        rh.toast_error = result_log.error_message
+        return rh.respond(empty=True)
+
+    changes, next_after = data
+    rh.context_data = {
+        "changes": changes,
+        "next_url": __next_changes_url(old, new, path, change, next_after),
+        "convert_bytes": datahelpers.convert_bytes,
+        "convert_bytes_delta": datahelpers.convert_bytes_delta,
+        "epoch_to_human": datahelpers.epoch_to_human,
+    }
+    return rh.respond()
+
+
+def __search_repository() -> Any:
+    """Borg repository id of the repository the search is limited to, None for all."""
+    repo_db_id = request.args.get("repo_db_id", "")
+    if not repo_db_id.isdigit():
+        return None
+
+    repository = repository_manager.get_one(db_id=int(repo_db_id))
+    return repository.repo_id if repository else None
+
+
+@archives_blueprint.route("/search")
+@login_required
+def search():
+    rh = ResponseHelper(get_template="archives/search.html")
+    rh.context_data = {
+        "repositories": repository_manager.get_all(),
+        "indexed": len(search_manager.indexed_archives()),
+    }
+    return rh.respond()
+
+
+@archives_blueprint.route("/search/results")
+@login_required
+def search_results():
+    """Paths matching the query across all indexed archives, one page at a time."""
+    rh = ResponseHelper(get_template="archives/search_results.html")
+
+    query = request.args.get("q", "")
+    after = request.args.get("after", "")
+    matches, next_after = search_manager.search(query, __search_repository(), int(after) if after.isdigit() else 0)
+
+    next_url = None
+    if next_after:
+        next_url = url_for(
+            "archives.search_results",
+            q=query,
+            repo_db_id=request.args.get("repo_db_id", ""),
+            before=request.args.get("before", ""),
+            after=next_after,
+        )
+
+    rh.context_data = {
+        "matches": matches,
+        "next_url": next_url,
+        "query": query,
+        "before": request.args.get("before", ""),
+        "repo_db_id": request.args.get("repo_db_id", ""),
+        "epoch_to_human": datahelpers.epoch_to_human,
+    }
+    return rh.respond()
+
+
+@archives_blueprint.route("/search/versions")
+@login_required
+def file_versions():
+    """Every indexed archive that has a path, optionally only versions modified before a day."""
+    rh = ResponseHelper(get_template="archives/file_versions.html")
+
+    path = request.args.get("path", "")
+    before = __date(request.args.get("before"))
+    versions = search_manager.versions(path, __search_repository(), datahelpers.ISO8601_to_epoch(before))
+
+    rh.context_data = {
+        "path": path,
+        "versions": versions,
+        "convert_bytes": datahelpers.convert_bytes,
+        "epoch_to_human": datahelpers.epoch_to_human,
+    }
+    return rh.respond()
+
+
+def __retention_context(bundle: BackupBundle, policy: Any = None) -> Dict[str, Any]:
+    """What the policy, by default the bundle's own, keeps of the bundle's archives."""
+    plan = retention_manager.plan_retention(bundle, policy)
+    return {
+        "bundle": bundle,
+        "rules": retention.RULES,
+        "plan": plan.to_dict(),
+        "glob": retention_manager.bundle_glob(bundle),
+        "epoch_to_human": datahelpers.epoch_to_human,
+    }
+
+
+@archives_blueprint.route("/retention/<int:bundle_id>", methods=["GET", "POST"])
+@login_required
+def retention_policy(bundle_id: int):
+    """A bundle's retention policy and the archives it keeps, POST saves the policy."""
+    rh = ResponseHelper(get_template="archives/retention.html", post_success_template="archives/retention.html")
+
+    if not (bundle := database.get_by_id(bundle_id, BackupBundle)):
+        rh.toast_error = "Bundle not found."
+        return rh.respond(empty=True)
+
+    if request.method == "POST":
+        result_log = bundle_manager.update_retention(bundle.id, **request.form)
+        rh.borgdrone_return = result_log.borgdrone_return()
+        if result_log.status == "FAILURE":
+            rh.toast_error = result_log.error_message
+            return rh.respond(empty=True)
+        rh.toast_success = result_log.message
+
+    rh.context_data = __retention_context(bundle)
+    return rh.respond()
+
+
+@archives_blueprint.route("/retention/<int:bundle_id>/preview")
+@login_required
+def retention_preview(bundle_id: int):
+    """What the policy in the query would keep, nothing is saved or deleted."""
+    rh = ResponseHelper(get_template="archives/retention_preview.html")
+
+    if not (bundle := database.get_by_id(bundle_id, BackupBundle)):
+        rh.toast_error = "Bundle not found."
+        return rh.respond(empty=True)
+
+    try:
+        policy = retention.RetentionPolicy.from_values(request.args)
+    except ValueError as e:
+        rh.context_data = {"bundle": bundle, "error": str(e)}
+        return rh.respond()
+
+    rh.context_data = __retention_context(bundle, policy)
+    return rh.respond()
+
+
+@archives_blueprint.route("/retention/<int:bundle_id>/prune", methods=["POST"])
+@login_required
+def retention_prune(bundle_id: int):
+    """Prune the bundle's archives with its saved policy."""
+    rh = ResponseHelper(post_success_template="archives/retention.html")
+
+    result_log = retention_manager.prune(bundle_id)
+    rh.borgdrone_return = result_log.borgdrone_return()
+    if result_log.status == "FAILURE":
+        rh.toast_error = result_log.error_message
+        # the archives of other repositories may be gone, the page is shown again then
+        if None not in (result_log.get_data() or {}).values():
+            return rh.respond(empty=True)
+    else:
+        rh.toast_success = result_log.message
+    if not (bundle := database.get_by_id(bundle_id, BackupBundle)):
+        return rh.respond(empty=True)
+
+    rh.context_data = __retention_context(bundle)
+    return rh.respond()
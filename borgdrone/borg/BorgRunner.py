@@ -1,19 +1,37 @@
+import asyncio
+import hashlib
 import json
-import os
+import re
+import statistics
+import threading
+import time
 import uuid
-from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from borgdrone.helpers import bash
+from flask_socketio import emit
+
+from borgdrone.extensions import borg_backend, borg_cache, borg_executor
+from borgdrone.helpers import bash, datahelpers
+from borgdrone.helpers.limits import ResourceLimits
 from borgdrone.logging import BorgdroneEvent, logger
 from borgdrone.types import OptStr
 
 from .constants import (
     BORG_CHECK_COMMAND,
     BORG_DELETE_COMMAND,
+    BORG_DIFF_COMMAND,
+    BORG_EXPORT_TAR_COMMAND,
+    BORG_EXTRACT_STDOUT_COMMAND,
     BORG_INFO_COMMAND,
     BORG_INIT_COMMAND,
     BORG_LIST_COMMAND,
+    BORG_LIST_ITEMS_COMMAND,
+    BORG_LIST_LINES_COMMAND,
+    BORG_LIST_LINES_FIELDS,
+    BORG_PRUNE_COMMAND,
 )
+from .progress import DEFAULT_UPDATES_PER_SECOND, ProgressTracker
 
 
 def __process_error(result_log: BorgdroneEvent, error: str) -> BorgdroneEvent:
@@ -29,7 +47,8 @@ def __process_error(result_log: BorgdroneEvent, error: str) -> BorgdroneEvent:
             result_log.error_message = "Invalid command or arguments."
 
     else:
-        e: dict = json.loads(error)
+        # with --log-json every line is a message, the error is the last one
+        e: dict = json.loads(error.strip().split("\n")[-1])
         result_log.error_message = e.get("message", "Unknown error.")
 
         result_log.error_code = e.get("msgid", "Unknown.Error.")
@@ -40,7 +59,70 @@ def __process_error(result_log: BorgdroneEvent, error: str) -> BorgdroneEvent:
     return result_log
 
 
-def create_repository(path: str, encryption: str) -> BorgdroneEvent[None]:
+def __run(repo_path: str, command: str | list, env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Run a borg command on the executor, queued behind other work on the same repository.
+
+    `env` only reaches the borg process, never our own environment, so
+    commands for different repositories can run in parallel safely.
+    Read-only commands run on a borg worker when that backend is enabled.
+    """
+    return borg_executor.run(repo_path, bash.run, command, on_spawn=borg_executor.attach_process, env=env, worker=True)
+
+
+async def __run_async(repo_path: str, command: str | list, env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """`__run` for coroutines, queued on the executor the same way and awaited without blocking the event loop."""
+    return await borg_executor.run_async(
+        repo_path, bash.run, command, on_spawn=borg_executor.attach_process, env=env, worker=True
+    )
+
+
+def repository_env(passphrase: Optional[str]) -> Optional[Dict[str, str]]:
+    """The environment for borg commands on a repository with `passphrase`."""
+    if not passphrase:
+        return None
+
+    return {"BORG_PASSPHRASE": passphrase}
+
+
+def __cache_key(command: List[str], env: Optional[Dict[str, str]]) -> Tuple[Tuple[str, ...], OptStr]:
+    """The cache key of a query, including a digest of `env`.
+
+    A result read with one passphrase is never served to a caller with
+    another one, and the passphrase itself is not kept in memory.
+    """
+    digest = hashlib.sha256(json.dumps(env, sort_keys=True).encode()).hexdigest() if env else None
+    return tuple(command), digest
+
+
+def __run_cached(repo_path: str, command: List[str], env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """`__run` for read-only queries, answered from the cache while the repository is unchanged."""
+    key = __cache_key(command, env)
+    token, result = borg_cache.get(repo_path, key)
+    if result is not None:
+        logger.debug(f"cache hit: {' '.join(command)}", "yellow")
+        return result
+
+    result = __run(repo_path, command, env)
+    if "stdout" in result:
+        borg_cache.set(repo_path, key, result, token)
+
+    return result
+
+
+async def __run_cached_async(repo_path: str, command: List[str], env: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    key = __cache_key(command, env)
+    token, result = borg_cache.get(repo_path, key)
+    if result is not None:
+        return result
+
+    result = await __run_async(repo_path, command, env)
+    if "stdout" in result:
+        borg_cache.set(repo_path, key, result, token)
+
+    return result
+
+
+def create_repository(path: str, encryption: str, env: Optional[Dict[str, str]] = None) -> BorgdroneEvent[None]:
     result_log = BorgdroneEvent[None]()
     result_log.event = "BorgRunner.create_repository"
 
@@ -50,7 +132,8 @@ def create_repository(path: str, encryption: str) -> BorgdroneEvent[None]:
 
     result_log.message = command
 
-    result = bash.run(command)
+    result = __run(path, command, env)
+    borg_cache.invalidate(path)
     if "stderr" in result:
         # - Repository.ParentPathDoesNotExist
         # - Repository.AlreadyExists
@@ -62,10 +145,7 @@ def create_repository(path: str, encryption: str) -> BorgdroneEvent[None]:
     return result_log
 
 
-def borg_info(path: str, archive_name: OptStr = None, first: int = 0, last: int = 0) -> BorgdroneEvent[dict]:
-    _log = BorgdroneEvent[dict]()
-    _log.event = "BorgRunner.borg_info"
-
+def __borg_info_command(path: str, archive_name: OptStr = None, first: int = 0, last: int = 0) -> List[str]:
     command = BORG_INFO_COMMAND.copy()
     command[1] = path
 
@@ -79,9 +159,10 @@ def borg_info(path: str, archive_name: OptStr = None, first: int = 0, last: int
     else:
         command[1] = path
 
-    _log.message = " ".join(command)
+    return command
+
 
-    result = bash.run(command)
+def __borg_info_result(_log: BorgdroneEvent[dict], result: Dict[str, Any]) -> BorgdroneEvent[dict]:
     if "stderr" in result:
         __process_error(_log, result["stderr"])
 
@@ -93,13 +174,118 @@ def borg_info(path: str, archive_name: OptStr = None, first: int = 0, last: int
     return _log
 
 
-def borg_compact(path: str) -> Dict[str, Any]:
+def borg_info(
+    path: str, archive_name: OptStr = None, first: int = 0, last: int = 0, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[dict]:
+    _log = BorgdroneEvent[dict]()
+    _log.event = "BorgRunner.borg_info"
+
+    command = __borg_info_command(path, archive_name, first, last)
+    _log.message = " ".join(command)
+
+    result = __run_cached(path, command, env)
+    return __borg_info_result(_log, result)
+
+
+async def borg_info_async(
+    path: str, archive_name: OptStr = None, first: int = 0, last: int = 0, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[dict]:
+    _log = BorgdroneEvent[dict]()
+    _log.event = "BorgRunner.borg_info"
+
+    command = __borg_info_command(path, archive_name, first, last)
+    _log.message = " ".join(command)
+
+    result = await __run_cached_async(path, command, env)
+    return __borg_info_result(_log, result)
+
+
+def borg_compact(path: str, threshold: Optional[int] = None, env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
     command = f"borg compact {path}"
-    result = bash.run(command)
+    if threshold is not None:
+        command = f"borg compact --threshold {threshold} {path}"
+
+    result = __run(path, command, env)
+    borg_cache.invalidate(path)
     return result
 
 
-def borg_delete(path: str, archive_name: OptStr = None):
+# repository path -> timer of its deferred compaction
+__compactions: Dict[str, threading.Timer] = {}
+__compactions_lock = threading.Lock()
+
+
+def __parse_window(window: str) -> Optional[Tuple[int, int]]:
+    """`HH:MM-HH:MM` as minutes since midnight, None if no window is set."""
+    if not window:
+        return None
+
+    start, end = (part.strip().split(":") for part in window.split("-"))
+    return int(start[0]) * 60 + int(start[1]), int(end[0]) * 60 + int(end[1])
+
+
+def __compact_delay(delay: float, window: str) -> float:
+    """Seconds until the compaction may run, pushed into the maintenance window if one is set."""
+    due = datetime.now() + timedelta(seconds=max(delay, 0))
+    if not (minutes := __parse_window(window)):
+        return max(delay, 0)
+
+    start, end = minutes
+    now_minutes = due.hour * 60 + due.minute
+    in_window = start <= now_minutes < end if start <= end else now_minutes >= start or now_minutes < end
+    if not in_window:
+        window_start = due.replace(hour=start // 60, minute=start % 60, second=0, microsecond=0)
+        if window_start < due:
+            window_start += timedelta(days=1)
+        due = window_start
+
+    return (due - datetime.now()).total_seconds()
+
+
+def schedule_compact(
+    path: str,
+    delay: float = 60,
+    threshold: Optional[int] = None,
+    window: str = "",
+    env: Optional[Dict[str, str]] = None,
+) -> None:
+    """Compact a repository once, `delay` seconds after the last request for it.
+
+    Deleting archives only marks their segments as free, compaction does the
+    expensive rewriting. Requests for the same repository are coalesced, so a
+    series of deletes is followed by a single `borg compact`. The job is
+    queued on the executor behind other work on the repository.
+
+    Pending compactions live in memory and do not survive a restart.
+
+    Arguments:
+        threshold -- Only rewrite segments with at least this many percent of free space.
+        window -- Daily maintenance window (`HH:MM-HH:MM`) to hold compaction for.
+    """
+
+    def submit() -> None:
+        with __compactions_lock:
+            __compactions.pop(path, None)
+        borg_executor.submit(path, borg_compact, path, threshold, env)
+
+    with __compactions_lock:
+        if timer := __compactions.pop(path, None):
+            timer.cancel()
+
+        timer = threading.Timer(__compact_delay(delay, window), submit)
+        timer.daemon = True
+        timer.name = f"compact-{path}"
+        __compactions[path] = timer
+        timer.start()
+
+
+def pending_compactions() -> List[str]:
+    """Repositories waiting for their deferred compaction."""
+    with __compactions_lock:
+        return list(__compactions)
+
+
+def borg_delete(path: str, archive_name: OptStr = None, env: Optional[Dict[str, str]] = None):
     _log = BorgdroneEvent[None]()
     _log.event = "BorgRunner.borg_delete"
     _log.status = "SUCCESS"
@@ -110,45 +296,149 @@ def borg_delete(path: str, archive_name: OptStr = None):
     else:
         command[1] = path
 
-    result = bash.run(command)
+    result = __run(path, command, env)
+    borg_cache.invalidate(path)
     if "stderr" in result:
         # Possible:
         # - ?
         __process_error(_log, result["stderr"])
 
-    if archive_name:
-        result = borg_compact(path)
-        if "stderr" in result:
-            # Possible:
-            # - ?
+    return _log
+
+
+def delete_archives(path: str, archive_names: List[str], env: Optional[Dict[str, str]] = None) -> BorgdroneEvent[None]:
+    """Delete many archives with a single `borg delete`.
+
+    The freed space is not reclaimed, see `schedule_compact`.
+    Archives that no longer exist are reported by borg as a warning and
+    do not fail the call.
+    """
+    _log = BorgdroneEvent[None]()
+    _log.event = "BorgRunner.delete_archives"
+
+    command = BORG_DELETE_COMMAND.copy()
+    command[1] = path
+    command.extend(archive_names)
+
+    result = __run(path, command, env)
+    borg_cache.invalidate(path)
+
+    # returncode 1 is a warning, e.g. one of the archives was already gone
+    if "stderr" in result and result["returncode"] != 1:
+        # Possible:
+        # - Repository.DoesNotExist
+        __process_error(_log, result["stderr"])
+        return _log.return_debug_failure()
+
+    return _log.return_debug_success(f"{len(archive_names)} archives deleted.")
+
+
+def prune_archives(
+    path: str, keep_flags: List[str], glob: str, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[None]:
+    """Prune the archives matching `glob` with a single `borg prune`.
+
+    `keep_flags` are the --keep-* options, e.g. ["--keep-daily", "7"].
+    Like deleting, the freed space is not reclaimed, see `schedule_compact`.
+    """
+    _log = BorgdroneEvent[None]()
+    _log.event = "BorgRunner.prune_archives"
+
+    command = BORG_PRUNE_COMMAND.copy()
+    command[1] = path
+    command.extend([*keep_flags, "--glob-archives", glob])
+
+    result = __run(path, command, env)
+    borg_cache.invalidate(path)
+
+    # returncode 1 is a warning
+    if "stderr" in result and result["returncode"] != 1:
+        # Possible:
+        # - Repository.DoesNotExist
+        __process_error(_log, result["stderr"])
+        return _log.return_debug_failure()
+
+    return _log.return_debug_success("Archives pruned.")
+
+
+def create_archive(
+    repo_path: str,
+    command_line: str,
+    emit_socket: bool = False,
+    expected_size: int = 0,
+    expected_nfiles: int = 0,
+    updates_per_second: float = DEFAULT_UPDATES_PER_SECOND,
+    env: Optional[Dict[str, str]] = None,
+    limits: Optional[ResourceLimits] = None,
+) -> BorgdroneEvent[None]:
+    """Run a bundle's `borg create` command line.
+
+    Blocks until the backup finished. The output is streamed to the log,
+    and to the client when `emit_socket` is set. Progress is sent as
+    `backup_progress` events, at most `updates_per_second` times a second.
+
+    Arguments:
+        expected_size -- Original size of the previous archive, for the ETA.
+        expected_nfiles -- File count of the previous archive, for the ETA.
+        limits -- Priority and cgroup limits for borg, the effective ones are sent as `backup_limits`.
+    """
+    _log = BorgdroneEvent[None]()
+    _log.event = "BorgRunner.create_archive"
+
+    if "--log-json" not in command_line.split(" "):
+        # bundles created before progress was parsed
+        command_line = command_line.replace("borg ", "borg --log-json ", 1)
+
+    def on_progress(progress: Dict[str, Any]) -> None:
+        if emit_socket:
+            emit("backup_progress", progress)
+
+    tracker = ProgressTracker(on_progress, expected_size, expected_nfiles, updates_per_second)
+
+    if limits:
+        effective = limits.prepare()
+        logger.debug(f"resource limits: {effective}", "yellow")
+        if emit_socket:
+            emit("backup_limits", effective)
+
+    job = bash.popen(command_line, emit_socket, key=repo_path, line_filter=tracker.filter_line, env=env, limits=limits)
+    result = job.result()
+    borg_cache.invalidate(repo_path)
+    if result is None:
+        return _log.return_debug_failure("Backup was cancelled.")
+
+    logger.debug(f"{tracker.updates_sent} progress updates sent, {tracker.updates_skipped} throttled.")
+
+    if "stderr" in result:
+        try:
             __process_error(_log, result["stderr"])
+        except ValueError:
+            _log.status = "FAILURE"
+            _log.error_message = result["stderr"] or f"borg create exited with {result['returncode']}."
+        return _log.return_debug_failure()
 
-    return _log
+    return _log.return_debug_success()
 
 
-def delete_repository(path: str) -> BorgdroneEvent[None]:
+def delete_repository(path: str, env: Optional[Dict[str, str]] = None) -> BorgdroneEvent[None]:
     event = "BorgRunner.delete_repository"
 
-    result_log = borg_delete(path)
+    result_log = borg_delete(path, env=env)
     result_log.event = event
 
     return result_log
 
 
-def delete_archive(path: str, archive_name: str) -> BorgdroneEvent[None]:
+def delete_archive(path: str, archive_name: str, env: Optional[Dict[str, str]] = None) -> BorgdroneEvent[None]:
     event = "BorgRunner.delete_archive"
 
-    result_log = borg_delete(path, archive_name)
+    result_log = borg_delete(path, archive_name, env)
     result_log.event = event
 
     return result_log
 
 
-def list_archives(repo_path: str, first: int = 0, last: int = 0) -> BorgdroneEvent[List[Dict[str, Any]]]:
-    _log = BorgdroneEvent[List[Dict[str, Any]]]()
-    _log.event = "BorgRunner.get_archives"
-    _log.status = "SUCCESS"
-
+def __list_archives_command(repo_path: str, first: int = 0, last: int = 0) -> List[str]:
     command = BORG_LIST_COMMAND.copy()
     command[1] = repo_path
 
@@ -157,7 +447,12 @@ def list_archives(repo_path: str, first: int = 0, last: int = 0) -> BorgdroneEve
     elif last > 0:
         command.insert(3, f"--last {str(last)}")
 
-    result = bash.run(command)
+    return command
+
+
+def __list_archives_result(
+    _log: BorgdroneEvent[List[Dict[str, Any]]], result: Dict[str, Any]
+) -> BorgdroneEvent[List[Dict[str, Any]]]:
     if "stderr" in result:
         # Possible:
         # - Repository.DoesNotExist
@@ -171,6 +466,174 @@ def list_archives(repo_path: str, first: int = 0, last: int = 0) -> BorgdroneEve
     return _log
 
 
+def list_archives(
+    repo_path: str, first: int = 0, last: int = 0, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[List[Dict[str, Any]]]:
+    _log = BorgdroneEvent[List[Dict[str, Any]]]()
+    _log.event = "BorgRunner.get_archives"
+    _log.status = "SUCCESS"
+
+    command = __list_archives_command(repo_path, first, last)
+    result = __run_cached(repo_path, command, env)
+    return __list_archives_result(_log, result)
+
+
+async def list_archives_async(
+    repo_path: str, first: int = 0, last: int = 0, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[List[Dict[str, Any]]]:
+    _log = BorgdroneEvent[List[Dict[str, Any]]]()
+    _log.event = "BorgRunner.get_archives"
+    _log.status = "SUCCESS"
+
+    command = __list_archives_command(repo_path, first, last)
+    result = await __run_cached_async(repo_path, command, env)
+    return __list_archives_result(_log, result)
+
+
+def __stream_result(_log: BorgdroneEvent, stream: bash.LineStream) -> BorgdroneEvent:
+    if stream.result is None:
+        # the caller stopped early
+        return _log.return_debug_success("Stream closed by the caller.")
+
+    if "stderr" in stream.result:
+        __process_error(_log, stream.result["stderr"])
+        return _log.return_debug_failure()
+
+    return _log.return_debug_success()
+
+
+def iter_archives(
+    repo_path: str,
+    repo_id: OptStr = None,
+    result_log: Optional[BorgdroneEvent[None]] = None,
+    env: Optional[Dict[str, str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Stream the archives of a repository without holding the whole listing in memory.
+
+    Yields archive dicts in the format of `__parse_archive_info`, without
+    stats. Breaking out of the loop stops borg.
+
+    Arguments:
+        repo_id -- Borg repository id to put into `repository_id`.
+        result_log -- Receives the outcome once the iteration finished.
+    """
+    _log = result_log if result_log is not None else BorgdroneEvent[None]()
+    _log.event = "BorgRunner.iter_archives"
+
+    command = BORG_LIST_LINES_COMMAND.copy()
+    command[2] = repo_path
+
+    stream = bash.stream(command, key=repo_path, env=env)
+    for line in stream:
+        if archive := __parse_archive_line(line, repo_id):
+            yield archive
+
+    __stream_result(_log, stream)
+
+
+def __parse_archive_line(line: str, repo_id: OptStr = None) -> Optional[Dict[str, Any]]:
+    """Map one BORG_LIST_LINES_COMMAND line onto the Archive() model fields."""
+    values = line.split("\t")
+    if len(values) != len(BORG_LIST_LINES_FIELDS):
+        return None
+
+    archive: Dict[str, Any] = dict(zip(BORG_LIST_LINES_FIELDS, values))
+    archive["repository_id"] = repo_id
+    archive["start_epoch"] = datahelpers.ISO8601_to_epoch(archive["start"])
+    archive["end_epoch"] = datahelpers.ISO8601_to_epoch(archive["end"])
+    return archive
+
+
+def iter_archive_items(
+    repo_path: str,
+    archive_name: str,
+    result_log: Optional[BorgdroneEvent[None]] = None,
+    env: Optional[Dict[str, str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Stream the contents of an archive from `borg list --json-lines`.
+
+    Yields one dict per file system item (path, type, mode, user, group,
+    size, mtime, ...). Breaking out of the loop stops borg.
+
+    Arguments:
+        result_log -- Receives the outcome once the iteration finished.
+    """
+    for line in iter_archive_item_lines(repo_path, archive_name, result_log, env):
+        yield json.loads(line)
+
+
+def iter_archive_item_lines(
+    repo_path: str,
+    archive_name: str,
+    result_log: Optional[BorgdroneEvent[None]] = None,
+    env: Optional[Dict[str, str]] = None,
+) -> Iterator[str]:
+    """The unparsed JSON lines of `iter_archive_items`, for callers that parse them elsewhere."""
+    _log = result_log if result_log is not None else BorgdroneEvent[None]()
+    _log.event = "BorgRunner.iter_archive_items"
+
+    command = BORG_LIST_ITEMS_COMMAND.copy()
+    command[1] = f"{repo_path}::{archive_name}"
+
+    stream = bash.stream(command, key=repo_path, env=env)
+    for line in stream:
+        if line:
+            yield line
+
+    __stream_result(_log, stream)
+
+
+def iter_archive_diff_lines(
+    repo_path: str,
+    old_name: str,
+    new_name: str,
+    result_log: Optional[BorgdroneEvent[None]] = None,
+    env: Optional[Dict[str, str]] = None,
+) -> Iterator[str]:
+    """Stream the unparsed `borg diff --json-lines` lines between two archives of a repository."""
+    _log = result_log if result_log is not None else BorgdroneEvent[None]()
+    _log.event = "BorgRunner.iter_archive_diff_lines"
+
+    command = BORG_DIFF_COMMAND.copy()
+    command[1] = f"{repo_path}::{old_name}"
+    command[2] = new_name
+
+    stream = bash.stream(command, key=repo_path, env=env)
+    for line in stream:
+        if line:
+            yield line
+
+    __stream_result(_log, stream)
+
+
+def export_tar_stream(
+    repo_path: str, archive_name: str, paths: Optional[List[str]] = None, env: Optional[Dict[str, str]] = None
+) -> bash.ChunkStream:
+    """The archive, or only `paths` of it, as an uncompressed tar stream from `borg export-tar`."""
+    command = BORG_EXPORT_TAR_COMMAND.copy()
+    command[1] = f"{repo_path}::{archive_name}"
+    # paths are never options, even when they start with a dash
+    return bash.stream_chunks(command, ["--", *(paths or [])], key=repo_path, env=env)
+
+
+def extract_stdout_stream(
+    repo_path: str, archive_name: str, path: str, env: Optional[Dict[str, str]] = None
+) -> bash.ChunkStream:
+    """The contents of one file of the archive, from `borg extract --stdout`."""
+    command = BORG_EXTRACT_STDOUT_COMMAND.copy()
+    command[1] = f"{repo_path}::{archive_name}"
+    return bash.stream_chunks(command, ["--", path], key=repo_path, env=env)
+
+
+def stream_error(stream: bash.LineStream) -> OptStr:
+    """Why a finished stream failed, None when it succeeded or was stopped early."""
+    if stream.result is None or "stderr" not in stream.result:
+        return None
+
+    _log = __process_error(BorgdroneEvent[None](), stream.result["stderr"])
+    return _log.error_message or "borg failed."
+
+
 def __parse_archive_info(raw_data: dict) -> List[Dict[str, Any]]:
     """Parse the archive data.
 
@@ -201,6 +664,8 @@ def __parse_archive_info(raw_data: dict) -> List[Dict[str, Any]]:
         return_data["hostname"] = info["hostname"]
         return_data["name"] = info["name"]
         return_data["start"] = info["start"]
+        return_data["start_epoch"] = datahelpers.ISO8601_to_epoch(info["start"])
+        return_data["end_epoch"] = datahelpers.ISO8601_to_epoch(info["end"])
         return_data["tam"] = info.get("tam")
         return_data["time"] = info.get("time")
         return_data["username"] = info["username"]
@@ -216,11 +681,10 @@ def __parse_archive_info(raw_data: dict) -> List[Dict[str, Any]]:
     return archives
 
 
-def archive_info(repo_path: str, archive_name: str) -> BorgdroneEvent[Dict[str, Any]]:
+def __archive_info_result(result_log: BorgdroneEvent[dict]) -> BorgdroneEvent[Dict[str, Any]]:
     _log = BorgdroneEvent[Dict[str, Any]]()
     _log.event = "BorgRunner.archive_info"
 
-    result_log = borg_info(repo_path, archive_name=archive_name)
     if not (archive_data := result_log.get_data()):
         _log.status = "FAILURE"
         _log.error_message = result_log.error_message
@@ -236,20 +700,62 @@ def archive_info(repo_path: str, archive_name: str) -> BorgdroneEvent[Dict[str,
     return _log
 
 
-def get_last_archive(repo_path: str) -> BorgdroneEvent[Optional[dict]]:
+def archive_info(
+    repo_path: str, archive_name: str, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[Dict[str, Any]]:
+    result_log = borg_info(repo_path, archive_name=archive_name, env=env)
+    return __archive_info_result(result_log)
+
+
+async def archive_info_async(
+    repo_path: str, archive_name: str, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[Dict[str, Any]]:
+    result_log = await borg_info_async(repo_path, archive_name=archive_name, env=env)
+    return __archive_info_result(result_log)
+
+
+def list_archives_info(repo_path: str, env: Optional[Dict[str, str]] = None) -> BorgdroneEvent[List[Dict[str, Any]]]:
+    """Info, including stats, for every archive in the repository with a single borg call.
+
+    Returns:
+        BorgdroneEvent[List[Dict[str, Any]]]:
+            archive info in the format of the Archive model, oldest first.
+    """
+    _log = BorgdroneEvent[List[Dict[str, Any]]]()
+    _log.event = "BorgRunner.list_archives_info"
+
+    command = __borg_info_command(repo_path)
+    command.insert(2, "--glob-archives *")
+
+    result = __run_cached(repo_path, command, env)
+    if "stderr" in result:
+        # Possible:
+        # - Repository.DoesNotExist
+        __process_error(_log, result["stderr"])
+        return _log.return_debug_failure()
+
+    data = __parse_archive_info(json.loads(result["stdout"]))
+    _log.set_data(data)
+    return _log.return_debug_success(f"Info for {len(data)} archives parsed.")
+
+
+def get_last_archive(
+    repo_path: str, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[Tuple[Dict[str, Any], Dict[str, Any]]]:
     """Get the last archive from the repository.
 
     Arguments:
         repo_path -- Path to the repository.
 
     Returns:
-        BorgdroneEvent[Dict[str, Any]]:
-            containing the archive info in the format of the Archive model.
+        BorgdroneEvent[Tuple[Dict[str, Any], Dict[str, Any]]]:
+            containing the archive info in the format of the Archive model, and the
+            repository's cache stats (`cache.stats` of `borg info --json`) that come with it.
     """
-    _log = BorgdroneEvent[Optional[Dict[str, Any]]]()
+    _log = BorgdroneEvent[Tuple[Dict[str, Any], Dict[str, Any]]]()
     _log.event = "BorgRunner.get_last_archive"
 
-    result_log = borg_info(repo_path, last=1)
+    result_log = borg_info(repo_path, last=1, env=env)
     if not (archive_data := result_log.get_data()):
         return result_log.return_debug_failure()
 
@@ -258,21 +764,20 @@ def get_last_archive(repo_path: str) -> BorgdroneEvent[Optional[dict]]:
         # logger.debug(json.dumps(archive_data, indent=4))
         return _log.return_debug_failure("No archives exist in the repository.")
 
-    _log.set_data(data[0])
+    _log.set_data((data[0], archive_data.get("cache", {}).get("stats", {})))
     return _log.return_debug_success("Archive data parsed.")
 
 
-def borg_check(repo_path: str, repository_only: bool = True) -> BorgdroneEvent[None]:
-
-    _log = BorgdroneEvent[None]()
-    _log.event = "BorgRunner.borg_check"
-
+def __borg_check_command(repo_path: str, repository_only: bool = True) -> List[str]:
     command = BORG_CHECK_COMMAND.copy()
     if repository_only:
         command.append("--repository-only")
 
     command.append(repo_path)
-    result = bash.run(command)
+    return command
+
+
+def __borg_check_result(_log: BorgdroneEvent[None], result: Dict[str, Any]) -> BorgdroneEvent[None]:
     if "stderr" in result:
         __process_error(_log, result["stderr"])
         return _log.return_debug_failure()
@@ -280,17 +785,161 @@ def borg_check(repo_path: str, repository_only: bool = True) -> BorgdroneEvent[N
     return _log.return_debug_success()
 
 
-def repository_info(repo_path: str, passphrase: Optional[str] = None) -> BorgdroneEvent[Optional[Dict[str, Any]]]:
-    _log = BorgdroneEvent[Optional[Dict[str, Any]]]()
-    _log.event = "BorgRunner.repository_info"
+def borg_check(
+    repo_path: str, repository_only: bool = True, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[None]:
+
+    _log = BorgdroneEvent[None]()
+    _log.event = "BorgRunner.borg_check"
+
+    command = __borg_check_command(repo_path, repository_only)
+    result = __run(repo_path, command, env)
+    return __borg_check_result(_log, result)
+
+
+async def borg_check_async(
+    repo_path: str, repository_only: bool = True, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[None]:
+    _log = BorgdroneEvent[None]()
+    _log.event = "BorgRunner.borg_check"
+
+    command = __borg_check_command(repo_path, repository_only)
+    result = await __run_async(repo_path, command, env)
+    return __borg_check_result(_log, result)
 
-    if not passphrase:
-        logger.debug("No repository passphrase provided. Generating one.", "yellow")
-        passphrase = str(uuid.uuid4())
 
-    os.environ["BORG_PASSPHRASE"] = passphrase
-    result_log = borg_info(repo_path)
-    os.environ["BORG_PASSPHRASE"] = ""
+def benchmark_backends(
+    repo_path: str, repeat: int = 5, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[List[Dict[str, Any]]]:
+    """Time the same read-only queries through the borg CLI and through a borg worker.
+
+    Results are never cached here. One untimed run per backend starts the
+    worker and warms the OS caches, so only the steady state is compared.
+
+    Returns:
+        BorgdroneEvent[List[Dict[str, Any]]] -- Median and mean milliseconds per command and backend.
+    """
+    _log = BorgdroneEvent[List[Dict[str, Any]]]()
+    _log.event = "BorgRunner.benchmark_backends"
+
+    if not borg_backend.enabled:
+        return _log.return_failure("The worker backend is disabled, set BORG_BACKEND=worker.")
+
+    commands = {"info": __borg_info_command(repo_path), "list": __list_archives_command(repo_path)}
+    rows = []
+    for name, command in commands.items():
+        timings: Dict[str, List[float]] = {"cli": [], "worker": []}
+        for run in range(repeat + 1):
+            for backend, times in timings.items():
+                started = time.perf_counter()
+                result = bash.run(command, env=env, worker=backend == "worker")
+                elapsed = time.perf_counter() - started
+
+                if "stderr" in result:
+                    __process_error(_log, result["stderr"])
+                    return _log.return_debug_failure()
+                if run > 0:
+                    times.append(elapsed * 1000)
+
+        if borg_backend.error:
+            return _log.return_failure(f"The borg worker is unavailable: {borg_backend.error}")
+
+        row: Dict[str, Any] = {"command": name, "runs": repeat}
+        for backend, times in timings.items():
+            row[f"{backend}_median_ms"] = round(statistics.median(times), 1)
+            row[f"{backend}_mean_ms"] = round(statistics.fmean(times), 1)
+        row["speedup"] = round(row["cli_median_ms"] / max(row["worker_median_ms"], 0.1), 2)
+        rows.append(row)
+
+    _log.set_data(rows)
+    return _log.return_success(f"Benchmarked {len(rows)} commands, {repeat} runs each.")
+
+
+def borg_check_slice(
+    repo_path: str, max_duration: int, env: Optional[Dict[str, str]] = None
+) -> BorgdroneEvent[Dict[str, Any]]:
+    """Run `borg check --repository-only` for at most `max_duration` seconds.
+
+    Borg remembers where a partial check stopped and the next slice continues
+    from there, so the repository lock is never held longer than one slice.
+
+    Returns:
+        BorgdroneEvent[Dict[str, Any]]:
+            - complete -- The slice reached the end of the repository.
+            - segment -- The last segment checked, if borg reported it.
+    """
+    _log = BorgdroneEvent[Dict[str, Any]]()
+    _log.event = "BorgRunner.borg_check_slice"
+
+    command = __borg_check_command(repo_path)
+    # the segment borg stopped at is only logged at the info level
+    command.insert(-1, f"--info --max-duration {max(1, int(max_duration))}")
+
+    messages: List[str] = []
+
+    def on_line(_stream: str, line: str) -> OptStr:
+        try:
+            message = json.loads(line).get("message", line)
+        except ValueError:
+            message = line
+        messages.append(message)
+        return message
+
+    job = bash.popen(command, key=repo_path, line_filter=on_line, env=env)
+    if (result := job.result()) is None:
+        return _log.return_debug_failure("Check was cancelled.")
+
+    if "stderr" in result:
+        # Possible:
+        # - Repository.DoesNotExist
+        # - Repository.CheckNeeded
+        _log.status = "FAILURE"
+        _log.error_message = messages[-1] if messages else f"borg check exited with {result['returncode']}."
+        return _log.return_debug_failure()
+
+    # "finished partial segment check, last segment checked is N" when the time ran out,
+    # "finished segment check at segment N" when the end of the repository was reached
+    segment = None
+    complete = True
+    for message in messages:
+        if match := re.search(r"last segment checked is (\d+)", message):
+            segment = int(match.group(1))
+            complete = False
+        elif match := re.search(r"segment check at segment (\d+)", message):
+            segment = int(match.group(1))
+            complete = True
+
+    _log.set_data({"complete": complete, "segment": segment})
+    return _log.return_debug_success()
+
+
+def borg_check_data(repo_path: str, last: int = 1, env: Optional[Dict[str, str]] = None) -> BorgdroneEvent[None]:
+    """Read back and verify the data chunks of the `last` archives."""
+    _log = BorgdroneEvent[None]()
+    _log.event = "BorgRunner.borg_check_data"
+
+    command = BORG_CHECK_COMMAND.copy()
+    command.append(f"--info --archives-only --verify-data --last {max(1, last)}")
+    command.append(repo_path)
+
+    job = bash.popen(command, key=repo_path, env=env)
+    if (result := job.result()) is None:
+        return _log.return_debug_failure("Check was cancelled.")
+
+    if "stderr" in result:
+        try:
+            __process_error(_log, result["stderr"])
+        except ValueError:
+            _log.status = "FAILURE"
+            _log.error_message = result["stderr"] or f"borg check exited with {result['returncode']}."
+        return _log.return_debug_failure()
+
+    return _log.return_debug_success()
+
+
+def __repository_info_result(result_log: BorgdroneEvent[dict]) -> BorgdroneEvent[Optional[Dict[str, Any]]]:
+    _log = BorgdroneEvent[Optional[Dict[str, Any]]]()
+    _log.event = "BorgRunner.repository_info"
 
     if not (repository_data := result_log.get_data()):
         result_log.event = _log.event
@@ -298,3 +947,49 @@ def repository_info(repo_path: str, passphrase: Optional[str] = None) -> Borgdro
 
     _log.set_data(repository_data)
     return _log.return_debug_success("Repository data parsed.")
+
+
+def __passphrase(passphrase: Optional[str]) -> str:
+    if not passphrase:
+        logger.debug("No repository passphrase provided. Generating one.", "yellow")
+        passphrase = str(uuid.uuid4())
+
+    return passphrase
+
+
+def repository_info(repo_path: str, passphrase: Optional[str] = None) -> BorgdroneEvent[Optional[Dict[str, Any]]]:
+    # the passphrase only goes into the child's environment, so concurrent queries cannot leak it
+    result_log = borg_info(repo_path, env=repository_env(__passphrase(passphrase)))
+
+    return __repository_info_result(result_log)
+
+
+async def repository_info_async(
+    repo_path: str, passphrase: Optional[str] = None
+) -> BorgdroneEvent[Optional[Dict[str, Any]]]:
+    result_log = await borg_info_async(repo_path, env=repository_env(__passphrase(passphrase)))
+
+    return __repository_info_result(result_log)
+
+
+async def gather_repository_info(
+    repositories: List[Tuple[str, Optional[str]]], limit: int = 8
+) -> List[BorgdroneEvent[Optional[Dict[str, Any]]]]:
+    """Run `repository_info_async` for many repositories, at most `limit` at a time.
+
+    The queries are borg executor jobs like any other, so BORG_MAX_JOBS and
+    the one-command-per-repository rule apply to them as well.
+
+    Arguments:
+        repositories -- (path, passphrase) pairs.
+
+    Returns:
+        The events in the same order as `repositories`.
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def query(path: str, passphrase: Optional[str]) -> BorgdroneEvent[Optional[Dict[str, Any]]]:
+        async with semaphore:
+            return await repository_info_async(path, passphrase)
+
+    return list(await asyncio.gather(*(query(path, passphrase) for path, passphrase in repositories)))
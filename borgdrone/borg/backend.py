@@ -0,0 +1,229 @@
+import atexit
+import json
+import os
+import shutil
+import subprocess
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from flask import Flask
+
+from borgdrone.logging import logger
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+
+# read-only commands with a small, complete output; anything else keeps its own borg process
+WORKER_COMMANDS = {"info", "list", "check"}
+DEFAULT_MAX_REQUESTS = 200
+
+
+class BorgWorker:
+    """One `worker.py` process, serving one request at a time."""
+
+    def __init__(self, python: str):
+        self.requests = 0
+        self.process = subprocess.Popen(  # pylint: disable=consider-using-with
+            [python, WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8",
+            # no controlling terminal, borg cannot prompt for anything
+            start_new_session=True,
+        )
+
+        ready = self.__read()
+        if not ready.get("ready"):
+            self.stop()
+            raise RuntimeError(ready.get("error", "The borg worker did not start."))
+
+        self.version: str = ready.get("version", "unknown")
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def __read(self) -> Dict[str, Any]:
+        assert self.process.stdout
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"The borg worker exited with {self.process.wait()}.")
+
+        return json.loads(line)
+
+    def request(self, args: List[str], env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        assert self.process.stdin
+        self.process.stdin.write(json.dumps({"args": args, "env": env or {}}) + "\n")
+        self.process.stdin.flush()
+        self.requests += 1
+        return self.__read()
+
+    def stop(self) -> None:
+        if self.process.stdin:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class WorkerBackend:
+    """Runs read-only borg commands in long-lived worker processes.
+
+    Starting borg costs several hundred milliseconds of interpreter startup
+    and imports before it does any work. Workers import borg once and then
+    run one command after another, in-process.
+
+    `run()` returns None whenever a command should go through the borg CLI
+    instead: the backend is disabled, the command is not read-only, every
+    worker is busy, or the worker could not be started, died or failed
+    outside of borg. Repositories are opened and closed by every command, as
+    holding them open would keep them locked for other borg processes.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.python: Optional[str] = None
+        self.max_workers = 2
+        self.max_requests = DEFAULT_MAX_REQUESTS
+        self.version: Optional[str] = None
+        self.error: Optional[str] = None
+
+        self._idle: List[BorgWorker] = []
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask) -> None:
+        self.enabled = app.config.get("BORG_BACKEND", "cli") == "worker"
+        self.python = app.config.get("BORG_WORKER_PYTHON") or None
+        self.max_workers = max(1, int(app.config.get("BORG_WORKERS") or app.config.get("BORG_MAX_JOBS", 2)))
+        self.max_requests = int(app.config.get("BORG_WORKER_MAX_REQUESTS", DEFAULT_MAX_REQUESTS))
+        app.extensions["borg_backend"] = self
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def eligible(cmd: List[str]) -> bool:
+        if not cmd or os.path.basename(cmd[0]) != "borg":
+            return False
+
+        subcommand = next((arg for arg in cmd[1:] if arg and not arg.startswith("-")), None)
+        return subcommand in WORKER_COMMANDS
+
+    def interpreter(self) -> Optional[str]:
+        """The configured Python, or the one named in the shebang of the `borg` script."""
+        if self.python:
+            return self.python
+
+        if not (borg := shutil.which("borg")):
+            return None
+
+        try:
+            with open(borg, "rb") as file:
+                first_line = file.readline(256)
+        except OSError:
+            return None
+
+        # a standalone borg binary has no shebang and no importable library
+        if first_line.startswith(b"#!") and b"python" in first_line:
+            return first_line[2:].decode(errors="replace").strip().split(" ")[0]
+
+        return None
+
+    def __acquire(self) -> Optional[BorgWorker]:
+        with self._lock:
+            if self.error is not None:
+                return None
+
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive:
+                    self._running += 1
+                    return worker
+
+            if self._running >= self.max_workers:
+                return None
+            self._running += 1
+
+        try:
+            if not (python := self.interpreter()):
+                raise RuntimeError("No Python interpreter with borg found, set BORG_WORKER_PYTHON.")
+            worker = BorgWorker(python)
+        except (OSError, RuntimeError, ValueError) as e:
+            with self._lock:
+                self._running -= 1
+                self.error = str(e)
+            logger.debug(f"borg worker backend disabled, using the borg CLI: {e}", "red")
+            return None
+
+        self.version = worker.version
+        return worker
+
+    def __release(self, worker: BorgWorker) -> None:
+        with self._lock:
+            self._running -= 1
+            if worker.alive and worker.requests < self.max_requests:
+                self._idle.append(worker)
+                return
+
+        # recycled, borg keeps module level state between calls
+        worker.stop()
+
+    def run(
+        self,
+        cmd: List[str],
+        env: Optional[Dict[str, str]] = None,
+        on_spawn: Optional[Callable[[subprocess.Popen], None]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Run `cmd` on a worker.
+
+        Arguments:
+            env -- Variables set for this command only.
+            on_spawn -- Called with the worker process, terminating it aborts the command.
+
+        Returns:
+            Optional[Dict[str, Any]] -- The worker's response, None to use the CLI instead.
+        """
+        if not self.enabled or not self.eligible(cmd) or (worker := self.__acquire()) is None:
+            return None
+
+        try:
+            if on_spawn:
+                on_spawn(worker.process)
+            response = worker.request(cmd[1:], env)
+        except (OSError, RuntimeError, ValueError) as e:
+            logger.debug(f"borg worker failed, using the borg CLI: {e}", "red")
+            return None
+        finally:
+            self.__release(worker)
+
+        if "error" in response:
+            # borg could not run in the worker, not a borg error
+            logger.debug(f"borg worker failed, using the borg CLI: {response['error']}", "red")
+            return None
+
+        return response
+
+    def shutdown(self) -> None:
+        with self._lock:
+            workers, self._idle = self._idle, []
+
+        for worker in workers:
+            worker.stop()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "python": self.python or self.interpreter(),
+                "version": self.version,
+                "error": self.error,
+                "idle": len(self._idle),
+                "running": self._running,
+                "max_workers": self.max_workers,
+            }
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any, Dict, Optional, Tuple
+
+from flask import Flask
+
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_CACHE_TTL = 300.0
+
+# files borg rewrites on every committed transaction
+TOKEN_FILES = ("config",)
+TOKEN_PREFIXES = ("index.", "hints.", "integrity.")
+
+ChangeToken = Tuple[Tuple[str, int, int], ...]
+
+
+def change_token(repo_path: str) -> Optional[ChangeToken]:
+    """A cheap fingerprint of a local repository's committed state.
+
+    Borg writes new index/hints/integrity files and bumps their transaction
+    number on every commit, so their names, mtimes and sizes change whenever
+    archives are added or removed.
+
+    Returns:
+        None -- For remote or missing repositories, which are not cached.
+    """
+    if "://" in repo_path or "@" in repo_path:
+        return None
+
+    token = []
+    try:
+        with os.scandir(repo_path) as entries:
+            for entry in entries:
+                if entry.name in TOKEN_FILES or entry.name.startswith(TOKEN_PREFIXES):
+                    stat = entry.stat()
+                    token.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    except OSError:
+        return None
+
+    if not token:
+        # not a repository (yet)
+        return None
+
+    return tuple(sorted(token))
+
+
+class CacheEntry:
+    def __init__(self, token: ChangeToken, value: Any):
+        self.token = token
+        self.value = value
+        self.created: float = time.monotonic()
+
+
+class ResultCache:
+    """LRU cache for the output of read-only borg queries.
+
+    Entries are keyed by repository path and command. An entry is served
+    only while it is younger than `ttl` and the repository's change token
+    is unchanged, so a hit costs a directory scan instead of a borg call.
+    Commands that modify a repository call `invalidate()` explicitly.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE, ttl: float = DEFAULT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self._entries: OrderedDict[Tuple[str, Hashable], CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask) -> None:
+        self.maxsize = max(0, int(app.config.get("BORG_CACHE_SIZE", DEFAULT_CACHE_SIZE)))
+        self.ttl = float(app.config.get("BORG_CACHE_TTL", DEFAULT_CACHE_TTL))
+        app.extensions["borg_cache"] = self
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, repo_path: str, key: Hashable) -> Tuple[Optional[ChangeToken], Any]:
+        """Look up `key` for `repo_path`.
+
+        Returns:
+            (token, value) -- `value` is None on a miss. Pass `token` to `set()`,
+            so a result is never stored under a state newer than it was read from.
+        """
+        if not self.enabled:
+            return None, None
+
+        token = change_token(repo_path)
+        cache_key = (os.path.normpath(repo_path), key)
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or token is None or entry.token != token or self.__expired(entry):
+                if entry is not None:
+                    del self._entries[cache_key]
+                self.misses += 1
+                return token, None
+
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return token, entry.value
+
+    def set(self, repo_path: str, key: Hashable, value: Any, token: Optional[ChangeToken]) -> None:
+        if not self.enabled or token is None:
+            return
+
+        cache_key = (os.path.normpath(repo_path), key)
+        with self._lock:
+            self._entries[cache_key] = CacheEntry(token, value)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, repo_path: Optional[str] = None) -> None:
+        """Drop the entries of `repo_path`, or everything."""
+        with self._lock:
+            if repo_path is None:
+                self._entries.clear()
+                return
+
+            path = os.path.normpath(repo_path)
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] == path]:
+                del self._entries[cache_key]
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def __expired(self, entry: CacheEntry) -> bool:
+        return time.monotonic() - entry.created > self.ttl
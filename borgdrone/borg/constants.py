@@ -18,6 +18,7 @@ BORG_DELETE_COMMAND = [
 
 BORG_CREATE_COMMAND = [
     "borg",
+    "--log-json",
     "create",
     "--list --stats --progress --one-file-system",
 ]
@@ -30,3 +31,41 @@ BORG_LIST_COMMAND = [
     "PATH",
     "--format '{archive}{name}{id}{tam}{start}{time}{end}{command_line}{hostname}{username}'",
 ]
+
+# one archive per line, fields separated by tabs
+BORG_LIST_LINES_COMMAND = [
+    "borg --log-json list",
+    "--format {id}{TAB}{name}{TAB}{start:%Y-%m-%dT%H:%M:%S.%f}{TAB}{end:%Y-%m-%dT%H:%M:%S.%f}"
+    "{TAB}{time:%Y-%m-%dT%H:%M:%S.%f}{TAB}{hostname}{TAB}{username}{TAB}{command_line}{NL}",
+    "PATH",
+]
+BORG_LIST_LINES_FIELDS = ["archive_id", "name", "start", "end", "time", "hostname", "username", "command_line"]
+
+BORG_LIST_ITEMS_COMMAND = [
+    "borg --log-json list --json-lines",
+    "PATH::ARCHIVE",
+]
+
+BORG_DIFF_COMMAND = [
+    "borg --log-json diff --json-lines",
+    "PATH::ARCHIVE",
+    "ARCHIVE2",
+]
+
+# the tar stream goes to stdout, paths to include are appended
+BORG_EXPORT_TAR_COMMAND = [
+    "borg --log-json export-tar",
+    "PATH::ARCHIVE",
+    "-",
+]
+
+BORG_EXTRACT_STDOUT_COMMAND = [
+    "borg --log-json extract --stdout",
+    "PATH::ARCHIVE",
+]
+
+# --keep-* options and --glob-archives are appended
+BORG_PRUNE_COMMAND = [
+    "borg --log-json prune",
+    "PATH",
+]
@@ -0,0 +1,379 @@
+import asyncio
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Set
+
+from flask import (
+    Flask,
+    copy_current_request_context,
+    current_app,
+    has_app_context,
+    has_request_context,
+)
+
+DEFAULT_MAX_JOBS = 2
+
+
+class BorgJob:
+    """Handle for a unit of work queued on the BorgExecutor.
+
+    - `status`: PENDING, RUNNING, DONE, FAILED, CANCELLED
+    """
+
+    def __init__(self, key: str, func: Callable[..., Any], args: tuple, kwargs: dict, repository: Optional[str] = None):
+        self.id: str = uuid.uuid4().hex
+        self.key = key
+        self.repository = repository  # the key, unless the job was submitted without one
+        self.status: str = "PENDING"
+
+        self.submitted: float = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+        self.process: Optional[subprocess.Popen] = None
+
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._value: Any = None
+        self._exception: Optional[BaseException] = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: list[Callable[["BorgJob"], None]] = []
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.status == "CANCELLED"
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the job finished. Returns False if `timeout` expired first."""
+        return self._done.wait(timeout)
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        """Wait for the job and return its value, re-raising any exception it raised.
+
+        Cancelled jobs return None.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError(f"Job {self.id} did not finish within {timeout} seconds.")
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._value
+
+    def cancel(self) -> bool:
+        """Cancel a pending job, or terminate the process of a running one.
+
+        Returns False if the job already finished.
+        """
+        callbacks = []
+        with self._lock:
+            if self.done:
+                return False
+
+            if self.status == "PENDING":
+                self.status = "CANCELLED"
+                callbacks = self.__finish()
+            else:
+                self.status = "CANCELLED"
+                if self.process is not None and self.process.poll() is None:
+                    self.process.terminate()
+
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self, callback: Callable[["BorgJob"], None]) -> None:
+        """Call `callback(job)` once the job finished, right away if it already did."""
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def __finish(self) -> list[Callable[["BorgJob"], None]]:
+        # called with self._lock held, the callbacks are run after releasing it
+        self.finished = time.time()
+        self._done.set()
+        callbacks, self._callbacks = self._callbacks, []
+        return callbacks
+
+    def attach_process(self, process: subprocess.Popen) -> None:
+        with self._lock:
+            self.process = process
+            if self.status == "CANCELLED":
+                process.terminate()
+
+    def _run(self) -> None:
+        with self._lock:
+            if self.status == "CANCELLED":
+                return
+            self.status = "RUNNING"
+            self.started = time.time()
+
+        try:
+            self._value = self._func(*self._args, **self._kwargs)
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            self._exception = e
+
+        with self._lock:
+            if self.status != "CANCELLED":
+                self.status = "FAILED" if self._exception is not None else "DONE"
+            self.process = None
+            callbacks = self.__finish()
+
+        for callback in callbacks:
+            callback(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "key": self.key,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class BorgExecutor:
+    """Runs borg work on a bounded pool of worker threads.
+
+    - At most `max_workers` jobs run at the same time.
+    - Jobs sharing a key (the repository path) never run concurrently
+      and are started in the order they were submitted.
+    - Work submitted from inside a running job is executed inline, so a job
+      can call other BorgRunner functions without deadlocking the pool.
+      Work on another key first waits until that key is free, see `hold()`.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_JOBS):
+        self.max_workers = max_workers
+
+        lock = threading.Lock()
+        self._cond = threading.Condition(lock)  # work became ready
+        self._released = threading.Condition(lock)  # a key stopped running
+        self._queues: Dict[str, Deque[BorgJob]] = {}
+        self._ready: Deque[str] = deque()
+        self._scheduled: Set[str] = set()  # keys that are in _ready or running
+        self._running: Set[str] = set()  # keys a job runs on, in a worker or inline
+        self._jobs: Dict[str, BorgJob] = {}
+        self._workers: list[threading.Thread] = []
+        self._local = threading.local()
+
+    def init_app(self, app: Flask) -> None:
+        self.max_workers = max(1, int(app.config.get("BORG_MAX_JOBS", DEFAULT_MAX_JOBS)))
+        app.extensions["borg_executor"] = self
+
+    def submit(self, key: Optional[str], func: Callable[..., Any], *args: Any, **kwargs: Any) -> BorgJob:
+        """Queue `func(*args, **kwargs)` behind other jobs with the same `key`.
+
+        A `key` of None only counts against the global limit.
+        """
+        normalized = self.__normalize_key(key)
+        job = BorgJob(normalized, self.__with_context(func), args, kwargs, normalized if key is not None else None)
+
+        if self.current_job() is not None:
+            # nested submission from a worker, the caller already holds a slot
+            with self.hold(key):
+                self.__execute(job)
+            return job
+
+        with self._cond:
+            self._jobs[job.id] = job
+            self._queues.setdefault(job.key, deque()).append(job)
+            if job.key not in self._scheduled:
+                self._scheduled.add(job.key)
+                self._ready.append(job.key)
+                self._cond.notify()
+            self.__spawn_worker()
+
+        return job
+
+    def run(self, key: Optional[str], func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Submit a job and block until its result is available."""
+        return self.submit(key, func, *args, **kwargs).result()
+
+    async def run_async(self, key: Optional[str], func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """`run()` for coroutines, queued the same way and awaited without blocking the event loop.
+
+        Cancelling the awaiting task cancels the job.
+        """
+        job = self.submit(key, func, *args, **kwargs)
+        future: concurrent.futures.Future = concurrent.futures.Future()
+
+        def resolve(done: BorgJob) -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(done.result())
+            except BaseException as e:  # pylint: disable=broad-exception-caught
+                future.set_exception(e)
+
+        job.add_done_callback(resolve)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+
+    def get_job(self, job_id: str) -> Optional[BorgJob]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list[BorgJob]:
+        """Jobs that are pending or running."""
+        with self._cond:
+            return list(self._jobs.values())
+
+    def current_job(self) -> Optional[BorgJob]:
+        """The job running on the calling thread, if any."""
+        return getattr(self._local, "job", None)
+
+    def attach_process(self, process: subprocess.Popen) -> None:
+        """Let the current job terminate `process` when it is cancelled."""
+        if job := self.current_job():
+            job.attach_process(process)
+
+    @contextmanager
+    def hold(self, key: Optional[str]) -> Iterator[None]:
+        """Own `key` on the calling thread, for work done inline in a running job.
+
+        Waits until no job runs on the key, and keeps its queued jobs
+        waiting until the block is left, so a repository still runs one borg
+        process at a time. Keys the thread already owns, and None, are
+        entered right away.
+        """
+        held = self.__held()
+        if key is None or (key := self.__normalize_key(key)) in held:
+            yield
+            return
+
+        with self._cond:
+            while key in self._running:
+                self._released.wait()
+            self._running.add(key)
+            self._scheduled.add(key)
+            if key in self._ready:
+                # queued jobs of the key wait behind the inline work
+                self._ready.remove(key)
+
+        held.add(key)
+        try:
+            yield
+        finally:
+            held.discard(key)
+            with self._cond:
+                self.__release(key)
+
+    def __held(self) -> Set[str]:
+        """The keys owned by the calling thread."""
+        if not hasattr(self._local, "held"):
+            self._local.held = set()
+        return self._local.held
+
+    @staticmethod
+    def __normalize_key(key: Optional[str]) -> str:
+        if key is None:
+            return f"job-{uuid.uuid4().hex}"
+
+        if "://" not in key and "@" not in key:
+            key = os.path.normpath(key)
+
+        return key
+
+    @staticmethod
+    def __with_context(func: Callable[..., Any]) -> Callable[..., Any]:
+        """Carry the Flask request or application context over to the worker thread."""
+        if has_request_context():
+            return copy_current_request_context(func)
+
+        if has_app_context():
+            app = current_app._get_current_object()  # pylint: disable=protected-access
+
+            @wraps(func)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                with app.app_context():
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return func
+
+    def __spawn_worker(self) -> None:
+        # called with self._cond held
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        if len(self._workers) >= self.max_workers:
+            return
+
+        worker = threading.Thread(target=self.__work, name=f"borg-worker-{len(self._workers)}", daemon=True)
+        self._workers.append(worker)
+        worker.start()
+
+    def __execute(self, job: BorgJob) -> None:
+        previous = self.current_job()
+        held = self.__held()
+        owner = job.key not in held
+        self._local.job = job
+        held.add(job.key)
+        try:
+            job._run()  # pylint: disable=protected-access
+        finally:
+            self._local.job = previous
+            if owner:
+                held.discard(job.key)
+
+    def __release(self, key: str) -> None:
+        # called with self._cond held
+        self._running.discard(key)
+        self._released.notify_all()
+        if self._queues.get(key):
+            # back of the line, so one busy repository cannot starve the others
+            self._ready.append(key)
+            self._cond.notify()
+        else:
+            self._queues.pop(key, None)
+            self._scheduled.discard(key)
+
+    def __next_job(self) -> Optional[BorgJob]:
+        # called with self._cond held
+        key = self._ready.popleft()
+        queue = self._queues[key]
+        while queue:
+            job = queue.popleft()
+            if not job.cancelled:
+                return job
+            self._jobs.pop(job.id, None)
+
+        del self._queues[key]
+        self._scheduled.discard(key)
+        return None
+
+    def __work(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+
+                if (job := self.__next_job()) is None:
+                    continue
+                self._running.add(job.key)
+
+            self.__execute(job)
+
+            with self._cond:
+                self._jobs.pop(job.id, None)
+                self.__release(job.key)
@@ -0,0 +1,142 @@
+import json
+import time
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_UPDATES_PER_SECOND = 4.0
+
+
+class ArchiveProgress:
+    """State of a running `borg create`, from its `archive_progress` messages.
+
+    https://borgbackup.readthedocs.io/en/stable/internals/frontends.html#logging
+    """
+
+    def __init__(self):
+        self.original_size: int = 0
+        self.compressed_size: int = 0
+        self.deduplicated_size: int = 0
+        self.nfiles: int = 0
+        self.path: str = ""
+        self.finished: bool = False
+
+        # derived from the bundle's previous archive
+        self.percent: Optional[float] = None
+        self.eta: Optional[float] = None
+        self.elapsed: float = 0.0
+
+    def update_from_message(self, message: Dict[str, Any]) -> "ArchiveProgress":
+        # the final message only carries `finished`
+        self.original_size = message.get("original_size", self.original_size)
+        self.compressed_size = message.get("compressed_size", self.compressed_size)
+        self.deduplicated_size = message.get("deduplicated_size", self.deduplicated_size)
+        self.nfiles = message.get("nfiles", self.nfiles)
+        self.path = message.get("path", self.path)
+        self.finished = bool(message.get("finished", False))
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "original_size": self.original_size,
+            "compressed_size": self.compressed_size,
+            "deduplicated_size": self.deduplicated_size,
+            "nfiles": self.nfiles,
+            "path": self.path,
+            "finished": self.finished,
+            "percent": self.percent,
+            "eta": self.eta,
+            "elapsed": round(self.elapsed, 1),
+        }
+
+
+class ProgressTracker:
+    """Filters `borg --log-json create` output into throttled progress updates.
+
+    `filter_line` is meant to be used as a `bash.popen` line filter:
+    progress messages are swallowed and handed to `on_progress` at most
+    `updates_per_second` times per second, other JSON messages are turned
+    back into readable text.
+
+    Arguments:
+        expected_size -- `stats_original_size` of the bundle's previous archive.
+        expected_nfiles -- `stats_nfiles` of the bundle's previous archive.
+    """
+
+    def __init__(
+        self,
+        on_progress: Callable[[Dict[str, Any]], None],
+        expected_size: int = 0,
+        expected_nfiles: int = 0,
+        updates_per_second: float = DEFAULT_UPDATES_PER_SECOND,
+    ):
+        self.on_progress = on_progress
+        self.expected_size = expected_size
+        self.expected_nfiles = expected_nfiles
+        self.interval = 1 / updates_per_second if updates_per_second > 0 else 0.0
+
+        self.progress = ArchiveProgress()
+        self.updates_sent: int = 0
+        self.updates_skipped: int = 0
+
+        self._started = time.monotonic()
+        self._last_sent = 0.0
+
+    def filter_line(self, _stream: str, line: str) -> Optional[str]:
+        """Returns the text to show for `line`, or None if it was consumed."""
+        if not line.startswith("{"):
+            return line
+
+        try:
+            message: Dict[str, Any] = json.loads(line)
+        except ValueError:
+            return line
+
+        match message.get("type"):
+            case "archive_progress":
+                self.update(message)
+                return None
+            case "file_status":
+                return f"{message.get('status', '')} {message.get('path', '')}"
+            case "log_message":
+                return message.get("message", line)
+            case "progress_message" | "progress_percent":
+                return None
+
+        return line
+
+    def update(self, message: Dict[str, Any]) -> None:
+        self.progress.update_from_message(message)
+
+        now = time.monotonic()
+        if not self.progress.finished and now - self._last_sent < self.interval:
+            self.updates_skipped += 1
+            return
+
+        self._last_sent = now
+        self.progress.elapsed = now - self._started
+        self.__estimate()
+
+        self.updates_sent += 1
+        self.on_progress(self.progress.to_dict())
+
+    def __estimate(self) -> None:
+        progress = self.progress
+        if progress.finished:
+            progress.percent = 100.0
+            progress.eta = 0.0
+            return
+
+        # bytes are the better measure, file counts are the fallback
+        if self.expected_size > 0:
+            done, expected = progress.original_size, self.expected_size
+        elif self.expected_nfiles > 0:
+            done, expected = progress.nfiles, self.expected_nfiles
+        else:
+            return
+
+        # the source may have grown since the last archive, never claim to be done
+        fraction = min(done / expected, 0.99)
+        progress.percent = round(fraction * 100, 1)
+
+        if done > 0 and progress.elapsed > 0:
+            rate = done / progress.elapsed
+            progress.eta = round(max(expected - done, 0) / rate, 1)
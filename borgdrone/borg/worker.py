@@ -0,0 +1,163 @@
+"""Long-lived borg process, started by `borgdrone.borg.backend.WorkerBackend`.
+
+Runs borg commands in-process, so the interpreter and borg's imports are
+paid for once instead of on every call. This file is executed directly by
+the Python interpreter borg is installed in, and must only import the
+standard library and borg.
+
+Protocol, one JSON object per line:
+
+- on start: {"ready": true, "version": "1.2.8"} or {"ready": false, "error": "..."}
+- request:  {"args": ["info", "--json", "/repo"], "env": {"BORG_PASSPHRASE": "..."}}
+- response: {"returncode": 0, "stdout": "...", "stderr": "...", "user_time": 0.1, "system_time": 0.0}
+            or {"error": "..."} when the worker itself failed and the command should run through the CLI
+
+The worker exits when its stdin is closed.
+"""
+
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+
+
+class _Output(io.BufferedWriter):
+    # borg wraps sys.stdout.buffer in its own TextIOWrapper, which closes
+    # the buffer when the replaced wrapper is collected
+    def close(self):
+        pass
+
+
+def _reset_logging():
+    # borg's setup_logging adds a handler for the current sys.stderr on every call
+    root = logging.getLogger("")
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+
+def _redirect(fd):
+    """Point `fd` to a new temporary file, returning the file and a copy of what `fd` was."""
+    capture = tempfile.TemporaryFile()
+    saved = os.dup(fd)
+    os.dup2(capture.fileno(), fd)
+    return capture, saved
+
+
+def _restore(fd, capture, saved):
+    """Undo `_redirect` and return what was written to `fd` meanwhile."""
+    os.dup2(saved, fd)
+    os.close(saved)
+    with capture:
+        capture.seek(0)
+        return capture.read().decode("utf-8", errors="replace")
+
+
+def _update_env(env):
+    """Apply `env`, where None removes a variable, and return the values it replaced."""
+    previous = {name: os.environ.get(name) for name in env}
+    for name, value in env.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+    return previous
+
+
+def _run(borg_main, args, env):
+    previous_env = _update_env(env)
+
+    # real file descriptors, borg hands sys.stderr to faulthandler, which needs one
+    captures = {fd: _redirect(fd) for fd in (1, 2)}
+    wrappers = [
+        io.TextIOWrapper(
+            _Output(io.FileIO(fd, "w", closefd=False)), encoding="utf-8", errors="replace", line_buffering=True
+        )
+        for fd in (1, 2)
+    ]
+    saved = sys.stdout, sys.stderr, sys.argv
+    sys.stdout, sys.stderr = wrappers
+    sys.argv = ["borg", *args]
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    returncode = 0
+    error = None
+    try:
+        borg_main()
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 2)
+    except BaseException as e:  # pylint: disable=broad-exception-caught
+        # borg handles its own errors, anything else is a problem of the worker
+        error = repr(e)
+    finally:
+        for stream in {sys.stdout, sys.stderr, *wrappers}:
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+        sys.stdout, sys.stderr, sys.argv = saved
+        _reset_logging()
+        _update_env(previous_env)
+
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    output = [_restore(fd, *capture) for fd, capture in captures.items()]
+    if error is not None:
+        return {"error": error}
+
+    # ru_maxrss is the peak of the worker's whole life, not of this command
+    return {
+        "returncode": returncode,
+        "stdout": output[0],
+        "stderr": output[1],
+        "user_time": after.ru_utime - before.ru_utime,
+        "system_time": after.ru_stime - before.ru_stime,
+    }
+
+
+def main():
+    # Executed as a script, this directory comes first on sys.path and its
+    # modules (cache.py, constants.py, ...) would shadow borg's dependencies.
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:] = [path for path in sys.path if os.path.abspath(path or os.curdir) != here]
+
+    # The protocol uses private copies of stdin and stdout. borg itself gets
+    # /dev/null as stdin, so a passphrase prompt fails instead of eating requests,
+    # and anything written to fd 1 ends up on stderr.
+    requests = os.fdopen(os.dup(0), "r", encoding="utf-8")
+    replies = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    sys.stdin = open(os.devnull, encoding="utf-8")  # pylint: disable=consider-using-with
+
+    def reply(message):
+        replies.write(json.dumps(message) + "\n")
+        replies.flush()
+
+    try:
+        import borg
+        from borg.archiver import main as borg_main
+        from borg.helpers import sig_int
+    except ImportError as e:
+        reply({"ready": False, "error": f"borg is not importable by {sys.executable}: {e}"})
+        return 1
+
+    reply({"ready": True, "version": getattr(borg, "__version__", "unknown")})
+
+    for line in requests:
+        if not line.strip():
+            continue
+
+        request = json.loads(line)
+        # borg's Ctrl-C handler is meant for one command per process, it gives
+        # up its signal handler when the command ends
+        sig_int.__init__()  # pylint: disable=unnecessary-dunder-call
+        reply(_run(borg_main, request["args"], request.get("env") or {}))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
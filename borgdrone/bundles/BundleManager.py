@@ -1,3 +1,4 @@
+import os
 from typing import Any, Dict, List, Optional
 
 import yaml
@@ -5,17 +6,21 @@ from flask import current_app as app
 from flask_login import current_user
 from sqlalchemy import select
 
+from borgdrone.archives import ListingManager as listing_manager
+from borgdrone.archives import SearchManager as search_manager
 from borgdrone.archives.models import Archive
 from borgdrone.borg import BorgRunner as borg_runner
 from borgdrone.borg.constants import BORG_CREATE_COMMAND
 from borgdrone.extensions import db
-from borgdrone.helpers import bash, datahelpers, filemanager
+from borgdrone.helpers import bash, datahelpers, filemanager, limits
 from borgdrone.logging import BorgdroneEvent, logger
 from borgdrone.repositories import Repository
 from borgdrone.repositories import RepositoryManager as repository_manager
+from borgdrone.repositories import StatsManager as stats_manager
 from borgdrone.types import OptInt, OptStr
 
 from . import BackupDirectoryManager as backup_directory_manager
+from . import retention
 from .models import BackupBundle, ListBackupBundle, OptBackupBundle
 
 
@@ -58,6 +63,80 @@ def _set_bundle_values(bundle: BackupBundle, **kwargs) -> BackupBundle:
     return bundle
 
 
+def __optional_int(value: Any) -> OptInt:
+    if value is None or str(value).strip() == "":
+        return None
+    return int(value)
+
+
+def _set_bundle_limits(bundle: BackupBundle, **kwargs) -> OptStr:
+    """Set the resource limits from the form, returns an error message if they are invalid."""
+    try:
+        values = {
+            "nice": __optional_int(kwargs.get("nice")),
+            "ionice_class": kwargs.get("ionice_class") or None,
+            "ionice_priority": __optional_int(kwargs.get("ionice_priority")),
+            "cpu_quota": __optional_int(kwargs.get("cpu_quota")),
+            "io_max": (kwargs.get("io_max") or "").strip() or None,
+            "memory_max": (kwargs.get("memory_max") or "").strip() or None,
+        }
+    except ValueError:
+        return "Nice level, IO priority and CPU quota must be whole numbers."
+
+    if error := limits.validate(**values):
+        return error
+
+    for name, value in values.items():
+        setattr(bundle, name, value)
+
+    return None
+
+
+def _set_bundle_retention(bundle: BackupBundle, **kwargs) -> OptStr:
+    """Set the retention policy from the form, returns an error message if it is invalid."""
+    try:
+        policy = retention.RetentionPolicy.from_values(kwargs)
+    except ValueError as e:
+        return str(e)
+
+    bundle.keep_within = policy.within
+    for rule in retention.RULES:
+        setattr(bundle, f"keep_{rule}", getattr(policy, rule))
+
+    return None
+
+
+def update_retention(bundle_id: int, **kwargs) -> BorgdroneEvent[BackupBundle]:
+    _log = BorgdroneEvent[BackupBundle]()
+    _log.event = "BundleManager.update_retention"
+
+    bundle = get_one(bundle_id=bundle_id)
+    if not bundle:
+        return _log.not_found_message("Bundle")
+
+    _log.set_data(bundle)
+    if error := _set_bundle_retention(bundle, **kwargs):
+        return _log.return_failure(error)
+
+    bundle.commit()
+    return _log.return_success("Retention policy saved.")
+
+
+def resource_limits(bundle: BackupBundle) -> limits.ResourceLimits:
+    """The limits `borg create` runs with for `bundle`, each bundle gets its own cgroup."""
+    cgroup_root = app.config.get("BORG_CGROUP_ROOT", "")
+
+    return limits.ResourceLimits(
+        nice=bundle.nice,
+        ionice_class=bundle.ionice_class,
+        ionice_priority=bundle.ionice_priority,
+        cpu_quota=bundle.cpu_quota,
+        io_max=bundle.io_max,
+        memory_max=bundle.memory_max,
+        cgroup=os.path.join(cgroup_root, f"bundle-{bundle.id}") if cgroup_root else None,
+    )
+
+
 def __process_directories(bundle, form_data: Dict[str, Any]) -> Optional[Dict[str, List[Any]]]:
     data = {
         "include_dirs": [],
@@ -141,6 +220,10 @@ def process_bundle_form(purpose: str, **kwargs) -> BorgdroneEvent[OptBackupBundl
     else:
         return _log.return_failure("Invalid purpose.")
 
+    if error := _set_bundle_limits(bundle, **kwargs):
+        _log.set_data(bundle)
+        return _log.return_failure(error)
+
     # get the parent repository
     repo = repository_manager.get_one(db_id=bundle.repo_id)
     if not repo:
@@ -204,7 +287,7 @@ def check_dir(path: str) -> BorgdroneEvent[List[str]]:
     return _log.return_success("Directory ok.")
 
 
-def create_backup(bundle_id: int) -> BorgdroneEvent[None]:
+def create_backup(bundle_id: int, emit_socket: bool = False) -> BorgdroneEvent[None]:
     _log = BorgdroneEvent[None]()
     _log.event = "BundleManager.create_backup"
 
@@ -215,25 +298,47 @@ def create_backup(bundle_id: int) -> BorgdroneEvent[None]:
     if not bundle.command_line:
         return _log.return_failure("Bundle has no command line set.")
 
-    if app.config["PYTESTING"] == "True":
-        # The command needs to be blocking during testing
-        result = bash.run(bundle.command_line)
-        if result.get("stderr"):
-            logger.debug(bundle.command_line, "red")
-            return _log.return_failure(result["stderr"])
-
-    else:
-        bash.popen(bundle.command_line, True)
-        # TODO: error checking
+    # the previous archive is what the progress ETA is measured against
+    stmt = select(Archive).where(Archive.backupbundle_id == bundle.id).order_by(Archive.id.desc())
+    previous = db.session.scalars(stmt).first()
+
+    env = borg_runner.repository_env(bundle.repo.passphrase)
+
+    # Blocks until borg is done, queued behind other jobs on the same repository
+    result_log = borg_runner.create_archive(
+        bundle.repo.path,
+        bundle.command_line,
+        emit_socket,
+        expected_size=int(previous.stats_original_size or 0) if previous else 0,
+        expected_nfiles=int(previous.stats_nfiles or 0) if previous else 0,
+        updates_per_second=float(app.config.get("BORG_PROGRESS_RATE", 4)),
+        env=env,
+        limits=resource_limits(bundle),
+    )
+    if result_log.status == "FAILURE":
+        # Possible:
+        # - Backup was cancelled.
+        # - any borg create error
+        logger.debug(bundle.command_line, "red")
+        return _log.return_failure(result_log.error_message)
 
     # Add the new archive to the database
-    result_log = borg_runner.get_last_archive(bundle.repo.path)
-    if not (archive_data := result_log.get_data()):
+    result_log = borg_runner.get_last_archive(bundle.repo.path, env)
+    if not (last_archive := result_log.get_data()):
         return _log.return_failure("Error getting archive data.")
 
+    archive_data, cache_stats = last_archive
     archive = Archive().update_from_dict(archive_data)
 
     bundle.archives.append(archive)
     bundle.commit()
 
+    # borg info reported the repository's stats along with the archive, no extra call needed
+    if cache_stats:
+        repository_manager.apply_cache_stats(bundle.repo, cache_stats)
+        stats_manager.record_snapshot(bundle.repo, "archive")
+
+    if search_manager.auto_index():
+        listing_manager.build_listings([archive.id])
+
     return _log.return_success("Backup created successfully.")
@@ -0,0 +1,308 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from flask import Flask
+from flask import current_app as app
+from sqlalchemy import select
+
+from borgdrone.archives.models import Archive
+from borgdrone.borg.executor import BorgJob
+from borgdrone.extensions import borg_executor, db
+from borgdrone.logging import BorgdroneEvent, logger
+from borgdrone.types import OptInt
+
+from . import BundleManager as bundle_manager
+from .models import BackupBundle
+
+# archives averaged for a bundle's expected duration
+HISTORY = 3
+# finished runs kept for the UI and the API
+KEEP_RUNS = 20
+POLL_INTERVAL = 0.5
+
+
+class RunItem:
+    """One bundle of a BackupRun.
+
+    - `status`: PENDING, RUNNING, SUCCESS, FAILURE, CANCELLED
+    """
+
+    def __init__(self, bundle: BackupBundle, expected: Optional[float]):
+        self.bundle_id = bundle.id
+        self.repo_path: str = bundle.repo.path
+        self.expected = expected  # seconds, None without history
+        self.status = "PENDING"
+        self.message = ""
+
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.original_size = 0
+        self.deduplicated_size = 0
+
+        self.job: Optional[BorgJob] = None
+
+    @property
+    def elapsed(self) -> Optional[float]:
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "bundle_id": self.bundle_id,
+            "repo_path": self.repo_path,
+            "expected": self.expected,
+            "status": self.status,
+            "message": self.message,
+            "elapsed": self.elapsed,
+            "original_size": self.original_size,
+            "deduplicated_size": self.deduplicated_size,
+        }
+
+
+class BackupRun:
+    """Backs up many bundles in parallel.
+
+    - At most `limit` bundles run at once. The executor's BORG_MAX_JOBS is
+      the global cap, shared with all other borg work.
+    - Two bundles of the same repository never run at the same time.
+    - Bundles that took longest before are started first, so a long backup
+      does not start at the end of the window. Bundles without history go
+      first, as they may be the longest.
+
+    - `status`: RUNNING, DONE, CANCELLED
+    """
+
+    def __init__(self, items: List[RunItem], limit: int):
+        self.id: str = uuid.uuid4().hex
+        self.items = items
+        self.limit = limit
+        self.status = "RUNNING"
+
+        self.started = time.time()
+        self.finished: Optional[float] = None
+
+        self._cancelled = threading.Event()
+        self._changed = threading.Event()  # a job finished or the run was cancelled
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        self._changed.set()
+        for item in self.items:
+            if item.job is not None and not item.job.done:
+                item.job.cancel()
+
+    def __next_item(self, busy: set) -> Optional[RunItem]:
+        # items are sorted longest first
+        for item in self.items:
+            if item.status == "PENDING" and item.repo_path not in busy:
+                return item
+        return None
+
+    def __start(self, item: RunItem) -> None:
+        item.status = "RUNNING"
+        item.started = time.time()
+        # keyed by the repository, so other jobs on it (queries, deletes) wait as well
+        item.job = borg_executor.submit(item.repo_path, bundle_manager.create_backup, item.bundle_id)
+        item.job.add_done_callback(lambda _job: self._changed.set())
+
+    def __finish(self, item: RunItem) -> None:
+        assert item.job
+        # time spent queued behind other work on the executor is not the bundle's
+        item.started = item.job.started or item.started
+        item.finished = time.time()
+
+        try:
+            result_log: Optional[BorgdroneEvent[None]] = item.job.result()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            item.status = "FAILURE"
+            item.message = str(e)
+            return
+
+        if result_log is None:
+            item.status = "CANCELLED"
+            item.message = "Backup was cancelled."
+            return
+
+        item.status = result_log.status
+        item.message = result_log.message if result_log.status == "SUCCESS" else result_log.error_message
+        if result_log.status == "FAILURE" and self._cancelled.is_set():
+            item.status = "CANCELLED"
+
+        if result_log.status == "SUCCESS":
+            # end our read transaction, the archive was committed by the job's thread
+            db.session.rollback()
+            stmt = select(Archive).where(Archive.backupbundle_id == item.bundle_id).order_by(Archive.id.desc())
+            if archive := db.session.scalars(stmt).first():
+                item.original_size = int(archive.stats_original_size or 0)
+                item.deduplicated_size = int(archive.stats_deduplicated_size or 0)
+
+    def run(self) -> None:
+        running: List[RunItem] = []
+        busy: set = set()
+
+        while True:
+            while not self._cancelled.is_set() and len(running) < self.limit:
+                if (item := self.__next_item(busy)) is None:
+                    break
+                self.__start(item)
+                running.append(item)
+                busy.add(item.repo_path)
+
+            if not running:
+                break
+
+            self._changed.wait()
+            self._changed.clear()
+
+            for item in running[:]:
+                assert item.job
+                if item.job.done:
+                    self.__finish(item)
+                    running.remove(item)
+                    busy.discard(item.repo_path)
+
+        for item in self.items:
+            if item.status == "PENDING":
+                item.status = "CANCELLED"
+
+        self.finished = time.time()
+        self.status = "CANCELLED" if self._cancelled.is_set() else "DONE"
+
+        logger.debug(f"backup run {self.id}: {self.summary()}", "green")
+
+    def summary(self) -> Dict[str, Any]:
+        """Totals over all bundles, throughput is measured against the wall time of the whole run."""
+        wall_time = (self.finished or time.time()) - self.started
+        busy_time = sum(item.elapsed or 0 for item in self.items)
+        original_size = sum(item.original_size for item in self.items)
+        deduplicated_size = sum(item.deduplicated_size for item in self.items)
+
+        counts: Dict[str, int] = {}
+        for item in self.items:
+            counts[item.status] = counts.get(item.status, 0) + 1
+
+        return {
+            "counts": counts,
+            "wall_time": round(wall_time, 1),
+            # how many backups ran at once on average
+            "parallelism": round(busy_time / wall_time, 2) if wall_time > 0 else 0,
+            "original_size": original_size,
+            "deduplicated_size": deduplicated_size,
+            "original_per_second": int(original_size / wall_time) if wall_time > 0 else 0,
+            "deduplicated_per_second": int(deduplicated_size / wall_time) if wall_time > 0 else 0,
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "limit": self.limit,
+            "started": self.started,
+            "finished": self.finished,
+            "summary": self.summary(),
+            "items": [item.to_dict() for item in self.items],
+        }
+
+
+__runs: "OrderedDict[str, BackupRun]" = OrderedDict()
+__runs_lock = threading.Lock()
+
+
+def expected_duration(bundle_id: int) -> Optional[float]:
+    """Average duration in seconds of the bundle's last archives, None without history."""
+    stmt = (
+        select(Archive.duration)
+        .where(Archive.backupbundle_id == bundle_id, Archive.duration.is_not(None))
+        .order_by(Archive.id.desc())
+        .limit(HISTORY)
+    )
+    durations = [float(duration) for duration in db.session.scalars(stmt) if duration]
+    if not durations:
+        return None
+
+    return sum(durations) / len(durations)
+
+
+def __run_in_thread(flask_app: Flask, backup_run: BackupRun) -> None:
+    with flask_app.app_context():
+        backup_run.run()
+
+
+def start_run(bundle_ids: List[int], limit: OptInt = None) -> BorgdroneEvent[BackupRun]:
+    """Start backing up `bundle_ids` in parallel, see `BackupRun`.
+
+    Arguments:
+        limit -- Bundles running at once, BORG_MAX_JOBS when None or higher.
+    """
+    _log = BorgdroneEvent[BackupRun]()
+    _log.event = "RunManager.start_run"
+
+    bundles = list(db.session.scalars(select(BackupBundle).where(BackupBundle.id.in_(bundle_ids))))
+    if not bundles:
+        return _log.not_found_message("Bundle")
+
+    bundles = [bundle for bundle in bundles if bundle.command_line]
+    if not bundles:
+        return _log.return_failure("None of the bundles has a command line set.")
+
+    items = [RunItem(bundle, expected_duration(bundle.id)) for bundle in bundles]
+    items.sort(key=lambda item: float("inf") if item.expected is None else item.expected, reverse=True)
+
+    max_jobs = borg_executor.max_workers
+    limit = max(1, min(limit or max_jobs, max_jobs))
+    backup_run = BackupRun(items, limit)
+
+    with __runs_lock:
+        __runs[backup_run.id] = backup_run
+        while len(__runs) > KEEP_RUNS:
+            oldest = next(iter(__runs.values()))
+            if oldest.status == "RUNNING":
+                break
+            __runs.popitem(last=False)
+
+    flask_app = app._get_current_object()  # pylint: disable=protected-access
+    thread = threading.Thread(
+        target=__run_in_thread, args=(flask_app, backup_run), name=f"backup-run-{backup_run.id[:8]}", daemon=True
+    )
+    thread.start()
+
+    _log.set_data(backup_run)
+    return _log.return_success(f"Backing up {len(items)} bundles, {limit} at a time.")
+
+
+def get_run(run_id: str) -> Optional[BackupRun]:
+    with __runs_lock:
+        return __runs.get(run_id)
+
+
+def get_runs() -> List[BackupRun]:
+    """Recent runs, newest first."""
+    with __runs_lock:
+        return list(reversed(__runs.values()))
+
+
+def cancel_run(run_id: str) -> BorgdroneEvent[BackupRun]:
+    _log = BorgdroneEvent[BackupRun]()
+    _log.event = "RunManager.cancel_run"
+
+    if not (backup_run := get_run(run_id)):
+        return _log.not_found_message("Backup run")
+
+    backup_run.cancel()
+    _log.set_data(backup_run)
+    return _log.return_success("Backup run cancelled.")
+
+
+def wait(run_id: str, timeout: Optional[float] = None) -> Optional[BackupRun]:
+    """Block until the run finished, mostly for the CLI and tests."""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while (backup_run := get_run(run_id)) is not None and backup_run.status == "RUNNING":
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    return backup_run
@@ -16,7 +16,8 @@ association_table = Table(
     "association_table",
     Base.metadata,
     Column("backupbundle_id", ForeignKey("backupbundle.id", ondelete="CASCADE"), primary_key=True),
-    Column("backupdirectory_id", ForeignKey("backupdirectory.id", ondelete="CASCADE"), primary_key=True),
+    # the primary key covers lookups by bundle, this one the way back from a directory
+    Column("backupdirectory_id", ForeignKey("backupdirectory.id", ondelete="CASCADE"), primary_key=True, index=True),
 )
 
 
@@ -25,7 +26,7 @@ class BackupBundle(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
 
     # child relationships
-    repo_id: Mapped[int] = mapped_column(ForeignKey("repository.id"))
+    repo_id: Mapped[int] = mapped_column(ForeignKey("repository.id"), index=True)
     repo = relationship("Repository", back_populates="backupbundles")
 
     ## parent
@@ -48,7 +49,23 @@ class BackupBundle(db.Model):
 
     # Archive options
     name_format: Mapped[Optional[str]]
-    command_line: Mapped[Optional[str]]
+    command_line: Mapped[Optional[str]] = mapped_column(index=True)
+
+    # Resource limits for borg create
+    nice: Mapped[Optional[int]]
+    ionice_class: Mapped[Optional[str]]  # best-effort, idle
+    ionice_priority: Mapped[Optional[int]]
+    cpu_quota: Mapped[Optional[int]]  # percent of one CPU
+    io_max: Mapped[Optional[str]]  # cgroup io.max lines, "MAJOR:MINOR wbps=N"
+    memory_max: Mapped[Optional[str]]  # bytes, K/M/G/T suffix
+
+    # Retention policy, the borg prune --keep-* options. None leaves a rule out, -1 keeps every period.
+    keep_within: Mapped[Optional[str]]  # interval like 2d, H/d/w/m/y
+    keep_hourly: Mapped[Optional[int]]
+    keep_daily: Mapped[Optional[int]]
+    keep_weekly: Mapped[Optional[int]]
+    keep_monthly: Mapped[Optional[int]]
+    keep_yearly: Mapped[Optional[int]]
 
     def commit(self):
         db.session.add(self)
@@ -79,7 +96,7 @@ class BackupDirectory(db.Model):
         back_populates="backupdirectories",
     )
 
-    path: Mapped[str]
+    path: Mapped[str] = mapped_column(index=True)
     permissions: Mapped[str]
     owner: Mapped[str]
     group: Mapped[str]
@@ -0,0 +1,139 @@
+import re
+from typing import Any, List, Mapping, Optional, Sequence, Tuple
+
+# the --keep-* rules in the order borg applies them, after --keep-within
+RULES = ("hourly", "daily", "weekly", "monthly", "yearly")
+
+# borg's interval units, a month is 31 days and a year 365
+INTERVAL_SECONDS = {"H": 3600, "d": 86400, "w": 7 * 86400, "m": 31 * 86400, "y": 365 * 86400}
+INTERVAL_RE = re.compile(r"^(\d+)([Hdwmy])$")
+CHECKPOINT_RE = re.compile(r"\.checkpoint(\.\d+)?$")
+
+# (id, name, start_epoch, hourly, daily, weekly, monthly, yearly) with the period each rule puts the archive in
+ArchiveRow = Tuple[Any, str, int, str, str, str, str, str]
+
+
+class RetentionPolicy:
+    """Which archives of a bundle to keep, the `borg prune` --keep-* options.
+
+    A rule left at None is not applied, -1 keeps one archive of every period.
+    """
+
+    def __init__(
+        self,
+        within: Optional[str] = None,
+        hourly: Optional[int] = None,
+        daily: Optional[int] = None,
+        weekly: Optional[int] = None,
+        monthly: Optional[int] = None,
+        yearly: Optional[int] = None,
+    ):
+        self.within = within
+        self.hourly = hourly
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.yearly = yearly
+
+    @classmethod
+    def from_bundle(cls, bundle: Any) -> "RetentionPolicy":
+        return cls(
+            within=bundle.keep_within,
+            **{rule: getattr(bundle, f"keep_{rule}") for rule in RULES},
+        )
+
+    @classmethod
+    def from_values(cls, values: Mapping[str, Any]) -> "RetentionPolicy":
+        """Read the policy from form values named keep_within, keep_daily and so on.
+
+        Raises:
+            ValueError -- With a message for the user when a value is invalid.
+        """
+        within = str(values.get("keep_within") or "").strip() or None
+        if within is not None and not ((match := INTERVAL_RE.match(within)) and int(match.group(1)) > 0):
+            raise ValueError("Keep within must be a number followed by H, d, w, m or y, e.g. 2d.")
+
+        counts = {}
+        for rule in RULES:
+            value = str(values.get(f"keep_{rule}") or "").strip()
+            try:
+                count = int(value) if value else None
+            except ValueError as e:
+                raise ValueError("The number of archives to keep must be a whole number.") from e
+            if count is not None and count < -1:
+                raise ValueError("The number of archives to keep must be -1 (all) or more.")
+            # 0 keeps nothing, the same as leaving the rule out
+            counts[rule] = count or None
+
+        return cls(within=within, **counts)
+
+    def is_empty(self) -> bool:
+        return self.within is None and all(getattr(self, rule) is None for rule in RULES)
+
+    def keep_flags(self) -> List[str]:
+        """The policy as `borg prune` options."""
+        flags = ["--keep-within", self.within] if self.within else []
+        for rule in RULES:
+            if (count := getattr(self, rule)) is not None:
+                flags += [f"--keep-{rule}", str(count)]
+        return flags
+
+    def to_dict(self) -> dict:
+        return {"within": self.within, **{rule: getattr(self, rule) for rule in RULES}}
+
+
+def within_seconds(within: str) -> int:
+    match = INTERVAL_RE.match(within)
+    if not match:
+        raise ValueError(f"Invalid interval: {within}")
+    return int(match.group(1)) * INTERVAL_SECONDS[match.group(2)]
+
+
+def plan(rows: Sequence[ArchiveRow], policy: RetentionPolicy, now: float) -> List[Optional[str]]:
+    """Decide which archives `policy` keeps, the way `borg prune` does.
+
+    `rows` are a bundle's archives newest first, with the period keys of
+    every rule already computed, so each rule is a single pass that keeps
+    the newest archive of each period until it has kept its count. A rule
+    that runs out of periods also keeps the oldest archive. Checkpoints are
+    left out of the rules, only the latest is kept and only while no
+    complete archive is newer.
+
+    Returns:
+        Why each row is kept, in the order of `rows`, None for the archives to prune.
+    """
+    reasons: List[Optional[str]] = [None] * len(rows)
+
+    checkpoints = {index for index, row in enumerate(rows) if CHECKPOINT_RE.search(row[1])}
+    if 0 in checkpoints:
+        reasons[0] = "latest checkpoint"
+    archives = [index for index in range(len(rows)) if index not in checkpoints]
+
+    if policy.within:
+        target = now - within_seconds(policy.within)
+        for index in archives:
+            if rows[index][2] <= target:
+                break
+            reasons[index] = "within"
+
+    for column, rule in enumerate(RULES, start=3):
+        if not (count := getattr(policy, rule)):
+            continue
+
+        kept = 0
+        last = None
+        for index in archives:
+            if (period := rows[index][column]) == last:
+                continue
+            last = period
+            if reasons[index] is None:
+                kept += 1
+                reasons[index] = f"{rule} #{kept}"
+                if kept == count:
+                    break
+        else:
+            # the rule ran out of periods, borg then also keeps the oldest archive
+            if archives and count != -1 and kept < count and reasons[archives[-1]] is None:
+                reasons[archives[-1]] = f"{rule} #{kept + 1} (oldest)"
+
+    return reasons
@@ -1,21 +1,26 @@
 import random
-from typing import Any
+from typing import Any, Dict
 
-from flask import Blueprint, request
+from flask import Blueprint, jsonify, request
 from flask_login import login_required
 from flask_socketio import emit
 
 from borgdrone.extensions import socketio
-from borgdrone.helpers import ResponseHelper
+from borgdrone.helpers import ResponseHelper, datahelpers
 from borgdrone.repositories import RepositoryManager as repository_manager
 from borgdrone.types import OptInt
 
 from . import BundleManager as bundle_manager
+from . import RunManager as run_manager
 from .models import BackupBundle
 
 bundles_blueprint = Blueprint("bundles", __name__, template_folder="templates")
 
 
+def __runs_context() -> Dict[str, Any]:
+    return {"runs": run_manager.get_runs(), "convert_bytes": datahelpers.convert_bytes}
+
+
 @bundles_blueprint.route("/")
 @login_required
 def index():
@@ -23,7 +28,7 @@ def index():
     rh.context_data = {"bundles": []}
 
     bundles = bundle_manager.get_all()
-    rh.context_data = {"bundles": bundles}
+    rh.context_data = {"bundles": bundles, **__runs_context()}
 
     return rh.respond()
 
@@ -124,7 +129,7 @@ def bundle_form(purpose: str, bundle_id: OptInt) -> Any:
         # Success, redirect to index with success message
         rh.toast_success = result_log.message
         bundles = bundle_manager.get_all()
-        rh.context_data = {"bundles": bundles}
+        rh.context_data = {"bundles": bundles, **__runs_context()}
         return rh.respond()
 
     # GET method handling
@@ -184,11 +189,79 @@ def run_backup(bundle_id: int):
     return rh.respond()
 
 
+@bundles_blueprint.route("/run-many", methods=["POST"])
+@login_required
+def run_many():
+    """Back up many bundles in parallel.
+
+    Takes `bundle_ids` and an optional `limit` from the form, or from a JSON
+    body, in which case the run is returned as JSON as well.
+    """
+    rh = ResponseHelper(post_success_template="bundles/runs.html", post_error_template="bundles/runs.html")
+
+    data = request.get_json() if request.is_json else request.form
+    bundle_ids = data.get("bundle_ids") if request.is_json else data.getlist("bundle_ids")
+    limit = data.get("limit") or None
+
+    bundle_ids = [int(i) for i in bundle_ids or [] if str(i).isdigit()]
+    result_log = run_manager.start_run(bundle_ids, int(limit) if str(limit).isdigit() else None)
+
+    rh.borgdrone_return = result_log.borgdrone_return()
+
+    if request.is_json:
+        if not (backup_run := result_log.get_data()):
+            return jsonify({"error": result_log.error_message}), 400
+        return jsonify(backup_run.to_dict())
+
+    if result_log.status == "FAILURE":
+        rh.toast_error = result_log.error_message
+        rh.context_data = __runs_context()
+        return rh.respond(error=True)
+
+    rh.toast_success = result_log.message
+    rh.context_data = __runs_context()
+    return rh.respond()
+
+
+@bundles_blueprint.route("/runs")
+@login_required
+def runs():
+    rh = ResponseHelper(get_template="bundles/runs.html")
+    rh.context_data = __runs_context()
+    return rh.respond()
+
+
+@bundles_blueprint.route("/runs/<run_id>")
+@login_required
+def run_status(run_id: str):
+    if not (backup_run := run_manager.get_run(run_id)):
+        return jsonify({"error": "Backup run not found."}), 404
+
+    return jsonify(backup_run.to_dict())
+
+
+@bundles_blueprint.route("/runs/<run_id>/cancel", methods=["POST"])
+@login_required
+def cancel_run(run_id: str):
+    rh = ResponseHelper(post_success_template="bundles/runs.html", post_error_template="bundles/runs.html")
+
+    result_log = run_manager.cancel_run(run_id)
+    rh.borgdrone_return = result_log.borgdrone_return()
+    if result_log.status == "FAILURE":
+        rh.toast_error = result_log.error_message
+        rh.context_data = __runs_context()
+        return rh.respond(error=True)
+
+    rh.toast_success = result_log.message
+    rh.context_data = __runs_context()
+    return rh.respond()
+
+
 @socketio.on("backup_start")
 def handle_message(msg):
 
     bundle_id = msg["bundle_id"]
-    result_log = bundle_manager.create_backup(bundle_id)
+    result_log = bundle_manager.create_backup(bundle_id, emit_socket=True)
 
     if result_log.status == "FAILURE":
         emit("send_line", {"text": result_log.error_message})
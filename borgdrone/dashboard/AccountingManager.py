@@ -0,0 +1,56 @@
+import time
+from typing import Any, Dict, List
+
+from flask import current_app as app
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from borgdrone.extensions import borg_accounting, db
+from borgdrone.helpers import accounting
+
+from .models import BorgInvocation
+
+PRUNE_INTERVAL = 3600
+
+__last_prune = 0.0
+
+
+def save_records(records: List[Dict[str, Any]]) -> None:
+    """Store invocation records, the sink of `borg_accounting`.
+
+    Uses its own session, records arrive from worker threads in the middle
+    of other work and must not commit anybody else's changes.
+    """
+    global __last_prune  # pylint: disable=global-statement
+
+    with Session(db.engine) as session:
+        session.execute(insert(BorgInvocation), records)
+
+        if time.monotonic() - __last_prune > PRUNE_INTERVAL:
+            __last_prune = time.monotonic()
+            cutoff = time.time() - float(app.config.get("BORG_ACCOUNTING_DAYS", 30)) * 86400
+            session.execute(delete(BorgInvocation).where(BorgInvocation.started < cutoff))
+
+        session.commit()
+
+
+def get_records(hours: float = 24) -> List[Dict[str, Any]]:
+    columns = [column for column in BorgInvocation.__table__.columns if column.key != "id"]
+    stmt = select(*columns).where(BorgInvocation.started >= time.time() - hours * 3600)
+    return [dict(row) for row in db.session.execute(stmt).mappings()]
+
+
+def get_summary(hours: float = 24) -> Dict[str, Any]:
+    """Wall time percentiles per command kind and per repository.
+
+    Arguments:
+        hours -- Look back this far in the database. 0 summarizes the
+                 in-memory records of this process instead.
+    """
+    records = get_records(hours) if hours > 0 else borg_accounting.recent()
+
+    return {
+        "count": len(records),
+        "kinds": accounting.summarize(records, "kind"),
+        "repositories": accounting.summarize(records, "repository"),
+    }
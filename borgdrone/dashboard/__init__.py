@@ -1 +1,2 @@
+from .models import BorgInvocation
 from .views import dashboard_blueprint
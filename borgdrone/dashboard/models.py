@@ -0,0 +1,42 @@
+from typing import Any, Optional
+
+from sqlalchemy import Index
+from sqlalchemy.orm import Mapped, mapped_column
+
+from borgdrone.extensions import db
+
+
+class BorgInvocation(db.Model):
+    """Resource usage of one finished subprocess, see helpers.accounting."""
+
+    __tablename__ = "borginvocation"
+    __table_args__ = (Index("ix_borginvocation_started", "started"),)
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    kind: Mapped[str]  # info, list, create, check, delete, compact, ...
+    repository: Mapped[Optional[str]]
+    started: Mapped[float]  # unix time
+
+    wall_time: Mapped[float]  # seconds
+    user_time: Mapped[Optional[float]]  # CPU seconds in user mode
+    system_time: Mapped[Optional[float]]  # CPU seconds in kernel mode
+    # KiB, Linux reports at least the RSS of the Borgdrone process that spawned the child
+    max_rss: Mapped[Optional[int]]
+
+    returncode: Mapped[Optional[int]]
+    stdout_bytes: Mapped[int] = mapped_column(default=0)
+    stderr_bytes: Mapped[int] = mapped_column(default=0)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "repository": self.repository,
+            "started": self.started,
+            "wall_time": self.wall_time,
+            "user_time": self.user_time,
+            "system_time": self.system_time,
+            "max_rss": self.max_rss,
+            "returncode": self.returncode,
+            "stdout_bytes": self.stdout_bytes,
+            "stderr_bytes": self.stderr_bytes,
+        }
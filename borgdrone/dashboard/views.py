@@ -1,6 +1,9 @@
-from flask import Blueprint
+from flask import Blueprint, jsonify, request
+from flask_login import login_required
 
-from borgdrone.helpers import ResponseHelper
+from borgdrone.helpers import ResponseHelper, datahelpers, socketemitter
+
+from . import AccountingManager as accounting_manager
 
 dashboard_blueprint = Blueprint("dashboard", __name__, template_folder="templates")
 
@@ -9,3 +12,25 @@ dashboard_blueprint = Blueprint("dashboard", __name__, template_folder="template
 def index():
     rh = ResponseHelper(get_template="dashboard/index.html")
     return rh.respond()
+
+
+@dashboard_blueprint.route("/accounting")
+@login_required
+def accounting():
+    rh = ResponseHelper(get_template="dashboard/accounting.html")
+
+    hours = request.args.get("hours", 24, type=float)
+    rh.context_data = {
+        "hours": hours,
+        "summary": accounting_manager.get_summary(hours),
+        "socket": socketemitter.get_metrics(),
+        "convert_bytes": datahelpers.convert_bytes,
+    }
+    return rh.respond()
+
+
+@dashboard_blueprint.route("/socket-output")
+@login_required
+def socket_output():
+    """Totals of the live output sent to browsers since Borgdrone started, as JSON."""
+    return jsonify(socketemitter.get_metrics())
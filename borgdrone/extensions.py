@@ -4,6 +4,11 @@ from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 
+from borgdrone.borg.backend import WorkerBackend
+from borgdrone.borg.cache import ResultCache
+from borgdrone.borg.executor import BorgExecutor
+from borgdrone.helpers.accounting import Accountant
+
 
 class Base(DeclarativeBase):
     pass
@@ -13,3 +18,7 @@ db = SQLAlchemy(model_class=Base)
 login_manager = LoginManager()
 socketio = SocketIO(cors_allowed_origins="*")
 migrate = Migrate()
+borg_executor = BorgExecutor()
+borg_cache = ResultCache()
+borg_accounting = Accountant()
+borg_backend = WorkerBackend()
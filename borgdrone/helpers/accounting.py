@@ -0,0 +1,164 @@
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+from flask import Flask
+
+from borgdrone.logging import logger
+
+RING_SIZE = 1000
+PERCENTILES = (50, 95, 99)
+
+InvocationSink = Callable[[List[Dict[str, Any]]], None]
+
+
+class AccountedPopen(subprocess.Popen):
+    """Popen that reaps its child with `os.wait4`, keeping the child's resource usage in `rusage`.
+
+    Only a blocking `wait()` (also used by `communicate()` and the context
+    manager) collects it, `rusage` stays None if the child was reaped by
+    `poll()` or a wait with a timeout.
+    """
+
+    rusage: Optional[Any] = None
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if self.returncode is None and timeout is None:
+            try:
+                _, status, self.rusage = os.wait4(self.pid, 0)
+                self.returncode = os.waitstatus_to_exitcode(status)
+            except ChildProcessError:
+                # reaped elsewhere in the meantime, Popen knows how it ended
+                pass
+
+        return super().wait(timeout)
+
+
+def command_kind(cmd: List[str]) -> str:
+    """The borg subcommand (info, list, create, ...), or the program name for anything else."""
+    if not cmd:
+        return "unknown"
+
+    program = os.path.basename(cmd[0])
+    if program != "borg":
+        return program
+
+    for arg in cmd[1:]:
+        if arg and not arg.startswith("-"):
+            return arg
+
+    return program
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    """Nearest-rank percentile of already sorted `values`."""
+    if not values:
+        return None
+
+    rank = max(1, -(-len(values) * percent // 100))  # ceil without floats
+    return values[int(rank) - 1]
+
+
+def summarize(records: Iterable[Dict[str, Any]], group_by: str) -> List[Dict[str, Any]]:
+    """Wall time percentiles and resource totals per `group_by` value (kind or repository)."""
+    groups: Dict[Any, List[Dict[str, Any]]] = {}
+    for record in records:
+        groups.setdefault(record.get(group_by) or "-", []).append(record)
+
+    summary = []
+    for name, group in groups.items():
+        wall_times = sorted(record["wall_time"] for record in group)
+        cpu_times = [
+            (record["user_time"] or 0) + (record["system_time"] or 0)
+            for record in group
+            if record["user_time"] is not None
+        ]
+        row: Dict[str, Any] = {
+            group_by: name,
+            "count": len(group),
+            "failures": sum(1 for record in group if record["returncode"] not in (0, None)),
+            "total_time": round(sum(wall_times), 3),
+            "cpu_time": round(sum(cpu_times), 3) if cpu_times else None,
+            "max_rss": max((record["max_rss"] or 0 for record in group), default=0),
+            "output_bytes": sum(record["stdout_bytes"] + record["stderr_bytes"] for record in group),
+        }
+        for percent in PERCENTILES:
+            row[f"p{percent}"] = percentile(wall_times, percent)
+        summary.append(row)
+
+    # the biggest total cost first
+    return sorted(summary, key=lambda row: row["total_time"], reverse=True)
+
+
+class Accountant:
+    """Keeps a record of every finished subprocess.
+
+    The most recent `RING_SIZE` records stay in memory. When a sink is
+    configured, every record is also handed to it inside an application
+    context, to be stored in the database.
+    """
+
+    def __init__(self, maxlen: int = RING_SIZE):
+        self.records: Deque[Dict[str, Any]] = deque(maxlen=maxlen)
+        self.sink: Optional[InvocationSink] = None
+        self.app: Optional[Flask] = None
+
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask, sink: Optional[InvocationSink] = None) -> None:
+        with self._lock:
+            self.records = deque(self.records, maxlen=int(app.config.get("BORG_ACCOUNTING_RING", RING_SIZE)))
+        self.app = app
+        self.sink = sink
+        app.extensions["borg_accounting"] = self
+
+    def recent(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self.records)
+
+    def record(
+        self,
+        cmd: List[str],
+        started: float,
+        process: Any,
+        stdout_bytes: int = 0,
+        stderr_bytes: int = 0,
+        repository: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Record a finished process.
+
+        Arguments:
+            started -- `time.monotonic()` from just before the process was started.
+            process -- The finished Popen, None if it could not be started.
+        """
+        wall_time = time.monotonic() - started
+        rusage = getattr(process, "rusage", None)
+
+        record = {
+            "kind": command_kind(cmd),
+            "repository": repository,
+            "started": time.time() - wall_time,
+            "wall_time": round(wall_time, 6),
+            "user_time": rusage.ru_utime if rusage else None,
+            "system_time": rusage.ru_stime if rusage else None,
+            "max_rss": rusage.ru_maxrss if rusage else None,
+            "returncode": process.returncode if process is not None else None,
+            "stdout_bytes": stdout_bytes,
+            "stderr_bytes": stderr_bytes,
+        }
+
+        with self._lock:
+            self.records.append(record)
+
+        if self.sink and self.app:
+            with self.app.app_context():
+                try:
+                    self.sink([record])
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # accounting must never fail the command it measured
+                    logger.debug(f"Failed to store the invocation record: {e}", "red")
+
+        return record
@@ -1,73 +1,346 @@
+import os
 import subprocess
-from threading import Thread
+import threading
+import time
+from queue import Empty, Full, Queue
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
-from flask import copy_current_request_context
-from flask_socketio import emit
+from flask import has_request_context, request
 
-from borgdrone.extensions import socketio
+from borgdrone.borg.executor import BorgJob
+from borgdrone.extensions import borg_accounting, borg_backend, borg_executor
 from borgdrone.logging import logger
+from borgdrone.types import OptStr
 
+from .accounting import AccountedPopen
+from .limits import ResourceLimits
+from .pump import LineBuffer, PumpStats, iter_chunks, iter_pump, pump
+from .socketemitter import LineEmitter
 
-def popen(command: str | list, emit_socket: bool = False):
+STREAM_MAX_PENDING = 1000
+# chunks of up to 64 KiB, what a download holds in memory at most
+CHUNK_STREAM_MAX_PENDING = 16
+STREAM_POLL_INTERVAL = 0.5
+
+
+def __split(command: str | list) -> List[str]:
     if isinstance(command, str):
-        cmd = command.split(" ")
-    else:
-        # The list constants contain list items with aguments that need to be separated
-        command = " ".join(command)
-        cmd = command.split(" ")
+        return command.split(" ")
+
+    # The list constants contain list items with aguments that need to be separated
+    return " ".join(command).split(" ")
+
+
+def __environment(env: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    """The child environment: ours, with `env` layered on top."""
+    if env is None:
+        return None
+
+    return {**os.environ, **env}
+
+
+def __repository() -> OptStr:
+    """The repository of the executor job running on this thread."""
+    job = borg_executor.current_job()
+    return job.repository if job else None
+
+
+def popen(
+    command: str | list,
+    emit_socket: bool = False,
+    key: OptStr = None,
+    line_filter: Optional[Callable[[str, str], OptStr]] = None,
+    env: Optional[Dict[str, str]] = None,
+    limits: Optional[ResourceLimits] = None,
+) -> BorgJob:
+    """Run a long command on the borg executor, streaming its output to the log and the socket.
+
+    Arguments:
+        command -- The command to run.
+        emit_socket -- Send the output to the requesting client, batched into `send_line` frames.
+        key -- Jobs with the same key (repository path) run one after another.
+        line_filter -- Called with (stream, line), returns the text to show or None to drop the line.
+        env -- Variables added to the child's environment only.
+        limits -- Priority and cgroup limits the command is started with, see `ResourceLimits.prepare()`.
+
+    Returns:
+        BorgJob -- Resolves to the same dict as `run()`, stderr holding the last lines of output.
+    """
+    cmd = __split(command)
     logger.debug(cmd, "yellow")
 
-    @copy_current_request_context  # Ensures Flask context is copied to the new thread
-    def run_command():
+    # the socket id is only known in the handler's request context
+    sid = getattr(request, "sid", None) if emit_socket and has_request_context() else None
 
-        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
-            while True:
-                if not process.stdout:
-                    continue
+    def run_command() -> Dict[str, Any]:
+        buffer = LineBuffer()
+        emitter = LineEmitter(sid) if sid else None
 
-                output = process.stdout.readline()
-                if output:
-                    line = output.strip("\n")
-                    if emit_socket:
-                        emit("send_line", {"text": line})
-                    logger.borg_temp_log(line)
-                    logger.debug(line)
-                    continue
+        def on_line(stream: str, line: str) -> None:
+            if line_filter and (line := line_filter(stream, line)) is None:
+                return
+
+            if emitter:
+                emitter.push(line)
+
+            logger.borg_temp_log(line)
+            logger.debug(line)
+
+        started = time.monotonic()
+        try:
+            with AccountedPopen(
+                limits.wrap(cmd) if limits else cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=__environment(env),
+            ) as process:
+                borg_executor.attach_process(process)
+                stats = pump(process, on_line, buffer)
+            borg_accounting.record(
+                cmd,
+                started,
+                process,
+                stats.stream_bytes.get("stdout", 0),
+                stats.stream_bytes.get("stderr", 0),
+                __repository(),
+            )
+        finally:
+            if emitter:
+                emitter.close()
+                logger.debug(f"socket output: {emitter.metrics}", "yellow")
+
+        logger.debug(
+            f"{cmd[0]} exited with {process.returncode}: "
+            f"{stats.lines} lines in {stats.elapsed:.2f}s ({stats.lines_per_second:.0f} lines/s)",
+            "yellow",
+        )
+        if process.returncode != 0:
+            return {"stderr": "\n".join(buffer.tail(stream="stderr")), "returncode": int(process.returncode)}
+
+        return {"stdout": "\n".join(buffer.tail(stream="stdout")), "returncode": 0}
+
+    # Running the command on the executor to allow Flask to continue processing other events
+    return borg_executor.submit(key, run_command)
+
+
+def run(
+    command: str | list,
+    capture_output=True,
+    text_mode=True,
+    on_spawn: Optional[Callable[[subprocess.Popen], None]] = None,
+    env: Optional[Dict[str, str]] = None,
+    worker: bool = False,
+):
+    """Run a command and wait for it.
+
+    Arguments:
+        on_spawn -- Called with the process once it started.
+        env -- Variables added to the child's environment only.
+        worker -- Let a borg worker run the command, when that backend is enabled (see `WorkerBackend`).
+
+    Returns:
+        dict -- {"stdout": ..., "returncode": 0}, or {"stderr": ..., "returncode": ...} on failure.
+    """
+    cmd = __split(command)
+
+    if worker and capture_output and text_mode:
+        started = time.monotonic()
+        if (response := borg_backend.run(cmd, env, on_spawn)) is not None:
+            return __worker_result(cmd, started, response)
+
+    pipe = subprocess.PIPE if capture_output else None
+    started = time.monotonic()
+    with AccountedPopen(cmd, stdout=pipe, stderr=pipe, env=__environment(env)) as process:
+        if on_spawn:
+            on_spawn(process)
+        stdout, stderr = process.communicate()
+
+    borg_accounting.record(cmd, started, process, len(stdout or b""), len(stderr or b""), __repository())
+
+    if text_mode:
+        stdout = stdout.decode("utf-8", errors="replace") if stdout is not None else None
+        stderr = stderr.decode("utf-8", errors="replace") if stderr is not None else None
+
+    if process.returncode != 0:
+        return {"stderr": stderr, "returncode": int(process.returncode)}
+
+    return {"stdout": stdout, "returncode": int(process.returncode)}
 
-                if not process.stderr:
-                    continue
 
-                error = process.stderr.readline()
-                if error:
-                    line = error.strip("\n")  # Remove the newline from both sides
-                    if emit_socket:
-                        emit("send_line", {"text": f"{line}\n"})
+def __worker_result(cmd: List[str], started: float, response: Dict[str, Any]) -> Dict[str, Any]:
+    """`run()`'s result for a command a borg worker ran, recorded like a process of its own."""
+    # a worker serves many commands, the peak memory of one is not known
+    usage = SimpleNamespace(ru_utime=response["user_time"], ru_stime=response["system_time"], ru_maxrss=None)
+    process = SimpleNamespace(returncode=response["returncode"], rusage=usage)
 
-                    logger.borg_temp_log(line)
-                    logger.debug(line)
+    stdout, stderr = response["stdout"], response["stderr"]
+    borg_accounting.record(cmd, started, process, len(stdout.encode()), len(stderr.encode()), __repository())
+
+    if process.returncode != 0:
+        return {"stderr": stderr, "returncode": int(process.returncode)}
+
+    return {"stdout": stdout, "returncode": 0}
+
+
+class LineStream:
+    """Iterate over the stdout lines of a command that runs on the borg executor.
+
+    Lines travel through a bounded queue, so borg is paused instead of
+    buffering when the consumer is slow. Stopping the iteration early
+    (break, close(), garbage collection) terminates the command.
+
+    After the iteration finished, `result` holds the same dict as `run()`,
+    with stderr holding the last lines borg wrote to it.
+    """
+
+    END = object()
+
+    def __init__(
+        self,
+        cmd: List[str],
+        key: OptStr = None,
+        max_pending: int = STREAM_MAX_PENDING,
+        env: Optional[Dict[str, str]] = None,
+    ):
+        self.cmd = cmd
+        self.key = key
+        self.env = env  # the complete child environment, None inherits ours
+        self.result: Optional[Dict[str, Any]] = None
+        self.stats = PumpStats()
+
+        self._queue: Queue = Queue(maxsize=max_pending)
+        self._closed = threading.Event()
+        self._job: Optional[BorgJob] = None
+
+    def __iter__(self) -> Iterator[str]:
+        if borg_executor.current_job() is not None:
+            # already on a worker, there is nobody else to fill the queue
+            with borg_executor.hold(self.key):
+                yield from self.__produce_items()
+            return
+
+        self._job = borg_executor.submit(self.key, self.__produce)
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=STREAM_POLL_INTERVAL)
+                except Empty:
+                    if self._job.done and self._queue.empty():
+                        self._job.result()  # re-raises if the command could not run
+                        break
                     continue
 
-                if output == "" and process.poll() is not None:
+                if item is self.END:
                     break
+                yield item
+        finally:
+            self.close()
 
-    if emit_socket:
-        # Running the command in a new thread to allow Flask to continue processing other events
-        socketio.start_background_task(run_command)
-    else:
-        thread = Thread(target=run_command)
-        thread.start()
+    def close(self) -> None:
+        if self._closed.is_set():
+            return
 
+        self._closed.set()
+        if self._job is not None and not self._job.done:
+            self._job.cancel()
 
-def run(command: str | list, capture_output=True, text_mode=True):
-    if isinstance(command, str):
-        cmd = command.split(" ")
-    else:
-        # The list constants contain list items with aguments that need to be separated
-        command = " ".join(command)
-        cmd = command.split(" ")
-
-    try:
-        result = subprocess.run(cmd, capture_output=capture_output, text=text_mode, check=True)
-        return {"stdout": result.stdout, "returncode": int(result.returncode)}
-    except subprocess.CalledProcessError as e:
-        return {"stderr": e.stderr, "returncode": int(e.returncode)}
+    def _read(self, process: subprocess.Popen, buffer: LineBuffer, stats: PumpStats) -> Iterator[Any]:
+        """The items of the command's stdout, here its lines."""
+        for name, line in iter_pump(process, buffer, stats):
+            if name == "stdout":
+                yield line
+
+    def __produce_items(self) -> Iterator[Any]:
+        buffer = LineBuffer()
+        stats = self.stats
+        started = time.monotonic()
+        with AccountedPopen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env) as process:
+            borg_executor.attach_process(process)
+            try:
+                yield from self._read(process, buffer, stats)
+            finally:
+                if process.poll() is None:
+                    process.terminate()
+
+        job = borg_executor.current_job()
+        borg_accounting.record(
+            self.cmd,
+            started,
+            process,
+            stats.stream_bytes.get("stdout", 0),
+            stats.stream_bytes.get("stderr", 0),
+            job.repository if job else None,
+        )
+
+        if self._closed.is_set():
+            # stopped by the consumer, the exit status means nothing
+            return
+
+        if process.returncode != 0:
+            self.result = {"stderr": "\n".join(buffer.tail(stream="stderr")), "returncode": int(process.returncode)}
+        else:
+            self.result = {"stdout": "", "returncode": 0}
+
+    def __put(self, item: Any) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=STREAM_POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def __produce(self) -> None:
+        for item in self.__produce_items():
+            if not self.__put(item):
+                return
+        self.__put(self.END)
+
+
+class ChunkStream(LineStream):
+    """Iterate over the raw stdout of a command in chunks, for binary output like a tar stream.
+
+    Works like `LineStream`, with a queue of a few chunks only, so memory
+    stays constant however much the command writes. `stats` counts the
+    bytes read so far.
+    """
+
+    def __init__(
+        self,
+        cmd: List[str],
+        key: OptStr = None,
+        max_pending: int = CHUNK_STREAM_MAX_PENDING,
+        env: Optional[Dict[str, str]] = None,
+    ):
+        super().__init__(cmd, key, max_pending, env)
+
+    def _read(self, process: subprocess.Popen, buffer: LineBuffer, stats: PumpStats) -> Iterator[bytes]:
+        yield from iter_chunks(process, buffer, stats)
+
+
+def stream(command: str | list, key: OptStr = None, env: Optional[Dict[str, str]] = None) -> LineStream:
+    """Stream the stdout lines of a command, see `LineStream`.
+
+    Arguments:
+        key -- Jobs with the same key (repository path) run one after another.
+        env -- Variables added to the child's environment only.
+    """
+    cmd = __split(command)
+    logger.debug(cmd, "yellow")
+    return LineStream(cmd, key, env=__environment(env))
+
+
+def stream_chunks(
+    command: str | list, args: Optional[List[str]] = None, key: OptStr = None, env: Optional[Dict[str, str]] = None
+) -> ChunkStream:
+    """Stream the raw stdout of a command in chunks, see `ChunkStream`.
+
+    Arguments:
+        args -- Appended to the command as they are, so they may contain spaces (paths).
+        key -- Jobs with the same key (repository path) run one after another.
+        env -- Variables added to the child's environment only.
+    """
+    cmd = __split(command) + list(args or [])
+    logger.debug(cmd, "yellow")
+    return ChunkStream(cmd, key, env=__environment(env))
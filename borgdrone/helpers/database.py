@@ -3,12 +3,18 @@
 
 from typing import Optional, Type, TypeVar
 
-from sqlalchemy import func, select
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.schema import CreateTable
 
 from borgdrone.extensions import db
 
 T = TypeVar("T")
 
+# indexes the models no longer define, by table
+DROPPED_INDEXES = {
+    "archive": ["ix_archive_backupbundle_id_start"],
+}
+
 
 def count(model) -> int:
     stmt = select(func.count()).select_from(model)
@@ -29,3 +35,114 @@ def get_by_id(id_int: int, model: Type[T]) -> Optional[T]:
     stmt = select(model).where(model.id == id_int)
     instance = db.session.scalars(stmt).first()
     return instance
+
+
+def __remove_duplicate_archives() -> int:
+    """Delete all but the first row of every (repository_id, archive_id), before the unique index is built."""
+    result = db.session.execute(
+        text(
+            "DELETE FROM archive WHERE repository_id IS NOT NULL AND id NOT IN"
+            " (SELECT min(id) FROM archive WHERE repository_id IS NOT NULL GROUP BY repository_id, archive_id)"
+        )
+    )
+    db.session.commit()
+    return result.rowcount or 0
+
+
+def __column_types(table) -> dict:
+    """Declared types of the columns of `table` in the database, by column name."""
+    inspector = inspect(db.engine)
+    return {column["name"]: column["type"].compile(db.engine.dialect) for column in inspector.get_columns(table.name)}
+
+
+def __rebuild_table(table, old_types: dict) -> None:
+    """Recreate `table` from its model and copy the rows over, casting retyped columns.
+
+    SQLite cannot change the type of a column in place. The new table is
+    created without indexes, they are created afterwards like any missing index.
+    """
+    old_name = f"_{table.name}_old"
+    copied = []
+    for column in table.columns:
+        if column.name not in old_types:
+            continue
+
+        new_type = column.type.compile(db.engine.dialect)
+        if old_types[column.name] == new_type:
+            copied.append((column.name, f'"{column.name}"'))
+        else:
+            copied.append((column.name, f"CAST(NULLIF(\"{column.name}\", '') AS {new_type})"))
+
+    with db.engine.begin() as connection:
+        # keep foreign keys of other tables pointing at the new table
+        connection.exec_driver_sql("PRAGMA legacy_alter_table = ON")
+        connection.exec_driver_sql(f'ALTER TABLE "{table.name}" RENAME TO "{old_name}"')
+        for index in inspect(connection).get_indexes(old_name):
+            connection.exec_driver_sql(f'DROP INDEX "{index["name"]}"')
+
+        connection.execute(CreateTable(table))
+        names = ", ".join(f'"{name}"' for name, _ in copied)
+        values = ", ".join(value for _, value in copied)
+        connection.exec_driver_sql(
+            f'INSERT INTO "{table.name}" ({names}) SELECT {values} FROM "{old_name}" ORDER BY rowid'
+        )
+        connection.exec_driver_sql(f'DROP TABLE "{old_name}"')
+        connection.exec_driver_sql("PRAGMA legacy_alter_table = OFF")
+
+
+def upgrade_schema() -> list:
+    """Bring the tables of an existing database up to date with the models.
+
+    `db.create_all()` only creates tables that do not exist yet. Here,
+    columns added to a model later are added to its table, tables with
+    columns whose type changed are rebuilt, missing indexes are created
+    and those in `DROPPED_INDEXES` are removed. Safe to run on every start,
+    nothing is done when the database matches the models.
+
+    Returns:
+        list -- What was changed: rebuilt tables, added columns as `table.column`, and created or dropped indexes.
+    """
+    existing_tables = set(inspect(db.engine).get_table_names())
+
+    changed = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        old_types = __column_types(table)
+        retyped = [
+            column.name
+            for column in table.columns
+            if column.name in old_types and old_types[column.name] != column.type.compile(db.engine.dialect)
+        ]
+        if retyped:
+            __rebuild_table(table, old_types)
+            changed.append(table.name)
+        else:
+            with db.engine.begin() as connection:
+                for column in table.columns:
+                    if column.name in old_types:
+                        continue
+                    # added as nullable, existing rows have no value for it
+                    column_type = column.type.compile(db.engine.dialect)
+                    connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+                    changed.append(f"{table.name}.{column.name}")
+
+        existing = {index["name"] for index in inspect(db.engine).get_indexes(table.name)}
+        for name in DROPPED_INDEXES.get(table.name, []):
+            if name in existing:
+                with db.engine.begin() as connection:
+                    connection.exec_driver_sql(f'DROP INDEX "{name}"')
+                changed.append(name)
+
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+
+            if index.name == "uq_archive_repository_id_archive_id":
+                __remove_duplicate_archives()
+
+            index.create(db.engine, checkfirst=True)
+            changed.append(index.name)
+
+    return changed
@@ -1,5 +1,6 @@
 import hashlib
 from datetime import datetime
+from typing import Optional
 
 
 def hash_data(data) -> str:
@@ -24,6 +25,11 @@ def convert_bytes(size_in_bytes: int, base: int = 1000) -> str:
     return f"{size:.2f} {units[unit_index]}"
 
 
+def convert_bytes_delta(delta: int, base: int = 1000) -> str:
+    """`convert_bytes` of a size difference, with its sign."""
+    return f"{'-' if delta < 0 else '+'}{convert_bytes(abs(delta), base)}"
+
+
 def convert_rwx_to_octal(rwx: str) -> str:
     """Convert a string representation of file permissions (rwx) to an octal representation."""
     rwx_in = [rwx[1:4], rwx[4:7], rwx[7:]]
@@ -54,3 +60,25 @@ def ISO8601_to_human(iso_date_str: str) -> str:
 
     # Convert to human-readable format
     return date_obj.strftime("%Y/%m/%d at %H:%M:%S")
+
+
+def epoch_to_human(epoch: Optional[int]) -> str:
+    """Format seconds since the epoch like `ISO8601_to_human`, in local time."""
+    if epoch is None:
+        return ""
+
+    return datetime.fromtimestamp(epoch).strftime("%Y/%m/%d at %H:%M:%S")
+
+
+def ISO8601_to_epoch(iso_date_str: Optional[str]) -> Optional[int]:
+    """Seconds since the epoch of an ISO 8601 date string, None if it is empty or invalid.
+
+    Strings without a timezone are local time, as borg writes them.
+    """
+    if not iso_date_str:
+        return None
+
+    try:
+        return int(datetime.fromisoformat(iso_date_str).timestamp())
+    except ValueError:
+        return None
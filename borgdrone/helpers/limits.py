@@ -0,0 +1,199 @@
+import os
+import re
+import shutil
+from typing import Any, Dict, List, Optional
+
+IONICE_CLASSES = {"best-effort": "2", "idle": "3"}
+CPU_PERIOD = 100000  # microseconds, the kernel's default cpu.max period
+IO_UNLIMITED = "rbps=max wbps=max riops=max wiops=max"
+
+IO_MAX_LINE = re.compile(r"^\d+:\d+( (rbps|wbps|riops|wiops)=(\d+|max))+$")
+MEMORY_MAX = re.compile(r"^(\d+[KMGT]?|max)$")
+
+
+def validate(
+    nice: Optional[int] = None,
+    ionice_class: Optional[str] = None,
+    ionice_priority: Optional[int] = None,
+    cpu_quota: Optional[int] = None,
+    io_max: Optional[str] = None,
+    memory_max: Optional[str] = None,
+) -> Optional[str]:
+    """The first problem with the limits, None if they are all valid."""
+    if nice is not None and not 0 <= nice <= 19:
+        # negative values need privileges borgdrone should not have
+        return "Nice level must be between 0 and 19."
+
+    if ionice_class and ionice_class not in IONICE_CLASSES:
+        return f"IO class must be one of: {', '.join(IONICE_CLASSES)}."
+
+    if ionice_priority is not None and not 0 <= ionice_priority <= 7:
+        return "IO priority must be between 0 and 7."
+
+    if cpu_quota is not None and cpu_quota <= 0:
+        return "CPU quota must be a positive percentage of one CPU."
+
+    for line in (io_max or "").splitlines():
+        if line.strip() and not IO_MAX_LINE.match(line.strip()):
+            return f"Invalid io.max line '{line.strip()}', expected 'MAJOR:MINOR wbps=N rbps=N ...'."
+
+    if memory_max and not MEMORY_MAX.match(memory_max):
+        return "Memory limit must be a number of bytes with an optional K, M, G or T suffix."
+
+    return None
+
+
+class ResourceLimits:
+    """CPU/IO priority and cgroup v2 limits for a borg process.
+
+    Priorities are applied by starting borg through `nice` and `ionice`.
+    When a cgroup is given, a shell moves itself into it and then execs the
+    rest of the command, so borg and everything it starts (ssh) is limited
+    from its first instruction on.
+
+    The cgroup's parent must be delegated to the user borgdrone runs as,
+    with the cpu, io and memory controllers available to it.
+    """
+
+    def __init__(
+        self,
+        nice: Optional[int] = None,
+        ionice_class: Optional[str] = None,
+        ionice_priority: Optional[int] = None,
+        cpu_quota: Optional[int] = None,
+        io_max: Optional[str] = None,
+        memory_max: Optional[str] = None,
+        cgroup: Optional[str] = None,
+    ):
+        self.nice = nice
+        self.ionice_class = ionice_class or None
+        self.ionice_priority = ionice_priority
+        self.cpu_quota = cpu_quota
+        self.io_max = io_max or None
+        self.memory_max = memory_max or None
+        self.cgroup = cgroup or None
+
+        self.errors: List[str] = []
+        self._cgroup_ready = False
+
+    @property
+    def wants_cgroup(self) -> bool:
+        return bool(self.cgroup and (self.cpu_quota or self.io_max or self.memory_max))
+
+    @staticmethod
+    def __write(path: str, value: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(value)
+
+    def __controllers(self) -> List[str]:
+        controllers = []
+        if self.cpu_quota:
+            controllers.append("cpu")
+        if self.io_max:
+            controllers.append("io")
+        if self.memory_max:
+            controllers.append("memory")
+        return controllers
+
+    def prepare(self) -> Dict[str, Any]:
+        """Create the cgroup and write its limits, then return the effective limits.
+
+        Limits that could not be set are listed in `errors` and left out of
+        the command, the backup runs without them.
+        """
+        self.errors = []
+        self._cgroup_ready = False
+
+        if not self.cgroup and self.__controllers():
+            self.errors.append("No cgroup configured (BORG_CGROUP_ROOT), CPU, IO and memory limits not applied.")
+
+        if self.wants_cgroup:
+            assert self.cgroup
+            try:
+                os.makedirs(self.cgroup, exist_ok=True)
+                parent = os.path.dirname(self.cgroup.rstrip("/"))
+                self.__write(
+                    os.path.join(parent, "cgroup.subtree_control"), " ".join(f"+{c}" for c in self.__controllers())
+                )
+
+                # limits removed from the bundle are reset, the files only exist for enabled controllers
+                self.__set("cpu.max", self.__cpu_max(), f"max {CPU_PERIOD}")
+                self.__set("memory.max", self.memory_max, "max")
+                for line in (self.__read("io.max") or "").splitlines():
+                    self.__write(os.path.join(self.cgroup, "io.max"), f"{line.split(' ')[0]} {IO_UNLIMITED}")
+                for line in (self.io_max or "").splitlines():
+                    if line.strip():
+                        self.__write(os.path.join(self.cgroup, "io.max"), line.strip())
+
+                self._cgroup_ready = True
+            except OSError as e:
+                self.errors.append(f"cgroup {self.cgroup}: {e.strerror or e}")
+
+        if self.ionice_class and not shutil.which("ionice"):
+            self.errors.append("ionice is not installed, IO priority not applied.")
+
+        return self.effective()
+
+    def __set(self, name: str, value: Optional[str], unlimited: str) -> None:
+        assert self.cgroup
+        path = os.path.join(self.cgroup, name)
+        if value or os.path.exists(path):
+            self.__write(path, value or unlimited)
+
+    def __cpu_max(self) -> Optional[str]:
+        if not self.cpu_quota:
+            return None
+        return f"{self.cpu_quota * CPU_PERIOD // 100} {CPU_PERIOD}"
+
+    def __read(self, name: str) -> Optional[str]:
+        assert self.cgroup
+        try:
+            with open(os.path.join(self.cgroup, name), encoding="utf-8") as file:
+                return file.read().strip() or None
+        except OSError:
+            return None
+
+    def wrap(self, cmd: List[str]) -> List[str]:
+        """`cmd`, started through the wrappers that apply the limits."""
+        wrapped = list(cmd)
+
+        if self.ionice_class and shutil.which("ionice"):
+            ionice = ["ionice", "-c", IONICE_CLASSES[self.ionice_class]]
+            if self.ionice_class == "best-effort" and self.ionice_priority is not None:
+                ionice += ["-n", str(self.ionice_priority)]
+            wrapped = ionice + wrapped
+
+        if self.nice:
+            wrapped = ["nice", "-n", str(self.nice)] + wrapped
+
+        if self._cgroup_ready:
+            assert self.cgroup
+            procs = os.path.join(self.cgroup, "cgroup.procs")
+            wrapped = ["sh", "-c", 'echo $$ > "$0" && exec "$@"', procs] + wrapped
+
+        return wrapped
+
+    def effective(self) -> Dict[str, Any]:
+        """The limits the next borg process will run with, as read back from the cgroup."""
+        ionice = None
+        if self.ionice_class and shutil.which("ionice"):
+            ionice = self.ionice_class
+            if self.ionice_class == "best-effort" and self.ionice_priority is not None:
+                ionice = f"{ionice} {self.ionice_priority}"
+
+        data: Dict[str, Any] = {
+            "nice": self.nice or 0,
+            "ionice": ionice,
+            "cgroup": self.cgroup if self._cgroup_ready else None,
+            "cpu_max": None,
+            "io_max": None,
+            "memory_max": None,
+            "errors": self.errors,
+        }
+
+        if self._cgroup_ready:
+            data["cpu_max"] = self.__read("cpu.max")
+            data["io_max"] = self.__read("io.max")
+            data["memory_max"] = self.__read("memory.max")
+
+        return data
@@ -0,0 +1,228 @@
+import os
+import selectors
+import subprocess
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+CHUNK_SIZE = 65536
+MAX_LINE_LENGTH = 65536
+MAX_BUFFERED_LINES = 1000
+
+# (stream name, line)
+LineCallback = Callable[[str, str], None]
+
+
+class PumpStats:
+    """Throughput counters for a single pumped process."""
+
+    def __init__(self):
+        self.lines: int = 0
+        self.bytes: int = 0
+        self.stream_bytes: Dict[str, int] = {}
+        self.truncated_lines: int = 0
+        self.started: float = time.monotonic()
+        self.finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    @property
+    def lines_per_second(self) -> float:
+        if not (elapsed := self.elapsed):
+            return 0.0
+        return self.lines / elapsed
+
+    @property
+    def bytes_per_second(self) -> float:
+        if not (elapsed := self.elapsed):
+            return 0.0
+        return self.bytes / elapsed
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "truncated_lines": self.truncated_lines,
+            "elapsed": round(self.elapsed, 3),
+            "lines_per_second": round(self.lines_per_second, 1),
+            "bytes_per_second": round(self.bytes_per_second, 1),
+        }
+
+
+class LineBuffer:
+    """Keeps only the most recent lines of a process, so memory stays bounded."""
+
+    def __init__(self, maxlen: int = MAX_BUFFERED_LINES):
+        self.lines: Deque[Tuple[str, str]] = deque(maxlen=maxlen)
+        self.dropped: int = 0
+
+    def append(self, stream: str, line: str) -> None:
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append((stream, line))
+
+    def tail(self, count: int = 10, stream: Optional[str] = None) -> list[str]:
+        lines = [line for name, line in self.lines if stream is None or name == stream]
+        return lines[-count:]
+
+
+def __split_chunk(data: bytes) -> Tuple[list[bytes], bytes]:
+    """Split `data` into complete lines and the unterminated remainder.
+
+    Borg terminates progress lines with a carriage return, so both
+    `\\r` and `\\n` end a line. A trailing `\\r` stays in the remainder,
+    it may be the first half of a `\\r\\n` that the next read completes.
+    """
+    end = len(data) - 1 if data.endswith(b"\r") else len(data)
+    cut = max(data.rfind(b"\n", 0, end), data.rfind(b"\r", 0, end))
+    if cut < 0:
+        return [], data
+
+    return data[: cut + 1].splitlines(), data[cut + 1 :]
+
+
+def iter_pump(
+    process: subprocess.Popen,
+    buffer: Optional[LineBuffer] = None,
+    stats: Optional[PumpStats] = None,
+    chunk_size: int = CHUNK_SIZE,
+    max_line_length: int = MAX_LINE_LENGTH,
+) -> Iterator[Tuple[str, str]]:
+    """Yield `(stream, line)` from stdout and stderr of `process` until both are closed.
+
+    Both pipes are watched with a selector and read without blocking in
+    `chunk_size` pieces, so a chatty stderr can never stall behind a quiet
+    stdout.
+
+    Arguments:
+        process -- A process started with binary (not text mode) pipes.
+        buffer -- Optional LineBuffer that receives a copy of every line.
+        stats -- Optional PumpStats that is updated while reading.
+        max_line_length -- Unterminated data longer than this is flushed as a line.
+    """
+    stats = stats if stats is not None else PumpStats()
+    partial: Dict[str, bytes] = {}
+
+    def decode(name: str, raw: bytes) -> Tuple[str, str]:
+        line = raw.decode("utf-8", errors="replace")
+        stats.lines += 1
+        if buffer is not None:
+            buffer.append(name, line)
+        return name, line
+
+    with selectors.DefaultSelector() as selector:
+        for name, stream in (("stdout", process.stdout), ("stderr", process.stderr)):
+            if stream is None:
+                continue
+            os.set_blocking(stream.fileno(), False)
+            selector.register(stream.fileno(), selectors.EVENT_READ, name)
+            partial[name] = b""
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                name = key.data
+                try:
+                    chunk = os.read(key.fd, chunk_size)
+                except BlockingIOError:
+                    continue
+
+                if not chunk:
+                    # EOF, flush whatever is left without a line ending
+                    selector.unregister(key.fd)
+                    for raw in partial[name].splitlines():
+                        yield decode(name, raw)
+                    partial[name] = b""
+                    continue
+
+                stats.bytes += len(chunk)
+                stats.stream_bytes[name] = stats.stream_bytes.get(name, 0) + len(chunk)
+                lines, partial[name] = __split_chunk(partial[name] + chunk)
+                for raw in lines:
+                    yield decode(name, raw)
+
+                if len(partial[name]) > max_line_length:
+                    stats.truncated_lines += 1
+                    yield decode(name, partial[name].rstrip(b"\r"))
+                    partial[name] = b""
+
+    process.wait()
+    stats.finished = time.monotonic()
+
+
+def iter_chunks(
+    process: subprocess.Popen,
+    buffer: Optional[LineBuffer] = None,
+    stats: Optional[PumpStats] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """Yield the stdout of `process` as it is read, in chunks of at most `chunk_size` bytes.
+
+    For binary output like a tar stream. stdout is passed through
+    untouched, stderr is split into lines and only kept in `buffer`, read
+    from the same selector so neither pipe can stall the other.
+    """
+    stats = stats if stats is not None else PumpStats()
+    stderr_partial = b""
+
+    with selectors.DefaultSelector() as selector:
+        for name, stream in (("stdout", process.stdout), ("stderr", process.stderr)):
+            if stream is None:
+                continue
+            os.set_blocking(stream.fileno(), False)
+            selector.register(stream.fileno(), selectors.EVENT_READ, name)
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                name = key.data
+                try:
+                    chunk = os.read(key.fd, chunk_size)
+                except BlockingIOError:
+                    continue
+
+                if not chunk:
+                    selector.unregister(key.fd)
+                    if name == "stderr" and buffer is not None:
+                        for raw in stderr_partial.splitlines():
+                            buffer.append(name, raw.decode("utf-8", errors="replace"))
+                    continue
+
+                stats.bytes += len(chunk)
+                stats.stream_bytes[name] = stats.stream_bytes.get(name, 0) + len(chunk)
+                if name == "stdout":
+                    yield chunk
+                    continue
+
+                lines, stderr_partial = __split_chunk(stderr_partial + chunk)
+                stats.lines += len(lines)
+                if buffer is not None:
+                    for raw in lines:
+                        buffer.append(name, raw.decode("utf-8", errors="replace"))
+                stderr_partial = stderr_partial[-MAX_LINE_LENGTH:]
+
+    process.wait()
+    stats.finished = time.monotonic()
+
+
+def pump(
+    process: subprocess.Popen,
+    on_line: LineCallback,
+    buffer: Optional[LineBuffer] = None,
+    chunk_size: int = CHUNK_SIZE,
+    max_line_length: int = MAX_LINE_LENGTH,
+) -> PumpStats:
+    """Read stdout and stderr of `process` until both are closed, see `iter_pump`.
+
+    Arguments:
+        on_line -- Called for every line with the stream name (`stdout` or `stderr`).
+
+    Returns:
+        PumpStats -- line and byte counters for the run.
+    """
+    stats = PumpStats()
+    for name, line in iter_pump(process, buffer, stats, chunk_size, max_line_length):
+        on_line(name, line)
+
+    return stats
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from borgdrone.extensions import socketio
+
+FRAME_INTERVAL = 0.1
+MAX_FRAME_BYTES = 64 * 1024
+MAX_PENDING_LINES = 10000
+MAX_UNACKED_FRAMES = 2
+ACK_TIMEOUT = 5.0
+
+# totals across all emitters since the application started
+METRICS: Dict[str, int] = {
+    "lines_in": 0,
+    "lines_sent": 0,
+    "lines_coalesced": 0,
+    "lines_dropped": 0,
+    "frames_sent": 0,
+}
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Dict[str, int]:
+    """A copy of the totals across all emitters."""
+    with _metrics_lock:
+        return dict(METRICS)
+
+
+class LineEmitter:
+    """Sends output lines to one Socket.IO client in batched frames.
+
+    - Lines are collected and sent as one frame every `interval` seconds,
+      or as soon as `max_frame_bytes` are waiting.
+    - Every frame asks the client for an acknowledgement. While
+      `max_unacked` frames are unanswered nothing else is sent, so a slow
+      browser slows down the frames instead of growing the server's buffers.
+    - At most `max_pending` lines wait in the queue. When the client falls
+      behind the oldest lines are dropped, and with `policy="summarize"` a
+      marker line tells the user how many were skipped.
+    """
+
+    def __init__(
+        self,
+        sid: str,
+        event: str = "send_line",
+        namespace: str = "/",
+        interval: float = FRAME_INTERVAL,
+        max_frame_bytes: int = MAX_FRAME_BYTES,
+        max_pending: int = MAX_PENDING_LINES,
+        max_unacked: int = MAX_UNACKED_FRAMES,
+        policy: str = "summarize",
+    ):
+        self.sid = sid
+        self.event = event
+        self.namespace = namespace
+        self.interval = interval
+        self.max_frame_bytes = max_frame_bytes
+        self.max_unacked = max_unacked
+        self.policy = policy
+
+        self.metrics: Dict[str, int] = {key: 0 for key in METRICS}
+
+        self._pending: Deque[str] = deque(maxlen=max_pending)
+        self._pending_bytes = 0
+        self._skipped = 0  # dropped since the last summary line
+        self._unacked: Dict[int, float] = {}  # frame number -> time sent
+        self._frame = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._task: Any = socketio.start_background_task(self.__run)
+
+    def push(self, line: str) -> None:
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                dropped = self._pending.popleft()
+                self._pending_bytes -= len(dropped) + 1
+                self._skipped += 1
+                self.__count("lines_dropped")
+
+            self._pending.append(line)
+            self._pending_bytes += len(line) + 1
+            self.__count("lines_in")
+
+    def close(self, timeout: float = ACK_TIMEOUT) -> None:
+        """Send what is left and stop, waiting up to `timeout` for a slow client."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._pending and not self._skipped:
+                    break
+            socketio.sleep(self.interval)
+
+        self._closed.set()
+        self._task.join()
+
+    def __count(self, key: str, amount: int = 1) -> None:
+        self.metrics[key] += amount
+        with _metrics_lock:
+            METRICS[key] += amount
+
+    def __ack(self, frame: int) -> None:
+        with self._lock:
+            self._unacked.pop(frame, None)
+
+    def __can_send(self) -> bool:
+        # a client that never answers must not stall the stream forever
+        now = time.monotonic()
+        for frame, sent in list(self._unacked.items()):
+            if now - sent > ACK_TIMEOUT:
+                del self._unacked[frame]
+
+        return len(self._unacked) < self.max_unacked
+
+    def __next_frame(self) -> Optional[str]:
+        lines = []
+        size = 0
+
+        if self._skipped and self.policy == "summarize":
+            lines.append(f"[... {self._skipped} lines skipped, the connection is too slow ...]")
+        self._skipped = 0
+
+        while self._pending and size < self.max_frame_bytes:
+            line = self._pending.popleft()
+            self._pending_bytes -= len(line) + 1
+            size += len(line) + 1
+            lines.append(line)
+
+        if not lines:
+            return None
+
+        self.__count("lines_sent", len(lines))
+        self.__count("lines_coalesced", len(lines) - 1)
+        self.__count("frames_sent")
+        return "\n".join(lines) + "\n"
+
+    def __send(self) -> None:
+        while True:
+            with self._lock:
+                if not self.__can_send() or not (text := self.__next_frame()):
+                    return
+
+                self._frame += 1
+                frame = self._frame
+                self._unacked[frame] = time.monotonic()
+
+            socketio.emit(
+                self.event,
+                {"text": text},
+                to=self.sid,
+                namespace=self.namespace,
+                callback=lambda *_, frame=frame: self.__ack(frame),
+            )
+
+            with self._lock:
+                if self._pending_bytes < self.max_frame_bytes:
+                    # the rest waits for the next tick, so it can be coalesced
+                    return
+
+    def __run(self) -> None:
+        while not self._closed.is_set():
+            self.__send()
+            socketio.sleep(self.interval)
@@ -19,7 +19,7 @@ class BorgdroneEvent(Generic[T]):
         self.status: str = "NOSTATUS"
         # SUCCESS, FAILURE
 
-        self.message: Optional[str]
+        self.message: str = ""
         self.error_message: str = ""
         # for toasts and logs
 
@@ -1,5 +1,7 @@
-from typing import Optional
+import asyncio
+from typing import Any, Dict, Optional
 
+from flask import current_app as app
 from flask_login import current_user
 from sqlalchemy import select
 
@@ -9,6 +11,7 @@ from borgdrone.helpers.datahelpers import ISO8601_to_human
 from borgdrone.logging import BorgdroneEvent, logger
 from borgdrone.types import OptInt, OptStr
 
+from . import StatsManager as stats_manager
 from .models import ListRepository, OptRepository, Repository
 
 
@@ -62,6 +65,29 @@ def create_repo(path: str, encryption: str) -> BorgdroneEvent[Repository]:
     return _log.return_success("Repository created.")
 
 
+def __apply_stats(instance: Repository, stats: Dict[str, Any]) -> Repository:
+    """Copy `borg info --json` repository output onto `instance`."""
+    instance.repo_id = stats["repository"]["id"]
+
+    date_str = stats["repository"]["last_modified"]
+    instance.last_modified = ISO8601_to_human(date_str)
+    instance.encryption_mode = stats["encryption"]["mode"]
+    instance.encryption_keyfile = stats["encryption"].get("keyfile", None)
+    instance.cache_path = stats["cache"]["path"]
+    apply_cache_stats(instance, stats["cache"]["stats"])
+    instance.security_dir = stats["security_dir"]
+
+    return instance
+
+
+def apply_cache_stats(instance: Repository, cache_stats: Dict[str, Any]) -> Repository:
+    """Copy the `cache.stats` of borg's JSON output onto `instance`, `borg info` and `borg create` report them."""
+    for metric in stats_manager.METRICS:
+        setattr(instance, metric, cache_stats[metric])
+
+    return instance
+
+
 def get_repository_info(path: str, passphrase: Optional[str] = None) -> BorgdroneEvent[Optional[Repository]]:
     """Get information about a repository.
 
@@ -92,20 +118,7 @@ def get_repository_info(path: str, passphrase: Optional[str] = None) -> Borgdron
 
         return _log.return_failure(error_message)
 
-    instance.repo_id = stats["repository"]["id"]
-
-    date_str = stats["repository"]["last_modified"]
-    instance.last_modified = ISO8601_to_human(date_str)
-    instance.encryption_mode = stats["encryption"]["mode"]
-    instance.encryption_keyfile = stats["encryption"].get("keyfile", None)
-    instance.cache_path = stats["cache"]["path"]
-    instance.total_chunks = stats["cache"]["stats"]["total_chunks"]
-    instance.total_unique_chunks = stats["cache"]["stats"]["total_unique_chunks"]
-    instance.total_size = stats["cache"]["stats"]["total_size"]
-    instance.total_csize = stats["cache"]["stats"]["total_csize"]
-    instance.unique_size = stats["cache"]["stats"]["unique_size"]
-    instance.unique_csize = stats["cache"]["stats"]["unique_csize"]
-    instance.security_dir = stats["security_dir"]
+    __apply_stats(instance, stats)
 
     _log.set_data(instance)
     return _log.return_success("Repository info retrieved.")
@@ -128,6 +141,7 @@ def delete_repo(db_id: int) -> BorgdroneEvent[None]:
     if not instance:
         return _log.not_found_message("Repository")
 
+    stats_manager.remove_repository(instance.id)
     instance.delete()
     logger.success("Repository deleted from borgdrone database.")
 
@@ -173,10 +187,49 @@ def update_repository_info(
     instance.security_dir = data.security_dir
 
     db.session.commit()
+    stats_manager.record_snapshot(instance, "info")
 
     return _log.return_success("Repository info updated.")
 
 
+def update_all_repository_info() -> BorgdroneEvent[None]:
+    """Refresh the stats of all of the user's repositories.
+
+    The `borg info` calls are queued together, at most BORG_MAX_QUERIES at a
+    time, and run in parallel on the borg executor, one per repository.
+    """
+    _log = BorgdroneEvent[None]()
+    _log.event = "RepositoryManager.update_all_repository_info"
+
+    if not (instances := get_all()):
+        return _log.return_success("No repositories to update.")
+
+    limit = int(app.config.get("BORG_MAX_QUERIES", 8))
+    results = asyncio.run(
+        borg_runner.gather_repository_info([(instance.path, instance.passphrase) for instance in instances], limit)
+    )
+
+    failed = []
+    for instance, result_log in zip(instances, results):
+        if not (stats := result_log.get_data()):
+            # Possible:
+            # - Borg.PassphraseWrong
+            # - Borg.Repository.DoesNotExist
+            logger.debug(f"{instance.path}: {result_log.error_message}", "red")
+            failed.append(instance.path)
+            continue
+
+        __apply_stats(instance, stats)
+        stats_manager.record_snapshot(instance, "info", commit=False)
+
+    db.session.commit()
+
+    if failed:
+        return _log.return_failure(f"Failed to update {len(failed)} of {len(instances)} repositories.")
+
+    return _log.return_success(f"Updated {len(instances)} repositories.")
+
+
 def import_repo(path: str, passphrase: Optional[str] = None) -> BorgdroneEvent[Repository]:
     _log = BorgdroneEvent[Repository]()
     _log.event = "RepositoryManager.import_repo"
@@ -198,6 +251,7 @@ def import_repo(path: str, passphrase: Optional[str] = None) -> BorgdroneEvent[R
 
     instance.user_id = current_user.id
     instance.commit()
+    stats_manager.record_snapshot(instance, "info")
 
     _log.set_data(instance)
     return _log.return_success("Repository imported to borgdrone")
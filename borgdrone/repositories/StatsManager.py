@@ -0,0 +1,134 @@
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from borgdrone.extensions import db
+
+from .models import Repository, RepositoryStats, RepositoryStatsRollup
+
+PERIODS = ("hour", "day", "week")
+
+# the borg cache stats every snapshot keeps
+METRICS = ("total_chunks", "total_unique_chunks", "total_size", "total_csize", "unique_size", "unique_csize")
+
+
+def bucket_start(taken: int, period: str) -> int:
+    """Start of the hour, day or week (from Monday) that `taken` falls in, in local time."""
+    start = datetime.fromtimestamp(taken).replace(minute=0, second=0, microsecond=0)
+    if period != "hour":
+        start = start.replace(hour=0)
+    if period == "week":
+        start -= timedelta(days=start.weekday())
+    return int(start.timestamp())
+
+
+def __upsert_rollups(repository_id: int, taken: int, values: Dict[str, Any]) -> None:
+    """Fold one snapshot into the rollup of every period, a single statement for all of them."""
+    rollup = RepositoryStatsRollup.__table__.c
+    stmt = sqlite_insert(RepositoryStatsRollup).values(
+        [
+            {
+                "repository_id": repository_id,
+                "period": period,
+                "bucket": bucket_start(taken, period),
+                "samples": 1,
+                "first_taken": taken,
+                "last_taken": taken,
+                "min_unique_csize": values["unique_csize"],
+                "max_unique_csize": values["unique_csize"],
+                **values,
+            }
+            for period in PERIODS
+        ]
+    )
+    new = stmt.excluded
+
+    # snapshots normally arrive in order, one that does not only widens the range
+    newer = new.last_taken >= rollup.last_taken
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[rollup.repository_id, rollup.period, rollup.bucket],
+        set_={
+            "samples": rollup.samples + 1,
+            "first_taken": func.min(rollup.first_taken, new.first_taken),
+            "last_taken": func.max(rollup.last_taken, new.last_taken),
+            **{metric: case((newer, new[metric]), else_=rollup[metric]) for metric in METRICS},
+            # min() and max() of SQLite are NULL as soon as one side is
+            "min_unique_csize": func.min(
+                func.coalesce(rollup.min_unique_csize, new.min_unique_csize),
+                func.coalesce(new.min_unique_csize, rollup.min_unique_csize),
+            ),
+            "max_unique_csize": func.max(
+                func.coalesce(rollup.max_unique_csize, new.max_unique_csize),
+                func.coalesce(new.max_unique_csize, rollup.max_unique_csize),
+            ),
+        },
+    )
+    db.session.execute(stmt)
+
+
+def record_snapshot(repository: Repository, source: str, taken: Optional[int] = None, commit: bool = True) -> None:
+    """Append the repository's current stats to its history and its hourly, daily and weekly rollups.
+
+    Arguments:
+        source -- What refreshed the stats: info (`borg info`) or archive (a new archive).
+        taken -- When the stats were read, now by default.
+    """
+    if repository.unique_csize is None:
+        # never read from borg, there is nothing to record
+        return
+
+    taken = int(time.time()) if taken is None else taken
+    values = {metric: getattr(repository, metric) for metric in METRICS}
+
+    db.session.execute(
+        insert(RepositoryStats).values(repository_id=repository.id, taken=taken, source=source, **values)
+    )
+    __upsert_rollups(repository.id, taken, values)
+
+    if commit:
+        db.session.commit()
+
+
+def get_history(repo_db_id: int, period: str = "day", since: Optional[int] = None) -> List[Dict[str, Any]]:
+    """The rollups of a repository, oldest first, read without touching the snapshots.
+
+    Besides the stats every point has `growth`, the change of the
+    deduplicated size since the point before, and `dedup_ratio`, how many
+    times the original data is larger than what is stored for it.
+
+    Arguments:
+        since -- Only periods starting at or after this time (epoch seconds).
+    """
+    rollup = RepositoryStatsRollup
+    stmt = select(rollup).where(rollup.repository_id == repo_db_id, rollup.period == period).order_by(rollup.bucket)
+    if since is not None:
+        stmt = stmt.where(rollup.bucket >= since)
+
+    columns = [column.name for column in rollup.__table__.columns if column.name not in ("repository_id", "period")]
+    points = [{name: getattr(row, name) for name in columns} for row in db.session.scalars(stmt)]
+
+    previous = None
+    for point in points:
+        size = point["unique_csize"]
+        point["growth"] = size - previous if size is not None and previous is not None else None
+        point["dedup_ratio"] = (
+            round(point["total_size"] / size, 2) if size and point["total_size"] is not None else None
+        )
+        previous = size if size is not None else previous
+
+    return points
+
+
+def count_snapshots(repo_db_id: int) -> int:
+    stmt = select(func.count(RepositoryStats.id)).where(RepositoryStats.repository_id == repo_db_id)
+    return db.session.scalar(stmt) or 0
+
+
+def remove_repository(repo_db_id: int) -> None:
+    """Delete the history of a repository that is removed from Borgdrone."""
+    db.session.execute(delete(RepositoryStats).where(RepositoryStats.repository_id == repo_db_id))
+    db.session.execute(delete(RepositoryStatsRollup).where(RepositoryStatsRollup.repository_id == repo_db_id))
+    db.session.commit()
@@ -0,0 +1,167 @@
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from flask import current_app as app
+from sqlalchemy import select
+
+from borgdrone.borg import BorgRunner as borg_runner
+from borgdrone.extensions import db
+from borgdrone.logging import BorgdroneEvent, logger
+
+from .models import Repository, RepositoryVerification
+
+# slices shorter than this spend more time opening the repository than checking it
+MIN_SLICE_SECONDS = 60
+
+
+def __now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def __segment_count(repo_path: str) -> Optional[int]:
+    """Highest segment number of a local repository, read from the file names in data/."""
+    data_path = os.path.join(repo_path, "data")
+    try:
+        directories = sorted((int(entry.name) for entry in os.scandir(data_path) if entry.name.isdigit()), reverse=True)
+        for directory in directories:
+            with os.scandir(os.path.join(data_path, str(directory))) as entries:
+                segments = [int(entry.name) for entry in entries if entry.name.isdigit()]
+            if segments:
+                return max(segments)
+    except OSError:
+        pass
+
+    return None
+
+
+def get_state(repository: Repository) -> RepositoryVerification:
+    if repository.verification is None:
+        repository.verification = RepositoryVerification(repository_id=repository.id, slices=0, cycles=0)
+        db.session.commit()
+
+    return repository.verification
+
+
+def __run_slice(state: RepositoryVerification, duration: int) -> BorgdroneEvent[Dict[str, Any]]:
+    repository = state.repository
+    env = borg_runner.repository_env(repository.passphrase)
+
+    if state.cycle_started is None:
+        state.cycle_started = __now()
+        state.slices = 0
+
+    result_log = borg_runner.borg_check_slice(repository.path, duration, env)
+
+    state.last_run = __now()
+    state.last_status = result_log.status
+
+    if not (data := result_log.get_data()):
+        # Possible:
+        # - Repository.DoesNotExist
+        # - Check was cancelled.
+        state.last_error = result_log.error_message
+        state.commit()
+        return result_log
+
+    state.last_error = None
+    state.slices += 1
+    state.last_segment = data["segment"]
+    state.total_segments = __segment_count(repository.path) or state.total_segments
+
+    if data["complete"]:
+        state.cycles += 1
+        state.last_completed = state.last_run
+        state.cycle_started = None
+        logger.debug(f"{repository.path}: verification cycle finished after {state.slices} slices.", "green")
+
+    state.commit()
+    return result_log
+
+
+def __verify_data_due(states: List[RepositoryVerification], days: int) -> Optional[RepositoryVerification]:
+    """The repository whose data was verified longest ago, if that was more than `days` ago."""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+    due = [state for state in states if state.last_verify_data is None or state.last_verify_data < cutoff]
+    if days <= 0 or not due:
+        return None
+
+    return min(due, key=lambda state: state.last_verify_data or "")
+
+
+def run_verification(
+    budget: Optional[int] = None, slice_seconds: Optional[int] = None, verify_data_days: Optional[int] = None
+) -> BorgdroneEvent[List[Dict[str, Any]]]:
+    """Spend up to `budget` seconds verifying repositories, one bounded check slice at a time.
+
+    Repositories take turns, least recently checked first, so a long check
+    of one repository never starves the others and none is locked for more
+    than `slice_seconds` at once. Borg continues each partial check where
+    the previous slice stopped, so every repository is fully verified over
+    as many nights as its size requires.
+
+    At most one repository per run also gets its latest archive read back
+    with `--verify-data`, staggered so each is due every `verify_data_days`.
+    That run cannot be bounded and counts against the budget.
+
+    Returns:
+        BorgdroneEvent[List[Dict[str, Any]]] -- The verification state of every repository.
+    """
+    _log = BorgdroneEvent[List[Dict[str, Any]]]()
+    _log.event = "VerificationManager.run_verification"
+
+    budget = budget if budget is not None else int(app.config.get("BORG_VERIFY_BUDGET", 3600))
+    slice_seconds = slice_seconds or int(app.config.get("BORG_VERIFY_SLICE", 600))
+    if verify_data_days is None:
+        verify_data_days = int(app.config.get("BORG_VERIFY_DATA_DAYS", 30))
+
+    deadline = time.monotonic() + budget
+
+    repositories = list(db.session.scalars(select(Repository)))
+    if not repositories:
+        return _log.return_success("No repositories to verify.")
+
+    states = [get_state(repository) for repository in repositories]
+
+    if state := __verify_data_due(states, verify_data_days):
+        repository = state.repository
+        result_log = borg_runner.borg_check_data(repository.path, env=borg_runner.repository_env(repository.passphrase))
+        if result_log.status == "SUCCESS":
+            state.last_verify_data = __now()
+        else:
+            state.last_error = result_log.error_message
+        state.commit()
+
+    queue = sorted(states, key=lambda state: state.last_run or "")
+    slices = 0
+    failed = 0
+    finished = 0
+
+    while queue:
+        remaining = int(deadline - time.monotonic())
+        if remaining < min(MIN_SLICE_SECONDS, slice_seconds):
+            break
+
+        state = queue.pop(0)
+        result_log = __run_slice(state, min(slice_seconds, remaining))
+        slices += 1
+
+        if not (data := result_log.get_data()):
+            failed += 1
+            continue
+
+        if data["complete"]:
+            # done for tonight, the next cycle starts with the next run
+            finished += 1
+            continue
+
+        queue.append(state)
+
+    _log.set_data([state.to_dict() for state in states])
+
+    message = f"Verification ran {slices} slices, {finished} cycles completed."
+    if failed:
+        return _log.return_failure(f"{message} {failed} failed.")
+
+    return _log.return_success(message)
@@ -1,2 +1,7 @@
-from .models import Repository
+from .models import (
+    Repository,
+    RepositoryStats,
+    RepositoryStatsRollup,
+    RepositoryVerification,
+)
 from .views import repositories_blueprint
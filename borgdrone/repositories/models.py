@@ -1,6 +1,6 @@
 from typing import Any, Optional
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from borgdrone.extensions import db
@@ -15,15 +15,18 @@ class Repository(db.Model):
 
     # relationships
     ## child
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     user = relationship("Users", back_populates="repositories")
     ## parent
     backupbundles = relationship("BackupBundle", back_populates="repo", cascade="all, delete")
+    verification = relationship(
+        "RepositoryVerification", back_populates="repository", cascade="all, delete", uselist=False
+    )
 
     name_format: Mapped[str] = mapped_column(default="{hostname}-{user}-{now}")
 
     # RepositoryKey
-    repo_id: Mapped[str] = mapped_column()
+    repo_id: Mapped[str] = mapped_column(index=True)
     path: Mapped[str] = mapped_column(unique=True)  # location
     last_modified: Mapped[Optional[str]]
 
@@ -75,3 +78,105 @@ class Repository(db.Model):
     def delete(self) -> None:
         db.session.delete(self)
         db.session.commit()
+
+
+class RepositoryVerification(db.Model):
+    """Progress of the rotating `borg check` of one repository.
+
+    A cycle is one complete pass over all segments, spread over as many
+    `--max-duration` slices as it takes.
+    """
+
+    __tablename__ = "repositoryverification"
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    repository_id: Mapped[int] = mapped_column(ForeignKey("repository.id"), unique=True)
+    repository = relationship("Repository", back_populates="verification")
+
+    cycle_started: Mapped[Optional[str]]
+    last_segment: Mapped[Optional[int]]  # last segment checked in the current cycle
+    total_segments: Mapped[Optional[int]]  # highest segment number when the slice ran
+    slices: Mapped[int] = mapped_column(default=0)  # slices run in the current cycle
+    cycles: Mapped[int] = mapped_column(default=0)  # completed cycles
+    last_completed: Mapped[Optional[str]]  # when the last cycle finished
+
+    last_run: Mapped[Optional[str]]
+    last_status: Mapped[Optional[str]]
+    last_error: Mapped[Optional[str]]
+
+    last_verify_data: Mapped[Optional[str]]
+
+    @property
+    def percent(self) -> Optional[float]:
+        if not self.total_segments or self.last_segment is None:
+            return None
+        return round(min(self.last_segment / self.total_segments, 1.0) * 100, 1)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "repository_id": self.repository_id,
+            "cycle_started": self.cycle_started,
+            "last_segment": self.last_segment,
+            "total_segments": self.total_segments,
+            "percent": self.percent,
+            "slices": self.slices,
+            "cycles": self.cycles,
+            "last_completed": self.last_completed,
+            "last_run": self.last_run,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "last_verify_data": self.last_verify_data,
+        }
+
+    def commit(self) -> None:
+        db.session.add(self)
+        db.session.commit()
+
+
+class RepositoryStats(db.Model):
+    """A snapshot of a repository's cache stats.
+
+    One row is appended on every stats refresh and every archive created,
+    the repository row only ever holds the latest values.
+    """
+
+    __tablename__ = "repositorystats"
+    __table_args__ = (Index("ix_repositorystats_repository_id_taken", "repository_id", "taken"),)
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    repository_id: Mapped[int] = mapped_column(ForeignKey("repository.id"))
+    taken: Mapped[int]  # seconds since the epoch
+    source: Mapped[str]  # info, archive
+
+    total_chunks: Mapped[Optional[int]]
+    total_unique_chunks: Mapped[Optional[int]]
+    total_size: Mapped[Optional[int]]
+    total_csize: Mapped[Optional[int]]
+    unique_size: Mapped[Optional[int]]
+    unique_csize: Mapped[Optional[int]]
+
+
+class RepositoryStatsRollup(db.Model):
+    """The snapshots of one hour, day or week, updated as snapshots are added.
+
+    The stats are those of the latest snapshot in the period, the range of
+    the deduplicated size shows how much it moved within the period.
+    """
+
+    __tablename__ = "repositorystatsrollup"
+    repository_id: Mapped[int] = mapped_column(ForeignKey("repository.id"), primary_key=True)
+    period: Mapped[str] = mapped_column(primary_key=True)  # hour, day, week
+    bucket: Mapped[int] = mapped_column(primary_key=True)  # start of the period, local time, epoch seconds
+
+    samples: Mapped[int]
+    first_taken: Mapped[int]
+    last_taken: Mapped[int]
+
+    total_chunks: Mapped[Optional[int]]
+    total_unique_chunks: Mapped[Optional[int]]
+    total_size: Mapped[Optional[int]]
+    total_csize: Mapped[Optional[int]]
+    unique_size: Mapped[Optional[int]]
+    unique_csize: Mapped[Optional[int]]
+    min_unique_csize: Mapped[Optional[int]]
+    max_unique_csize: Mapped[Optional[int]]
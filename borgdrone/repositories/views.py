@@ -1,11 +1,19 @@
-from typing import Any
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
-from flask import Blueprint, request
+import click
+from flask import Blueprint, jsonify, request
 from flask_login import login_required
+from sqlalchemy import select
 
+from borgdrone.borg import BorgRunner as borg_runner
+from borgdrone.extensions import db
 from borgdrone.helpers import ResponseHelper, datahelpers
 
 from . import RepositoryManager as repository_manager
+from . import StatsManager as stats_manager
+from . import VerificationManager as verification_manager
+from .models import Repository
 
 repositories_blueprint = Blueprint("repositories", __name__, template_folder="templates")
 
@@ -128,3 +136,121 @@ def update_stats(db_id):
     rh.toast_success = result_log.message
     rh.htmx_refresh = True
     return rh.respond(empty=True)
+
+
+@repositories_blueprint.route("/update", methods=["POST"])
+@login_required
+def update_all_stats():
+    rh = ResponseHelper()
+
+    result_log = repository_manager.update_all_repository_info()
+    rh.borgdrone_return = result_log.borgdrone_return()
+
+    if result_log.status == "FAILURE":
+        rh.toast_error = result_log.error_message
+    else:
+        rh.toast_success = result_log.message
+
+    rh.htmx_refresh = True
+    return rh.respond(empty=True)
+
+
+def __history_range() -> Tuple[Optional[str], int]:
+    """The period and the start of the history asked for, a year of days by default."""
+    period = request.args.get("period", "day")
+    days = request.args.get("days", "365")
+    if period not in stats_manager.PERIODS or not days.isdigit():
+        return None, 0
+    return period, int(time.time()) - int(days) * 86400
+
+
+def __polyline(points: List[Dict[str, Any]], key: str, width: int = 600, height: int = 120) -> Dict[str, Any]:
+    """An SVG polyline of one value of the history, placed by the time of each period."""
+    values = [(point["bucket"], point[key]) for point in points if point[key] is not None]
+    if not values:
+        return {"points": "", "min": None, "max": None}
+
+    first, last = values[0][0], values[-1][0]
+    low = min(value for _, value in values)
+    high = max(value for _, value in values)
+    coordinates = (
+        (
+            (bucket - first) / (last - first) * width if last > first else width / 2,
+            height - (value - low) / (high - low) * height if high > low else height / 2,
+        )
+        for bucket, value in values
+    )
+    return {
+        "points": " ".join(f"{x:.1f},{y:.1f}" for x, y in coordinates),
+        "min": low,
+        "max": high,
+    }
+
+
+@repositories_blueprint.route("/<int:db_id>/history")
+@login_required
+def history(db_id: int):
+    """The stats history of a repository from its hourly, daily or weekly rollups, as JSON."""
+    period, since = __history_range()
+    if period is None:
+        return jsonify({"error": "The period must be hour, day or week, and days a number."}), 400
+
+    return jsonify({"period": period, "points": stats_manager.get_history(db_id, period, since)})
+
+
+@repositories_blueprint.route("/<int:db_id>/history/chart")
+@login_required
+def history_chart(db_id: int):
+    rh = ResponseHelper(get_template="repositories/history.html")
+
+    period, since = __history_range()
+    if period is None:
+        rh.toast_error = "The period must be hour, day or week, and days a number."
+        return rh.respond(empty=True)
+
+    points = stats_manager.get_history(db_id, period, since)
+    rh.context_data = {
+        "db_id": db_id,
+        "period": period,
+        "points": points,
+        "size": __polyline(points, "unique_csize"),
+        "ratio": __polyline(points, "dedup_ratio"),
+        "convert_bytes": datahelpers.convert_bytes,
+        "epoch_to_human": datahelpers.epoch_to_human,
+    }
+    return rh.respond()
+
+
+@repositories_blueprint.cli.command("verify")
+@click.option("--budget", type=int, default=None, help="Seconds to spend in total, BORG_VERIFY_BUDGET by default.")
+@click.option("--slice", "slice_seconds", type=int, default=None, help="Longest check, BORG_VERIFY_SLICE by default.")
+def verify(budget: Optional[int], slice_seconds: Optional[int]):
+    """Run one night's share of the rotating repository verification.
+
+    flask --app borgdrone repositories verify
+    """
+    result_log = verification_manager.run_verification(budget, slice_seconds)
+
+    for state in result_log.get_data() or []:
+        click.echo(state)
+
+    click.echo(result_log.message if result_log.status == "SUCCESS" else result_log.error_message)
+
+
+@repositories_blueprint.cli.command("benchmark")
+@click.option("--repeat", type=int, default=5, help="Timed runs per command and backend.")
+def benchmark(repeat: int):
+    """Compare borg info/list through the borg CLI and through a borg worker.
+
+    BORG_BACKEND=worker flask --app borgdrone repositories benchmark
+    """
+    for repository in db.session.scalars(select(Repository)):
+        env = borg_runner.repository_env(repository.passphrase)
+        result_log = borg_runner.benchmark_backends(repository.path, max(1, repeat), env)
+
+        click.echo(repository.path)
+        for row in result_log.get_data() or []:
+            click.echo(row)
+
+        if result_log.status != "SUCCESS":
+            click.echo(result_log.message or result_log.error_message)
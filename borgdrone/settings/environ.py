@@ -39,12 +39,14 @@ def load_config() -> dict[str, Any]:
     logs_dir = os.environ.get("LOGS_DIR", f"{instance_path}/logs")
     archives_log_dir = os.environ.get("ARCHIVES_LOG_DIR", f"{logs_dir}/archive_logs")
     bash_dir = os.environ.get("BASH_SCRIPTS_DIR", f"{instance_path}/bash_scripts")
+    listings_dir = os.environ.get("LISTINGS_DIR", f"{instance_path}/listings")
 
     # check instance directories
     filemanager.check_dir(instance_path, create=True)
     filemanager.check_dir(logs_dir, create=True)
     filemanager.check_dir(archives_log_dir, create=True)
     filemanager.check_dir(bash_dir, create=True)
+    filemanager.check_dir(listings_dir, create=True)
 
     config_sqlalchemy = {
         "SQLALCHEMY_TRACK_MODIFICATIONS": os.environ.get("SQLALCHEMY_TRACK_MODIFICATIONS", "False"),
@@ -62,6 +64,28 @@ def load_config() -> dict[str, Any]:
         "LOGS_DIR": logs_dir,
         "ARCHIVES_LOG_DIR": archives_log_dir,
         "BASH_SCRIPTS_DIR": bash_dir,
+        "LISTINGS_DIR": listings_dir,
+        "LISTING_PARSE_WORKERS": os.environ.get("LISTING_PARSE_WORKERS", ""),
+        "FILE_INDEX_PATH": os.environ.get("FILE_INDEX_PATH", f"{instance_path}/file_index.sqlite3"),
+        "FILE_INDEX_AUTO": os.environ.get("FILE_INDEX_AUTO", "True"),
+        "BORG_MAX_JOBS": os.environ.get("BORG_MAX_JOBS", "2"),
+        "BORG_MAX_QUERIES": os.environ.get("BORG_MAX_QUERIES", "8"),
+        "BORG_PROGRESS_RATE": os.environ.get("BORG_PROGRESS_RATE", "4"),
+        "BORG_CACHE_SIZE": os.environ.get("BORG_CACHE_SIZE", "128"),
+        "BORG_CACHE_TTL": os.environ.get("BORG_CACHE_TTL", "300"),
+        "BORG_COMPACT_DELAY": os.environ.get("BORG_COMPACT_DELAY", "60"),
+        "BORG_COMPACT_THRESHOLD": os.environ.get("BORG_COMPACT_THRESHOLD", "10"),
+        "BORG_COMPACT_WINDOW": os.environ.get("BORG_COMPACT_WINDOW", ""),
+        "BORG_VERIFY_BUDGET": os.environ.get("BORG_VERIFY_BUDGET", "3600"),
+        "BORG_VERIFY_SLICE": os.environ.get("BORG_VERIFY_SLICE", "600"),
+        "BORG_VERIFY_DATA_DAYS": os.environ.get("BORG_VERIFY_DATA_DAYS", "30"),
+        "BORG_ACCOUNTING_RING": os.environ.get("BORG_ACCOUNTING_RING", "1000"),
+        "BORG_ACCOUNTING_DAYS": os.environ.get("BORG_ACCOUNTING_DAYS", "30"),
+        "BORG_BACKEND": os.environ.get("BORG_BACKEND", "cli"),
+        "BORG_WORKER_PYTHON": os.environ.get("BORG_WORKER_PYTHON", ""),
+        "BORG_WORKERS": os.environ.get("BORG_WORKERS", ""),
+        "BORG_WORKER_MAX_REQUESTS": os.environ.get("BORG_WORKER_MAX_REQUESTS", "200"),
+        "BORG_CGROUP_ROOT": os.environ.get("BORG_CGROUP_ROOT", ""),
     }
 
     config_file_path = f"{instance_path}/borgdrone.env"
@@ -223,3 +223,10 @@ def ctx_archive(client: FlaskClient, ctx_bundle):
     result_log = archives_manager.delete_archive(archive.name)
     assert result_log.status == "SUCCESS"
     assert database.count(Archive) == start_archive_count
+
+
+@pytest.fixture(scope="function", name="unlisted_archive")
+def ctx_unlisted_archive(app: Flask, monkeypatch: pytest.MonkeyPatch, request: pytest.FixtureRequest):
+    # with FILE_INDEX_AUTO off, nothing lists the new archive in the background
+    monkeypatch.setitem(app.config, "FILE_INDEX_AUTO", "False")
+    yield request.getfixturevalue("archive")
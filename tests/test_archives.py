@@ -1,13 +1,26 @@
+import os
+from typing import Any
+
 from flask.testing import FlaskClient
+from sqlalchemy import select, text
 
 from borgdrone.archives import Archive
 from borgdrone.archives import ArchivesManager as archives_manager
+from borgdrone.archives import DiffManager as diff_manager
+from borgdrone.archives import DownloadManager as download_manager
+from borgdrone.archives import ListingManager as listing_manager
+from borgdrone.archives import SearchManager as search_manager
+from borgdrone.archives import listing
 from borgdrone.borg import BorgRunner as borg_runner
 from borgdrone.bundles import BackupBundle, BackupDirectory
+from borgdrone.bundles import BundleManager as bundle_manager
+from borgdrone.extensions import db
 from borgdrone.helpers import bash, database, datahelpers, filemanager
-from borgdrone.logging import logger
+from borgdrone.logging import BorgdroneEvent, logger
 from borgdrone.repositories import Repository
 
+from .conftest import INSTANCE_PATH
+
 
 def test_get(client: FlaskClient, archive: Archive):
     response = client.get("/archives/")
@@ -34,6 +47,35 @@ def test_get_archives(client: FlaskClient):
     assert response.status_code == 200
 
 
+def test_get_page(client: FlaskClient, archive: Archive):
+    repository = database.get_latest(Repository)
+    assert repository
+
+    # walk all pages, newest first
+    seen = []
+    rows, cursor = archives_manager.get_page(repository.id, limit=1)
+    seen.extend(rows)
+    while cursor:
+        rows, cursor = archives_manager.get_page(repository.id, cursor, limit=1)
+        seen.extend(rows)
+
+    assert len(seen) == len(archives_manager.get_all(repository.id) or [])
+    assert [row["start_epoch"] for row in seen] == sorted((row["start_epoch"] for row in seen), reverse=True)
+
+    rows, _ = archives_manager.get_page(repository.id, hostname="no-such-host")
+    assert not rows
+
+    rows, _ = archives_manager.get_page(repository.id, bundle_id=archive.backupbundle_id, date_from=archive.start[:10])
+    assert archive.id in [row["id"] for row in rows]
+
+    form_data = {"repo_db_id": repository.id, "sort": "oldest", "hostname": archive.hostname}
+    response = client.post("/archives/get", data=form_data)
+    assert response.status_code == 200
+
+    response = client.get(f"/archives/page?repo_db_id={repository.id}&cursor={archives_manager.encode_cursor(seen[0])}")
+    assert response.status_code == 200
+
+
 def test_refresh_archive(client: FlaskClient, archive: Archive):
 
     result_log = archives_manager.refresh_archive("FakeArchive")
@@ -43,6 +85,125 @@ def test_refresh_archive(client: FlaskClient, archive: Archive):
     assert result_log.status == "SUCCESS"
 
 
+def test_iter_archives(client: FlaskClient, archive: Archive):
+    repository = database.get_latest(Repository)
+    assert repository
+
+    result_log = BorgdroneEvent[None]()
+    archives = list(borg_runner.iter_archives(repository.path, repository.repo_id, result_log=result_log))
+    assert result_log.status == "SUCCESS"
+    assert archive.archive_id in [data["archive_id"] for data in archives]
+
+    # stopping early
+    items = borg_runner.iter_archive_items(repository.path, archive.name)
+    assert "path" in next(items)
+    items.close()
+
+    result_log = BorgdroneEvent[None]()
+    assert not list(borg_runner.iter_archives("/bad/path", result_log=result_log))
+    assert result_log.error_code == "Borg.Repository.DoesNotExist"
+
+
+def test_sync_archives(client: FlaskClient, archive: Archive):
+    repository = database.get_latest(Repository)
+    assert repository
+
+    # pick up whatever earlier tests left in the repository
+    result_log = archives_manager.sync_archives(repository.id)
+    assert result_log.status == "SUCCESS"
+    archive_count = database.count(Archive)
+    bundle_count = database.count(BackupBundle)
+
+    result_log = archives_manager.sync_archives(repository.id)
+    assert result_log.message == "Archives synchronized: 0 added, 0 removed."
+
+    # created outside of Borgdrone
+    bash.run(f"borg create {repository.path}::OutsideArchive /tmp/borgdrone_pytest/data/include1")
+    result_log = archives_manager.sync_archives(repository.id)
+    assert result_log.message == "Archives synchronized: 1 added, 0 removed."
+    assert database.count(Archive) == archive_count + 1
+
+    # deleted outside of Borgdrone
+    bash.run(f"borg delete {repository.path}::OutsideArchive")
+    result_log = archives_manager.sync_archives(repository.id)
+    assert result_log.message == "Archives synchronized: 0 added, 1 removed."
+    assert database.count(Archive) == archive_count
+
+    # OK
+    response = client.post("/archives/refresh", data={"repo_db_id": repository.id})
+    assert response.headers["BORGDRONE_RETURN"] == "ArchivesManager.sync_archives.SUCCESS"
+
+    # FAIL | Repository not found.
+    response = client.post("/archives/refresh", data={"repo_db_id": 0})
+    assert response.headers["BORGDRONE_RETURN"] == "ArchivesManager.sync_archives.FAILURE"
+
+    # cleanup the bundle created for the outside archive
+    if database.count(BackupBundle) > bundle_count:
+        bundle = database.get_latest(BackupBundle)
+        assert bundle
+        bundle.delete()
+
+
+def copy_row(instance: Any, **changes: Any) -> Any:
+    """A new row with the columns of `instance`, except for its id and `changes`."""
+    table = type(instance).__table__
+    values = {column.key: getattr(instance, column.key) for column in table.columns if column.key != "id"}
+    row = type(instance)(**{**values, **changes})
+    db.session.add(row)
+    db.session.commit()
+    return row
+
+
+def test_delete_archives(client: FlaskClient):
+    repository = database.get_latest(Repository)
+    assert repository
+    bundle = database.get_latest(BackupBundle)
+    assert bundle
+
+    start_archive_count = database.count(Archive)
+    for _ in range(3):
+        result_log = bundle_manager.create_backup(bundle.id)
+        assert result_log.status == "SUCCESS"
+
+    archive_ids = [archive.id for archive in archives_manager.get_all(repository.id)[-3:]]
+
+    # OK | two archives in one borg call, compaction is deferred
+    result_log = archives_manager.delete_archives(archive_ids[:2])
+    assert result_log.status == "SUCCESS"
+    assert database.count(Archive) == start_archive_count + 1
+    assert repository.path in borg_runner.pending_compactions()
+
+    # OK
+    form_data = {"archive_ids": [archive_ids[2]], "repo_db_id": repository.id}
+    response = client.post("/archives/delete", data=form_data)
+    assert response.headers["BORGDRONE_RETURN"] == "ArchivesManager.delete_archives.SUCCESS"
+    assert database.count(Archive) == start_archive_count
+
+    # FAIL | a repository that fails does not stop the others, both are named
+    assert bundle_manager.create_backup(bundle.id).status == "SUCCESS"
+    archive = database.get_latest(Archive)
+    assert archive
+    missing_repository = copy_row(repository, path=f"{INSTANCE_PATH}/NoSuchRepo", repo_id="0" * 64)
+    missing_bundle = copy_row(bundle, repo_id=missing_repository.id)
+    missing_archive = copy_row(archive, backupbundle_id=missing_bundle.id, repository_id=missing_repository.repo_id)
+
+    result_log = archives_manager.delete_archives([archive.id, missing_archive.id])
+    assert result_log.status == "FAILURE"
+    results = result_log.get_data()
+    assert results and results[repository.path] is None and results[missing_repository.path]
+    assert missing_repository.path in result_log.error_message
+    assert f"Deleted from {repository.path}." in result_log.error_message
+    assert database.count(Archive) == start_archive_count + 1
+
+    for row in (missing_archive, missing_bundle, missing_repository):
+        db.session.delete(row)
+        db.session.commit()
+
+    # FAIL | Archive not found.
+    result_log = archives_manager.delete_archives(archive_ids)
+    assert result_log.status == "FAILURE"
+
+
 def test_import_archives(client: FlaskClient):
     repository = database.get_latest(Repository)
     assert repository
@@ -68,6 +229,14 @@ def test_import_archives(client: FlaskClient):
     assert database.count(BackupBundle) == 4
     assert database.count(BackupDirectory) == 4
 
+    # already imported archives are skipped, or updated in place
+    result_log = archives_manager.import_archives(repository)
+    assert result_log.status == "SUCCESS"
+    result_log = archives_manager.import_archives(repository, refresh=True, batch_size=3)
+    assert result_log.status == "SUCCESS"
+    assert database.count(Archive) == 4
+    assert database.count(BackupBundle) == 4
+
     # cleanup the new bundles
     for i in range(3):
         bundle = database.get_latest(BackupBundle)
@@ -78,3 +247,236 @@ def test_import_archives(client: FlaskClient):
 
 
 # archives_manager.
+
+
+def test_totals(client: FlaskClient, archive: Archive):
+    repository = database.get_latest(Repository)
+    assert repository
+
+    assert isinstance(archive.stats_original_size, int)
+    assert archive.start_epoch and archive.end_epoch
+
+    totals = archives_manager.get_totals(repository.id)
+    assert totals["archives"] == len(archives_manager.get_all(repository.id) or [])
+    assert totals["original_size"] >= archive.stats_original_size
+
+    day = archive.start[:10]
+    totals = archives_manager.get_totals(repository.id, bundle_id=archive.backupbundle_id, date_from=day, date_to=day)
+    assert totals["archives"] >= 1
+
+    growth = archives_manager.get_bundle_growth(repository.id)
+    rows = [row for row in growth if row["backupbundle_id"] == archive.backupbundle_id]
+    assert rows[-1]["growth"] == sum(row["deduplicated_size"] for row in rows)
+
+    response = client.get(f"/archives/stats?repo_db_id={repository.id}")
+    assert response.status_code == 200
+    assert response.json["totals"]["archives"] >= 1
+
+
+def test_listing(client: FlaskClient, unlisted_archive: Archive):
+    archive = unlisted_archive
+    assert listing_manager.get_status(archive)["state"] == "missing"
+
+    response = client.get(f"/archives/{archive.id}/browse")
+    assert response.status_code == 200
+
+    build = listing_manager.build_listing(archive.id).get_data()
+    assert build and build.job
+    build.job.wait(60)
+    assert build.status == "READY", build.error
+
+    status = listing_manager.get_status(archive)
+    assert status["state"] == "ready" and status["items"] > 0
+
+    # walk down to the first directory with files, one entry per page
+    path = ""
+    while True:
+        entries, _ = listing_manager.get_children(archive, path).get_data() or ([], None)
+        assert entries
+        if entries[0]["type"] != "d":
+            break
+        path = entries[0]["path"]
+
+    entries, after = listing_manager.get_children(archive, path, limit=1).get_data() or ([], None)
+    assert len(entries) == 1
+    if after:
+        next_entries, _ = listing_manager.get_children(archive, path, after, limit=1).get_data() or ([], None)
+        assert next_entries[0]["name"] > entries[0]["name"]
+
+    response = client.get(f"/archives/{archive.id}/children?path={path}")
+    assert response.status_code == 200
+    assert entries[0]["name"].encode() in response.data
+
+    response = client.post(f"/archives/{archive.id}/listing")
+    assert response.status_code == 200
+
+
+def test_search(client: FlaskClient, archive: Archive):
+    # new archives are listed and indexed in the background, this joins that build
+    build = listing_manager.build_listing(archive.id).get_data()
+    assert build and build.job
+    build.job.wait(60)
+    assert build.status == "READY", build.error
+    assert archive.id in search_manager.indexed_archives()
+
+    with listing.ListingReader(listing_manager.listing_path(archive)) as reader:
+        path = next(path for path, item_type, _, _ in reader.files() if item_type == "-")
+
+    matches, _ = search_manager.search(path.rsplit("/", 1)[-1])
+    assert path in [match["path"] for match in matches]
+    assert not search_manager.search(path, repository="0" * 64)[0]
+
+    # every archive of the bundle has the file, the new one first
+    versions = search_manager.versions(f"/{path}")
+    assert versions[0]["archive_id"] == archive.id
+    assert {version["archive_id"] for version in versions} <= set(search_manager.indexed_archives())
+    assert versions[-1]["changed"]
+
+    response = client.get("/archives/search")
+    assert response.status_code == 200
+    response = client.get(f"/archives/search/results?q={path}")
+    assert response.status_code == 200
+    assert path.encode() in response.data
+    response = client.get(f"/archives/search/versions?path={path}")
+    assert response.status_code == 200
+    assert archive.name.encode() in response.data
+
+    search_manager.remove_archives([archive.id])
+    assert archive.id not in search_manager.indexed_archives()
+    assert archive.id not in [version["archive_id"] for version in search_manager.versions(f"/{path}")]
+
+
+def test_diff(client: FlaskClient, archive: Archive):
+    bundle = database.get_latest(BackupBundle)
+    assert bundle
+    result_log = bundle_manager.create_backup(bundle.id)
+    assert result_log.status == "SUCCESS"
+    second = database.get_latest(Archive)
+    assert second and second.id != archive.id
+    assert diff_manager.previous(second) == archive
+
+    for archive_db_id in (archive.id, second.id):
+        build = listing_manager.build_listing(archive_db_id).get_data()
+        assert build and build.job
+        build.job.wait(60)
+
+    # both listings are cached, they are merged without borg
+    archive_diff = diff_manager.start_diff(second.id, archive.id).get_data()
+    assert archive_diff and archive_diff.job and archive_diff.source == "listings"
+    archive_diff.job.wait(60)
+    assert archive_diff.status == "READY", archive_diff.error
+
+    status = diff_manager.get_status(archive, second)
+    assert status["state"] == "ready"
+    changes, _ = diff_manager.get_changes(archive, second).get_data() or ([], None)
+    assert status["added"] + status["removed"] + status["modified"] >= len(changes)
+
+    response = client.get(f"/archives/{second.id}/diff")
+    assert response.status_code == 200
+    response = client.get(f"/archives/{second.id}/diff/changes?other={archive.id}&change=added")
+    assert response.status_code == 200
+
+    # without a listing borg diff is streamed
+    repository = database.get_latest(Repository)
+    assert repository
+    listing_manager.remove_listings(repository.repo_id, [second.archive_id])
+    diff_manager.remove_diffs(repository.repo_id, [second.archive_id])
+    assert diff_manager.get_status(archive, second) == {"state": "missing", "cached": False}
+
+    response = client.post(f"/archives/{second.id}/diff/status?other={archive.id}")
+    assert response.headers["BORGDRONE_RETURN"] == "DiffManager.start_diff.SUCCESS"
+    archive_diff = diff_manager.start_diff(archive.id, second.id).get_data()
+    assert archive_diff and archive_diff.job
+    archive_diff.job.wait(60)
+    assert diff_manager.get_status(archive, second)["state"] == "ready"
+
+    # FAIL | not the same archive twice
+    assert diff_manager.start_diff(archive.id, archive.id).status == "FAILURE"
+
+    path = diff_manager.diff_path(archive, second)
+    result_log = archives_manager.delete_archive(second.name)
+    assert result_log.status == "SUCCESS"
+    assert not os.path.exists(path)
+
+
+def test_download(client: FlaskClient, archive: Archive):
+    response = client.get(f"/archives/{archive.id}/download")
+    assert response.status_code == 200
+    assert response.headers["BORGDRONE_RETURN"] == "DownloadManager.open_download.SUCCESS"
+    assert response.data[257:262] == b"ustar"
+    assert download_manager.get_downloads()[0].status == "DONE"
+
+    build = listing_manager.build_listing(archive.id).get_data()
+    assert build and build.job
+    build.job.wait(60)
+    with listing.ListingReader(listing_manager.listing_path(archive)) as reader:
+        path = next(path for path, item_type, size, _ in reader.files() if item_type == "-" and size)
+
+    response = client.get(f"/archives/{archive.id}/download?kind=file&path={path}")
+    assert response.status_code == 200
+    with open(f"/{path}", "rb") as f:
+        assert response.data == f.read()
+
+    downloads = client.get("/archives/downloads").json
+    assert downloads[0]["bytes"] == len(response.data) and downloads[0]["status"] == "DONE"
+
+    # FAIL | not in the archive, reported before the response starts
+    response = client.get(f"/archives/{archive.id}/download?kind=file&path=does/not/exist")
+    assert response.status_code == 302
+    assert response.headers["BORGDRONE_RETURN"] == "DownloadManager.open_download.FAILURE"
+
+    # FAIL | a path is never taken for an option
+    response = client.get(f"/archives/{archive.id}/download?kind=file&path=--help")
+    assert response.status_code == 302
+    assert response.headers["BORGDRONE_RETURN"] == "DownloadManager.open_download.FAILURE"
+
+
+def query_plan(stmt) -> str:
+    compiled = stmt.compile(db.engine, compile_kwargs={"literal_binds": True})
+    rows = db.session.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+    return "\n".join(row[3] for row in rows)
+
+
+def test_query_plans(client: FlaskClient, archive: Archive):
+    repository = database.get_latest(Repository)
+    assert repository
+
+    plans = {
+        "ix_archive_archive_id": select(Archive).where(Archive.archive_id == "x"),
+        "ix_archive_name": select(Archive).where(Archive.name == "x"),
+        "uq_archive_repository_id_archive_id": select(Archive.archive_id).where(Archive.repository_id == "x"),
+        "ix_archive_backupbundle_id_start_epoch": select(Archive.id)
+        .where(Archive.backupbundle_id == 1, Archive.start_epoch >= 0)
+        .order_by(Archive.start_epoch.desc()),
+        "ix_backupbundle_command_line": select(BackupBundle).where(BackupBundle.command_line == "x"),
+        "ix_backupbundle_repo_id": select(BackupBundle).where(BackupBundle.repo_id == 1),
+        "ix_backupdirectory_path": select(BackupDirectory).where(BackupDirectory.path == "/x"),
+        "ix_repository_repo_id": select(Repository).where(Repository.repo_id == "x"),
+        "ix_repository_user_id": select(Repository).where(Repository.user_id == 1),
+    }
+    for index, stmt in plans.items():
+        plan = query_plan(stmt)
+        # SEARCH is an index lookup, SCAN would read the whole table
+        assert plan.startswith("SEARCH") and index in plan, plan
+
+
+def test_upgrade_schema(client: FlaskClient, archive: Archive):
+    db.session.execute(text("DROP INDEX ix_archive_name"))
+    db.session.execute(text("DROP INDEX uq_archive_repository_id_archive_id"))
+    # an index of an older version
+    db.session.execute(text("CREATE INDEX ix_archive_backupbundle_id_start ON archive (backupbundle_id, start)"))
+    db.session.commit()
+
+    # a duplicate that the unique index would reject
+    duplicate = {column.key: getattr(archive, column.key) for column in Archive.__table__.columns if column.key != "id"}
+    db.session.add(Archive(**duplicate))
+    db.session.commit()
+
+    created = database.upgrade_schema()
+    assert created == ["ix_archive_backupbundle_id_start", "ix_archive_name", "uq_archive_repository_id_archive_id"]
+    assert database.upgrade_schema() == []
+
+    stmt = select(Archive).where(
+        Archive.repository_id == archive.repository_id, Archive.archive_id == archive.archive_id
+    )
+    assert len(db.session.scalars(stmt).all()) == 1
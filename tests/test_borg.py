@@ -0,0 +1,274 @@
+import asyncio
+import subprocess
+import threading
+import time
+from types import SimpleNamespace
+
+from borgdrone.borg import progress
+from borgdrone.borg.executor import BorgExecutor
+
+
+class Concurrency:
+    """Counts how many calls are inside `track()` at once."""
+
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def track(self, seconds: float) -> None:
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(seconds)
+        with self._lock:
+            self.active -= 1
+
+
+def test_executor_key_order():
+    executor = BorgExecutor(max_workers=4)
+    concurrency = Concurrency()
+    order = []
+
+    def job(number: int) -> int:
+        concurrency.track(0.02)
+        order.append(number)
+        return number
+
+    jobs = [executor.submit("/tmp/repo/../repo", job, number) for number in range(6)]
+    assert [job.result(timeout=10) for job in jobs] == list(range(6))
+
+    # one repository, one job at a time, in the order submitted
+    assert order == list(range(6))
+    assert concurrency.peak == 1
+    assert {job.key for job in jobs} == {"/tmp/repo"}
+    assert all(job.status == "DONE" for job in jobs)
+
+
+def test_executor_global_limit():
+    executor = BorgExecutor(max_workers=2)
+    concurrency = Concurrency()
+
+    jobs = [executor.submit(f"/tmp/repo{number}", concurrency.track, 0.05) for number in range(6)]
+    jobs += [executor.submit(None, concurrency.track, 0.05) for _ in range(2)]
+    for job in jobs:
+        job.result(timeout=10)
+
+    assert concurrency.peak == 2
+    assert not executor.jobs()
+
+
+def test_executor_cancel():
+    executor = BorgExecutor(max_workers=1)
+    release = threading.Event()
+    called = []
+
+    blocking = executor.submit("/tmp/repo", release.wait, 10)
+    pending = executor.submit("/tmp/repo", called.append, "pending")
+
+    # a pending job never starts
+    assert pending.cancel()
+    assert pending.status == "CANCELLED" and pending.done
+    assert pending.result(timeout=1) is None
+    assert not pending.cancel()
+
+    release.set()
+    assert blocking.result(timeout=10) is True
+    executor.submit("/tmp/repo", called.append, "after").result(timeout=10)
+    assert called == ["after"]
+
+    # a running job has its process terminated
+    def sleep() -> int:
+        with subprocess.Popen(["sleep", "10"]) as process:
+            executor.attach_process(process)
+            return process.wait()
+
+    running = executor.submit("/tmp/repo", sleep)
+    while running.status != "RUNNING" or running.process is None:
+        time.sleep(0.01)
+    started = time.monotonic()
+    assert running.cancel()
+    assert running.wait(timeout=5)
+    assert running.status == "CANCELLED"
+    assert time.monotonic() - started < 5
+
+
+def test_executor_nested():
+    executor = BorgExecutor(max_workers=1)
+
+    # the same repository runs inline, even with a single worker
+    assert executor.run("/tmp/repo", executor.run, "/tmp/repo", lambda: "inline") == "inline"
+
+    executor = BorgExecutor(max_workers=2)
+    concurrency = Concurrency()
+    log = []
+    b_started = threading.Event()
+    release_b = threading.Event()
+
+    def job_b() -> None:
+        b_started.set()
+        release_b.wait(10)
+        log.append("b")
+
+    def job_a() -> None:
+        b_started.wait(10)
+        # another repository waits until it is free
+        executor.run("/tmp/repo_b", log.append, "nested")
+        executor.run("/tmp/repo_b", concurrency.track, 0.02)
+
+    b = executor.submit("/tmp/repo_b", job_b)
+    a = executor.submit("/tmp/repo_a", job_a)
+    b_started.wait(10)
+    queued = executor.submit("/tmp/repo_b", concurrency.track, 0.02)
+
+    time.sleep(0.2)
+    assert not log
+    release_b.set()
+
+    for job in (a, b, queued):
+        job.result(timeout=10)
+    assert log == ["b", "nested"]
+    assert concurrency.peak == 1
+
+
+def test_executor_run_async():
+    executor = BorgExecutor(max_workers=4)
+    concurrency = Concurrency()
+
+    async def gather():
+        return await asyncio.gather(*(executor.run_async("/tmp/repo", concurrency.track, 0.02) for _ in range(4)))
+
+    # coroutines are queued like any other job, one per repository
+    assert asyncio.run(gather()) == [None] * 4
+    assert concurrency.peak == 1
+
+    release = threading.Event()
+    blocking = executor.submit("/tmp/repo", release.wait, 10)
+
+    async def cancel():
+        task = asyncio.ensure_future(executor.run_async("/tmp/repo", concurrency.track, 0))
+        await asyncio.sleep(0.05)
+        queued = [job for job in executor.jobs() if job is not blocking]
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return queued
+        return []
+
+    # cancelling the awaiting task cancels the queued job
+    queued = asyncio.run(cancel())
+    assert len(queued) == 1 and queued[0].status == "CANCELLED"
+    release.set()
+    blocking.result(timeout=10)
+
+
+# recorded from `borg --log-json create --progress --list --json`
+ARCHIVE_PROGRESS = (
+    '{"type": "archive_progress", "original_size": 250, "compressed_size": 200, "deduplicated_size": 100,'
+    ' "nfiles": 2, "path": "tmp/data/include1/4kb_test_data.txt", "time": 1760774342.1}'
+)
+ARCHIVE_FINISHED = '{"type": "archive_progress", "finished": true, "time": 1760774343.2}'
+FILE_STATUS = '{"type": "file_status", "status": "A", "path": "tmp/data/include1/4kb_test_data.txt"}'
+LOG_MESSAGE = (
+    '{"type": "log_message", "time": 1760774342.0, "message": "Creating archive at \\"/tmp/repo::name\\"",'
+    ' "levelname": "INFO", "name": "borg.archiver"}'
+)
+PROGRESS_PERCENT = (
+    '{"type": "progress_percent", "operation": 1, "msgid": "cache.begin_transaction", "finished": false,'
+    ' "message": "Initializing cache transaction: Reading config", "current": 1, "total": 3, "time": 1760774342.0}'
+)
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def test_progress_filter_line():
+    updates = []
+    tracker = progress.ProgressTracker(updates.append, updates_per_second=0)
+
+    assert tracker.filter_line("stderr", ARCHIVE_PROGRESS) is None
+    assert tracker.filter_line("stderr", PROGRESS_PERCENT) is None
+    assert tracker.filter_line("stderr", FILE_STATUS) == "A tmp/data/include1/4kb_test_data.txt"
+    assert tracker.filter_line("stderr", LOG_MESSAGE) == 'Creating archive at "/tmp/repo::name"'
+
+    # anything that is not a borg JSON message is shown as it is
+    assert tracker.filter_line("stdout", "plain text") == "plain text"
+    assert tracker.filter_line("stderr", "{not json") == "{not json"
+    assert tracker.filter_line("stdout", '{"archive": {}}') == '{"archive": {}}'
+
+    assert len(updates) == 1
+    assert updates[0]["original_size"] == 250
+    assert updates[0]["nfiles"] == 2
+    assert updates[0]["path"] == "tmp/data/include1/4kb_test_data.txt"
+    assert not updates[0]["finished"]
+
+    # the final message only carries `finished`, the totals are kept
+    assert tracker.filter_line("stderr", ARCHIVE_FINISHED) is None
+    assert updates[-1]["finished"] and updates[-1]["original_size"] == 250
+
+
+def test_progress_throttle(monkeypatch):
+    clock = Clock(1000.0)
+    monkeypatch.setattr(progress, "time", SimpleNamespace(monotonic=clock.monotonic))
+
+    updates = []
+    tracker = progress.ProgressTracker(updates.append, updates_per_second=4)
+
+    for _ in range(10):
+        clock.now += 0.05
+        tracker.filter_line("stderr", ARCHIVE_PROGRESS)
+
+    # half a second of messages every 50 ms, at most one update per 250 ms
+    assert tracker.updates_sent == 2
+    assert tracker.updates_skipped == 8
+    assert len(updates) == 2
+
+    # the final message is never throttled
+    clock.now += 0.01
+    tracker.filter_line("stderr", ARCHIVE_FINISHED)
+    assert tracker.updates_sent == 3
+    assert updates[-1]["finished"]
+
+
+def test_progress_eta(monkeypatch):
+    clock = Clock(100.0)
+    monkeypatch.setattr(progress, "time", SimpleNamespace(monotonic=clock.monotonic))
+
+    updates = []
+    tracker = progress.ProgressTracker(updates.append, expected_size=1000, updates_per_second=0)
+
+    # 250 of 1000 bytes in 10 s
+    clock.now = 110.0
+    tracker.update({"original_size": 250, "nfiles": 1})
+    assert updates[-1]["percent"] == 25.0
+    assert updates[-1]["eta"] == 30.0
+    assert updates[-1]["elapsed"] == 10.0
+
+    # the source grew since the previous archive
+    clock.now = 140.0
+    tracker.update({"original_size": 1500, "nfiles": 3})
+    assert updates[-1]["percent"] == 99.0
+    assert updates[-1]["eta"] == 0.0
+
+    tracker.update({"finished": True})
+    assert updates[-1]["percent"] == 100.0
+    assert updates[-1]["eta"] == 0.0
+
+    # without an expected size, the file count of the previous archive
+    tracker = progress.ProgressTracker(updates.append, expected_nfiles=10, updates_per_second=0)
+    clock.now = 150.0
+    tracker.update({"original_size": 1, "nfiles": 5})
+    assert updates[-1]["percent"] == 50.0
+    assert updates[-1]["eta"] == 10.0
+
+    # and nothing to compare with
+    tracker = progress.ProgressTracker(updates.append, updates_per_second=0)
+    clock.now = 160.0
+    tracker.update({"original_size": 1, "nfiles": 5})
+    assert updates[-1]["percent"] is None and updates[-1]["eta"] is None
@@ -1,8 +1,11 @@
 from flask.testing import FlaskClient
 
 from borgdrone.archives import Archive
+from borgdrone.archives import RetentionManager as retention_manager
 from borgdrone.bundles import BackupBundle, BackupDirectory
 from borgdrone.bundles import BundleManager as bundle_manager
+from borgdrone.bundles import RunManager as run_manager
+from borgdrone.bundles import retention
 from borgdrone.helpers import database
 from borgdrone.logging import logger
 from borgdrone.repositories import Repository
@@ -124,3 +127,115 @@ def test_create_backup(client: FlaskClient):
 
     assert result_log.status == "SUCCESS"
     assert database.count(Archive) == archive_count + 1
+
+
+def test_backup_limits(client: FlaskClient):
+    bundle = database.get_latest(BackupBundle)
+    assert bundle
+
+    form_data = bundle_form_data(2)
+    form_data["bundle_id"] = str(bundle.id)
+
+    # FAIL | invalid nice level
+    response = client.post(f"/bundles/form/update/{bundle.id}", data={**form_data, "nice": "-5"})
+    assert response.headers["BORGDRONE_RETURN"] == "BundleManager.process_bundle_form.FAILURE"
+
+    # OK | priorities apply without a cgroup
+    form_data.update({"nice": "10", "ionice_class": "best-effort", "ionice_priority": "7"})
+    response = client.post(f"/bundles/form/update/{bundle.id}", data=form_data)
+    assert response.headers["BORGDRONE_RETURN"] == "BundleManager.process_bundle_form.SUCCESS"
+    assert bundle.nice == 10
+
+    limits = bundle_manager.resource_limits(bundle)
+    assert limits.wrap(["borg", "create"])[:3] == ["nice", "-n", "10"]
+
+    result_log = bundle_manager.create_backup(bundle.id)
+    assert result_log.status == "SUCCESS"
+
+    # reset for the other tests
+    form_data.update({"nice": "", "ionice_class": "", "ionice_priority": ""})
+    response = client.post(f"/bundles/form/update/{bundle.id}", data=form_data)
+    assert bundle.nice is None
+
+
+def test_run_many(client: FlaskClient):
+    bundle = database.get_latest(BackupBundle)
+    assert bundle
+
+    archive_count = database.count(Archive)
+
+    # OK | through the API
+    response = client.post("/bundles/run-many", json={"bundle_ids": [bundle.id], "limit": 2})
+    assert response.status_code == 200
+    run_id = response.json["id"]
+
+    backup_run = run_manager.wait(run_id, timeout=120)
+    assert backup_run
+    assert backup_run.status == "DONE"
+    assert backup_run.summary()["counts"] == {"SUCCESS": 1}
+    assert backup_run.summary()["original_size"] > 0
+    assert database.count(Archive) == archive_count + 1
+
+    response = client.get(f"/bundles/runs/{run_id}")
+    assert response.json["status"] == "DONE"
+
+    response = client.get("/bundles/runs")
+    assert response.status_code == 200
+
+    # FAIL | Bundle not found.
+    response = client.post("/bundles/run-many", data={"bundle_ids": ["0"]})
+    assert response.headers["BORGDRONE_RETURN"] == "RunManager.start_run.FAILURE"
+
+    response = client.get("/bundles/runs/unknown")
+    assert response.status_code == 404
+
+
+def test_retention(client: FlaskClient):
+    # the planner follows borg prune: newest of each period, then the oldest when a rule runs short
+    day = 86400
+    rows = [
+        (3, "b-3", 3 * day, "h3", "d3", "w1", "m1", "y1"),
+        (2, "b-2", day + 60, "h2", "d1", "w1", "m1", "y1"),
+        (1, "b-1", day, "h1", "d1", "w1", "m1", "y1"),
+        (0, "b-0.checkpoint", 0, "h0", "d0", "w0", "m0", "y0"),
+    ]
+    assert retention.plan(rows, retention.RetentionPolicy(daily=1), 4 * day) == ["daily #1", None, None, None]
+    reasons = retention.plan(rows, retention.RetentionPolicy(daily=3), 4 * day)
+    assert reasons == ["daily #1", "daily #2", "daily #3 (oldest)", None]
+    assert retention.plan(rows, retention.RetentionPolicy(within="2d"), 4 * day) == ["within", None, None, None]
+
+    bundle = database.get_latest(BackupBundle)
+    assert bundle
+
+    for _ in range(2):
+        result_log = bundle_manager.create_backup(bundle.id)
+        assert result_log.status == "SUCCESS"
+
+    # FAIL | invalid interval
+    response = client.post(f"/archives/retention/{bundle.id}", data={"keep_within": "2 days"})
+    assert response.headers["BORGDRONE_RETURN"] == "BundleManager.update_retention.FAILURE"
+
+    # FAIL | no policy to prune with
+    response = client.post(f"/archives/retention/{bundle.id}/prune")
+    assert response.headers["BORGDRONE_RETURN"] == "RetentionManager.prune.FAILURE"
+
+    response = client.get(f"/archives/retention/{bundle.id}/preview?keep_daily=1")
+    assert response.status_code == 200
+
+    response = client.post(f"/archives/retention/{bundle.id}", data={"keep_daily": "1"})
+    assert response.headers["BORGDRONE_RETURN"] == "BundleManager.update_retention.SUCCESS"
+    assert bundle.keep_daily == 1
+    assert retention.RetentionPolicy.from_bundle(bundle).keep_flags() == ["--keep-daily", "1"]
+
+    plan = retention_manager.plan_retention(bundle)
+    assert plan.kept_count >= 1
+    assert plan.removed_count >= 2
+
+    response = client.post(f"/archives/retention/{bundle.id}/prune")
+    assert response.headers["BORGDRONE_RETURN"] == "RetentionManager.prune.SUCCESS"
+    remaining = {archive.name for archive in Archive.query.filter_by(backupbundle_id=bundle.id)}
+    assert remaining == {archive["name"] for archive in plan.kept()}
+
+    # reset for the other tests
+    response = client.post(f"/archives/retention/{bundle.id}", data={})
+    assert bundle.keep_daily is None
@@ -0,0 +1,228 @@
+import subprocess
+import sys
+import time
+from typing import Any, Callable, List
+
+from flask.testing import FlaskClient
+
+from borgdrone.extensions import socketio
+from borgdrone.helpers import pump, socketemitter
+from borgdrone.helpers.accounting import AccountedPopen
+
+
+def python_process(code: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def test_pump_interleaved():
+    # stderr alone fills far more than a pipe buffer, a reader blocked on stdout would deadlock
+    process = python_process(
+        "import sys\n"
+        "for i in range(2000):\n"
+        "    sys.stderr.write(f'err {i} ' + 'x' * 100 + '\\n')\n"
+        "    if i % 500 == 0:\n"
+        "        sys.stdout.write(f'out {i}\\n')\n"
+        "        sys.stdout.flush()\n"
+    )
+
+    lines = []
+    buffer = pump.LineBuffer(maxlen=10000)
+    stats = pump.pump(process, lambda name, line: lines.append((name, line)), buffer)
+
+    stdout = [line for name, line in lines if name == "stdout"]
+    stderr = [line for name, line in lines if name == "stderr"]
+    assert stdout == ["out 0", "out 500", "out 1000", "out 1500"]
+    assert len(stderr) == 2000
+    assert stderr[0].startswith("err 0 ") and stderr[-1].startswith("err 1999 ")
+
+    assert process.returncode == 0
+    assert stats.lines == 2004
+    assert stats.stream_bytes["stdout"] == sum(len(line) + 1 for line in stdout)
+    assert stats.bytes == sum(stats.stream_bytes.values())
+    assert stats.finished is not None
+    assert buffer.tail(4, "stdout") == stdout
+
+
+def test_pump_carriage_return():
+    # borg ends progress lines with \r, a trailing line without an ending is flushed at EOF
+    process = python_process("import sys; sys.stderr.write('10%\\r20%\\r30%\\ndone\\r\\nlast')")
+
+    lines = []
+    pump.pump(process, lambda name, line: lines.append(line), chunk_size=3)
+
+    assert lines == ["10%", "20%", "30%", "done", "last"]
+
+
+def test_pump_split_line_ending():
+    # \r\n split over two reads is one line ending, not two
+    process = python_process(
+        "import sys, time\n"
+        "sys.stdout.buffer.write(b'a\\r')\n"
+        "sys.stdout.flush()\n"
+        "time.sleep(0.2)\n"
+        "sys.stdout.buffer.write(b'\\nb\\n')\n"
+    )
+
+    lines = []
+    pump.pump(process, lambda name, line: lines.append(line))
+
+    assert lines == ["a", "b"]
+
+
+def test_pump_max_line_length():
+    process = python_process("import sys; sys.stdout.write('x' * 100 + '\\nshort\\n')")
+
+    lines = []
+    stats = pump.pump(process, lambda name, line: lines.append(line), chunk_size=16, max_line_length=30)
+
+    # an unterminated line longer than the limit is flushed in pieces, nothing is lost
+    assert all(len(line) <= 30 + 16 for line in lines)
+    assert "".join(lines[:-1]) == "x" * 100
+    assert lines[-1] == "short"
+    assert stats.truncated_lines == len(lines) - 2
+
+
+def test_line_buffer():
+    buffer = pump.LineBuffer(maxlen=3)
+    for i in range(5):
+        buffer.append("stdout" if i % 2 else "stderr", f"line {i}")
+
+    assert len(buffer.lines) == 3
+    assert buffer.dropped == 2
+    assert buffer.tail() == ["line 2", "line 3", "line 4"]
+    assert buffer.tail(1) == ["line 4"]
+    assert buffer.tail(stream="stderr") == ["line 2", "line 4"]
+
+
+def test_accounted_popen():
+    # the resource usage of the child itself, not of all of our children
+    with AccountedPopen([sys.executable, "-c", "sum(range(3 * 10**6)); exit(3)"], stdout=subprocess.PIPE) as process:
+        process.communicate()
+    assert process.returncode == 3
+    assert process.rusage is not None
+    assert process.rusage.ru_utime > 0
+    assert process.rusage.ru_maxrss > 0
+
+    with AccountedPopen(["sleep", "10"]) as process:
+        process.terminate()
+    assert process.returncode == -15
+    assert process.rusage is not None
+
+    # reaped by poll(), Popen still knows how it ended
+    process = AccountedPopen(["true"])
+    while process.poll() is None:
+        time.sleep(0.01)
+    assert process.wait() == 0
+    assert process.rusage is None
+
+
+class FakeSocket:
+    """Stands in for `socketio.emit`, acknowledging frames right away or only when told to."""
+
+    def __init__(self, ack: bool = True):
+        self.ack = ack
+        self.frames: List[List[str]] = []
+        self.callbacks: List[Callable[..., Any]] = []
+
+    def emit(self, event: str, data: dict, to: str, namespace: str, callback: Callable[..., Any]) -> None:
+        assert event == "send_line" and to == "sid"
+        self.frames.append(data["text"].splitlines())
+        if self.ack:
+            callback()
+        else:
+            self.callbacks.append(callback)
+
+    def ack_all(self) -> None:
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def test_emitter_batching(monkeypatch):
+    fake = FakeSocket()
+    monkeypatch.setattr(socketio, "emit", fake.emit)
+
+    # lines pushed within one interval go out as one frame
+    emitter = socketemitter.LineEmitter("sid", interval=0.2)
+    for i in range(100):
+        emitter.push(f"line {i}")
+    emitter.close()
+
+    assert fake.frames == [[f"line {i}" for i in range(100)]]
+    assert emitter.metrics == {
+        "lines_in": 100,
+        "lines_sent": 100,
+        "lines_coalesced": 99,
+        "lines_dropped": 0,
+        "frames_sent": 1,
+    }
+
+    # a full frame is sent without waiting for the next tick
+    fake.frames.clear()
+    emitter = socketemitter.LineEmitter("sid", interval=0.2, max_frame_bytes=100)
+    for i in range(10):
+        emitter.push(f"{i}".ljust(49, "."))
+    emitter.close()
+
+    assert [len(frame) for frame in fake.frames] == [2] * 5
+    assert emitter.metrics["lines_coalesced"] == 5
+
+
+def test_emitter_backpressure(monkeypatch):
+    fake = FakeSocket(ack=False)
+    monkeypatch.setattr(socketio, "emit", fake.emit)
+
+    emitter = socketemitter.LineEmitter("sid", interval=0.05, max_frame_bytes=100, max_unacked=2)
+    for i in range(10):
+        emitter.push(f"{i}".ljust(49, "."))
+
+    # nothing more is sent while two frames are unanswered
+    time.sleep(0.3)
+    assert len(fake.frames) == 2
+
+    fake.ack_all()
+    time.sleep(0.3)
+    assert len(fake.frames) == 4
+
+    fake.ack = True
+    fake.ack_all()
+    emitter.close()
+    assert len(fake.frames) == 5
+    assert sum(len(frame) for frame in fake.frames) == 10
+
+
+def test_emitter_drop_policy(monkeypatch, client: FlaskClient):
+    fake = FakeSocket()
+    monkeypatch.setattr(socketio, "emit", fake.emit)
+    before = socketemitter.get_metrics()
+
+    # a client too slow for 20 lines while only 5 may wait
+    emitter = socketemitter.LineEmitter("sid", interval=0.2, max_pending=5)
+    for i in range(20):
+        emitter.push(f"line {i}")
+    emitter.close()
+
+    assert fake.frames == [
+        ["[... 15 lines skipped, the connection is too slow ...]"] + [f"line {i}" for i in range(15, 20)]
+    ]
+    assert emitter.metrics["lines_dropped"] == 15
+
+    fake.frames.clear()
+    emitter = socketemitter.LineEmitter("sid", interval=0.2, max_pending=5, policy="drop")
+    for i in range(20):
+        emitter.push(f"line {i}")
+    emitter.close()
+
+    assert fake.frames == [[f"line {i}" for i in range(15, 20)]]
+
+    # the totals of all emitters are on the dashboard
+    after = socketemitter.get_metrics()
+    assert after["lines_dropped"] - before["lines_dropped"] == 30
+    assert after["lines_in"] - before["lines_in"] == 40
+
+    response = client.get("/socket-output")
+    assert response.status_code == 200
+    assert response.json == after
+
+    response = client.get("/accounting")
+    assert response.status_code == 200
@@ -1,12 +1,19 @@
-from flask.testing import FlaskClient
+import asyncio
+import os
 
+from flask.testing import FlaskClient, FlaskCliRunner
+
+from borgdrone.archives import Archive
 from borgdrone.borg import BorgRunner as borg_runner
-from borgdrone.helpers import database, filemanager
+from borgdrone.extensions import borg_accounting, borg_backend, borg_cache
+from borgdrone.helpers import bash, database, filemanager
 from borgdrone.logging import logger
 from borgdrone.repositories import Repository
 from borgdrone.repositories import RepositoryManager as repository_manager
+from borgdrone.repositories import StatsManager as stats_manager
+from borgdrone.repositories import VerificationManager as verification_manager
 
-from .conftest import REPO_2
+from .conftest import INSTANCE_PATH, REPO_2
 
 
 def test_get(client: FlaskClient):
@@ -107,3 +114,204 @@ def test_update_stats(client: FlaskClient):
     # FAIL | Failed to find repository.
     response = client.post("/repositories/update/0")
     assert response.headers["BORGDRONE_RETURN"] == "RepositoryManager.update_repository_info.FAILURE"
+
+
+def test_update_all_stats(client: FlaskClient):
+    # OK
+    response = client.post("/repositories/update")
+    assert response.headers["BORGDRONE_RETURN"] == "RepositoryManager.update_all_repository_info.SUCCESS"
+
+
+def test_stats_history(client: FlaskClient, archive: Archive):
+    # an empty repository has no deduplication ratio, `archive` gives it data
+    repository = database.get_by_id(1, Repository)
+    assert repository
+
+    snapshots = stats_manager.count_snapshots(repository.id)
+    for _ in range(2):
+        response = client.post(f"/repositories/update/{repository.id}")
+        assert response.headers["BORGDRONE_RETURN"] == "RepositoryManager.update_repository_info.SUCCESS"
+    assert stats_manager.count_snapshots(repository.id) == snapshots + 2
+
+    # both refreshes are folded into the same hour, day and week
+    for period in stats_manager.PERIODS:
+        points = stats_manager.get_history(repository.id, period)
+        assert points[-1]["samples"] >= 2
+        assert points[-1]["unique_csize"] == repository.unique_csize
+        assert points[-1]["dedup_ratio"] is not None
+
+    response = client.get(f"/repositories/{repository.id}/history?period=hour&days=1")
+    assert response.status_code == 200
+    assert response.json and response.json["points"]
+
+    response = client.get(f"/repositories/{repository.id}/history?period=month")
+    assert response.status_code == 400
+
+    response = client.get(f"/repositories/{repository.id}/history/chart")
+    assert response.status_code == 200
+
+
+def test_repository_info_async(client: FlaskClient):
+    repository = database.get_by_id(1, Repository)
+    assert repository
+
+    results = asyncio.run(borg_runner.gather_repository_info([(repository.path, None), ("/bad/path", None)], limit=2))
+    assert results[0].status == "SUCCESS"
+    assert results[1].error_code == "Borg.Repository.DoesNotExist"
+
+
+def test_result_cache(client: FlaskClient):
+    repository = database.get_by_id(1, Repository)
+    assert repository
+
+    borg_cache.invalidate()
+    hits = borg_cache.hits
+
+    # the second query is answered from the cache
+    assert borg_runner.borg_info(repository.path).status == "SUCCESS"
+    assert borg_runner.borg_info(repository.path).status == "SUCCESS"
+    assert borg_cache.hits == hits + 1
+
+    # compacting modifies the repository and drops its entries
+    borg_runner.borg_compact(repository.path)
+    assert borg_runner.borg_info(repository.path).status == "SUCCESS"
+    assert borg_cache.hits == hits + 1
+
+    # remote and missing repositories are never cached
+    assert borg_runner.borg_info("/bad/path").status == "FAILURE"
+    assert borg_cache.get("/bad/path", "key") == (None, None)
+
+
+def test_repository_env(client: FlaskClient):
+    repository = database.get_by_id(1, Repository)
+    assert repository
+
+    # the passphrase is handed to borg only, never to our own environment
+    result_log = borg_runner.repository_info(repository.path, "not-our-passphrase")
+    assert result_log.status == "SUCCESS"
+    assert os.environ.get("BORG_PASSPHRASE") != "not-our-passphrase"
+
+    assert borg_runner.repository_env(None) is None
+    assert borg_runner.repository_env("secret") == {"BORG_PASSPHRASE": "secret"}
+
+    # a cached result is only returned for the passphrase it was read with
+    path = f"{INSTANCE_PATH}/EncryptedRepo"
+    env = borg_runner.repository_env("secret")
+    assert borg_runner.create_repository(path, "repokey", env).status == "SUCCESS"
+    borg_cache.invalidate()
+    assert borg_runner.repository_info(path, "secret").status == "SUCCESS"
+    assert borg_runner.repository_info(path, "secret").status == "SUCCESS"
+
+    result_log = borg_runner.repository_info(path, "wrong")
+    assert result_log.status == "FAILURE"
+    assert result_log.error_code == "Borg.PassphraseWrong"
+    assert borg_runner.repository_info(path).error_code == "Borg.PassphraseWrong"
+
+
+def test_run_verification(client: FlaskClient, runner: FlaskCliRunner):
+    repository = database.get_by_id(1, Repository)
+    assert repository
+
+    # OK | a small repository is checked completely in one slice
+    result_log = verification_manager.run_verification(budget=120, slice_seconds=60, verify_data_days=30)
+    assert result_log.status == "SUCCESS"
+
+    state = verification_manager.get_state(repository)
+    assert state.cycles >= 1
+    assert state.last_verify_data
+    assert state.last_status == "SUCCESS"
+
+    # not enough budget for a single slice
+    result_log = verification_manager.run_verification(budget=0)
+    assert result_log.message == "Verification ran 0 slices, 0 cycles completed."
+
+    result = runner.invoke(args=["repositories", "verify", "--budget", "60", "--slice", "60"])
+    assert "Verification ran" in result.output
+
+
+def test_check_slice(client: FlaskClient):
+    repository = database.get_by_id(1, Repository)
+    assert repository
+
+    # a small repository is checked to its last segment
+    result_log = borg_runner.borg_check_slice(repository.path, 60)
+    assert result_log.status == "SUCCESS"
+    data = result_log.get_data()
+    assert data and data["complete"] is True
+    assert isinstance(data["segment"], int)
+
+    # one chunk per segment, ~36000 segments take a few seconds to check
+    path = f"{INSTANCE_PATH}/SliceRepo"
+    data_path = f"{INSTANCE_PATH}/slice_data.bin"
+    with open(data_path, "wb") as file:
+        file.write(os.urandom(60 * 1000 * 1000))
+    try:
+        assert borg_runner.create_repository(path, "none").status == "SUCCESS"
+        assert bash.run(f"borg config {path} max_segment_size 1024")["returncode"] == 0
+        result = bash.run(f"borg create --compression none --chunker-params 10,11,10,63 {path}::data {data_path}")
+        assert result["returncode"] == 0
+    finally:
+        os.remove(data_path)
+
+    result_log = borg_runner.borg_check_slice(path, 1)
+    assert result_log.status == "SUCCESS"
+    first = result_log.get_data()
+    assert first and first["complete"] is False
+    assert isinstance(first["segment"], int)
+
+    # the next slice continues where the last one stopped
+    for _ in range(10):
+        result_log = borg_runner.borg_check_slice(path, 1)
+        data = result_log.get_data()
+        assert data and isinstance(data["segment"], int)
+        assert data["segment"] > first["segment"]
+        if data["complete"]:
+            break
+    assert data["complete"] is True
+
+
+def test_accounting(client: FlaskClient):
+    repository = database.get_by_id(1, Repository)
+    assert repository
+
+    borg_cache.invalidate()
+    result_log = borg_runner.borg_info(repository.path)
+    assert result_log.status == "SUCCESS"
+
+    record = borg_accounting.recent()[-1]
+    assert record["kind"] == "info"
+    assert record["returncode"] == 0
+    assert record["stdout_bytes"] > 0
+    assert record["user_time"] is not None
+
+    response = client.get("/accounting")
+    assert response.status_code == 200
+
+    response = client.get("/accounting?hours=0")
+    assert response.status_code == 200
+
+
+def test_worker_backend(client: FlaskClient):
+    repository = database.get_by_id(1, Repository)
+    assert repository
+
+    assert borg_backend.eligible(["borg", "info", "--json", repository.path])
+    assert not borg_backend.eligible(["borg", "create", f"{repository.path}::name", "/tmp"])
+
+    borg_backend.enabled = True
+    try:
+        borg_cache.invalidate()
+        result_log = borg_runner.borg_info(repository.path)
+        assert result_log.status == "SUCCESS"
+        assert borg_backend.to_dict()["error"] is None
+
+        # errors come back in the same format as from the CLI
+        result_log = borg_runner.borg_info("/bad/path")
+        assert result_log.error_code == "Borg.Repository.DoesNotExist"
+
+        result_log = borg_runner.benchmark_backends(repository.path, repeat=1)
+        assert result_log.status == "SUCCESS"
+        assert [row["command"] for row in result_log.get_data() or []] == ["info", "list"]
+    finally:
+        borg_backend.enabled = False
+        borg_backend.shutdown()